@@ -0,0 +1,300 @@
+""" Benchmarks of the hot paths of stocklab, run it like::
+
+        python benchmarks/bench.py -o new.json
+        python benchmarks/bench.py -o new.json --compare old.json
+
+    The benchmarks run on synthetic bundles generated in a temporary
+    directory: a deep chain of nodes, a node with a wide fan-out, a
+    `DataNode` with a large schema, and a bundle of many node files for the
+    cold start.  Each result is the best of several repeats.
+
+    The results are written in JSON.  With `--compare`, the ratio to the
+    previous results is reported, and the exit status is 1 if any
+    benchmark regressed more than `--threshold`.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import stocklab
+
+CONFIG = """\
+root_dir: "./app_data"
+log_level: WARNING
+force_offline: false
+database:
+  type: sqlite
+  filename: db.sqlite
+"""
+
+CHAIN_NODE = """\
+from stocklab import DataIdentifier as DI
+from stocklab.node import *
+
+class Chain(Node):
+    args = Args(n = Arg(type=int), tag = Arg())
+
+    def evaluate(n, tag):
+        if n == 0:
+            return 0
+        return DI('Chain')(n=n - 1, tag=tag) + 1
+"""
+
+FANOUT_NODE = """\
+from stocklab import DataIdentifier as DI
+from stocklab.node import *
+
+class FanOut(Node):
+    args = Args(width = Arg(type=int), tag = Arg())
+
+    def evaluate(width, tag):
+        return sum(DI('Leaf').batch([{'i': i, 'tag': tag}
+            for i in range(width)]))
+"""
+
+LEAF_NODE = """\
+from stocklab.node import *
+
+class Leaf(Node):
+    args = Args(i = Arg(type=int), tag = Arg())
+
+    def evaluate(i, tag):
+        return i
+"""
+
+WIDE_NODE = """\
+from stocklab.node import *
+
+class Wide(DataNode):
+    args = Args(k = Arg(type=int))
+    schema = Schema(
+            stock = {'key': True},
+            date = {'type': 'integer', 'key': True},
+            **{f'col{i}': {'type': 'double'} for i in range(50)},
+            )
+
+    def evaluate(k):
+        raise NotImplementedError()
+"""
+
+SYNTH_NODE = """\
+from stocklab.node import *
+
+class Synth{i}(Node):
+    args = Args(a = Arg(type=int), b = Arg(oneof=['x', 'y']))
+
+    def evaluate(a, b):
+        return a
+"""
+
+def measure(func, number, repeat=5, setup=None):
+    """Returns the best time per call in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def create_bundle(path, files):
+    os.makedirs(path)
+    for name, src in files.items():
+        with open(os.path.join(path, f'{name}.py'), 'w') as f:
+            f.write(src)
+
+class Suite:
+    def __init__(self, workdir, quick=False):
+        super().__init__()
+        self.workdir = workdir
+        self.scale = 10 if quick else 1
+        self.results = {}
+
+    def record(self, name, value, unit, higher_is_better):
+        self.results[name] = {'value': value, 'unit': unit,
+                'higher_is_better': higher_is_better}
+        print(f'{name:32s} {value:14.3f} {unit}', file=sys.stderr)
+
+    def setup(self):
+        config_file = os.path.join(self.workdir, 'config.yml')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG)
+        os.makedirs(os.path.join(self.workdir, 'app_data'))
+        create_bundle(os.path.join(self.workdir, 'synthetic'), {
+            'Chain': CHAIN_NODE,
+            'FanOut': FANOUT_NODE,
+            'Leaf': LEAF_NODE,
+            'Wide': WIDE_NODE,
+            })
+        create_bundle(os.path.join(self.workdir, 'many'), {
+            f'Synth{i}': SYNTH_NODE.format(i=i) for i in range(300)})
+        stocklab.bundle(os.path.join(self.workdir, 'synthetic'))
+        stocklab.configure(config_file)
+
+    def run(self):
+        from stocklab.core.node import flush_cache
+        for bench in [self.bench_eval, self.bench_cache, self.bench_fields,
+                self.bench_chain, self.bench_fanout, self.bench_ingest,
+                self.bench_cold_start]:
+            flush_cache()
+            bench()
+        return self.results
+
+    def bench_eval(self):
+        di_str = 'Leaf.i:1.tag:eval'
+        stocklab.eval(di_str)
+        self.record('eval_cached', 1 / measure(
+            lambda: stocklab.eval(di_str), 20000 // self.scale),
+            'ops/s', True)
+        di = stocklab.DataIdentifier(di_str)
+        self.record('eval_identifier_cached', 1 / measure(
+            lambda: di(), 20000 // self.scale), 'ops/s', True)
+
+    def bench_cache(self):
+        from stocklab.core.cache import LRUCache
+        cache = LRUCache(max_entries=10000)
+        keys = [f'Leaf.i:{i}.tag:cache' for i in range(20000)]
+        for key in keys[:10000]:
+            cache.set(key, 1)
+        hits = iter(keys[:10000] * 10)
+        misses = iter(keys[10000:] * 10)
+        self.record('cache_hit', measure(lambda: cache.get(next(hits)),
+            10000 // self.scale) * 1e6, 'us', False)
+        self.record('cache_miss', measure(lambda: cache.get(next(misses)),
+            10000 // self.scale) * 1e6, 'us', False)
+        leaf = stocklab.DataIdentifier('Leaf.tag:miss')
+        counter = iter(range(10 ** 9))
+        self.record('eval_uncached', measure(
+            lambda: leaf(i=next(counter)), 10000 // self.scale) * 1e6,
+            'us', False)
+
+    def bench_fields(self):
+        from stocklab.core import bundle
+        node = bundle.get_node('Leaf')
+        fields = {'i': '12', 'tag': 'fields'}
+        self.record('type_normalization', measure(
+            lambda: node.type_normalization(dict(fields)),
+            20000 // self.scale) * 1e6, 'us', False)
+        fields = node.type_normalization(dict(fields))
+        self.record('node_path', measure(lambda: node.path(**fields),
+            20000 // self.scale) * 1e6, 'us', False)
+
+    def bench_chain(self):
+        from stocklab.core.node import flush_cache
+        depth = 50 # each level takes several frames of the recursion limit
+        self.record('deep_chain', measure(
+            lambda: stocklab.eval(f'Chain.n:{depth}.tag:chain'), 1,
+            repeat=10 // self.scale + 1, setup=flush_cache) * 1e3,
+            'ms', False)
+
+    def bench_fanout(self):
+        from stocklab.core.node import flush_cache
+        width = 2000 // self.scale
+        self.record('wide_fanout', measure(
+            lambda: stocklab.eval(f'FanOut.width:{width}.tag:fanout'), 1,
+            repeat=5, setup=flush_cache) * 1e3, 'ms', False)
+
+    def bench_ingest(self):
+        from stocklab.db import get_db
+        from stocklab.core import bundle
+        node = bundle.get_node('Wide')
+        size = 20000 // self.scale
+        offset = iter(range(0, 10 ** 9, size))
+        def _ingest():
+            start = next(offset)
+            records = [dict({f'col{i}': 0.5 for i in range(50)},
+                stock='acme', date=d) for d in range(start, start + size)]
+            with get_db('database') as db:
+                db.declare_table(node.name, node.schema)
+                db.update(node, records)
+        self.record('db_update', size / measure(_ingest, 1, repeat=3),
+                'records/s', True)
+
+    def bench_cold_start(self):
+        script = ('import time; start = time.perf_counter(); '
+                'import stocklab; '
+                f'stocklab.bundle({os.path.join(self.workdir, "many")!r}); '
+                f'stocklab.configure({os.path.join(self.workdir, "config.yml")!r}); '
+                "stocklab.eval('Synth7.a:1.b:x'); "
+                'print(time.perf_counter() - start)')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.join(os.path.dirname(__file__), '..')] + sys.path))
+        def _run():
+            out = subprocess.run([sys.executable, '-c', script], env=env,
+                    check=True, capture_output=True, text=True).stdout
+            return float(out.split()[-1])
+        _run() # builds the manifest
+        self.record('cold_start', min(_run() for _ in range(3)) * 1e3, 'ms',
+                False)
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of `results` to `baseline`.
+
+    :returns: The names of the regressed benchmarks.
+    """
+    regressed = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['value']
+        ratio = res['value'] / old if old else float('inf')
+        speedup = ratio if res['higher_is_better'] else 1 / ratio
+        flag = ''
+        if speedup < 1 - threshold:
+            regressed.append(name)
+            flag = ' REGRESSED'
+        print(f'{name:32s} {old:14.3f} -> {res["value"]:14.3f} '
+                f'{res["unit"]:10s} x{speedup:.2f}{flag}')
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write the results to a file')
+    parser.add_argument('--compare', help='the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help='the tolerated slowdown, defaults to 0.1 (10%%)')
+    parser.add_argument('--quick', action='store_true',
+            help='fewer iterations, for smoke testing')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            suite = Suite(workdir, quick=args.quick)
+            suite.setup()
+            results = suite.run()
+        finally:
+            os.chdir(cwd)
+    report = {
+            'meta': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'quick': args.quick,
+                },
+            'results': results,
+            }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
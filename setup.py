@@ -22,4 +22,9 @@ setup(
         'pyDAL',
         'pyyaml',
         ],
+    extras_require={
+        'series': ['numpy'],
+        'columnar': ['pyarrow>=14'],
+        'test': ['pytest', 'numpy', 'pyarrow>=14'],
+        },
 )
@@ -1,26 +1,87 @@
 from .core.bundle import bundle, register, get_node
 from .core.config import configure
+from .core.identifier import DataIdentifier
 
-DataIdentifier = get_node
+import sys
 
 def reset():
     from .core.config import _reset as reset_config
     from .core.bundle import _reset as reset_bundle
     from .core.logger import _reset as reset_logger
+    from .core.cache import _reset as reset_cache
+    from .core.persist import _reset as reset_persist
+    from .core.ratelimit import _reset as reset_ratelimit
+    from .core.identifier import _reset as reset_identifier
+    from .core.deps import _reset as reset_deps
+    if 'stocklab.ingest' in sys.modules: # the writer requires the config
+        sys.modules['stocklab.ingest']._reset()
     reset_config()
     reset_bundle()
     reset_logger()
+    reset_cache()
+    reset_persist()
+    reset_ratelimit()
+    reset_identifier()
+    reset_deps()
+    if 'stocklab.db' in sys.modules: # avoid importing pyDAL
+        sys.modules['stocklab.db']._reset()
 
 def eval(di_str):
     """
     Evaluate the DataIdentifier string.
 
     :param di_str: the DataIdentifier.
-    :type di_str: str
-    """
-    names = di_str.split('.')
-    node_name = names[0]
-    fields = [field.split(':') for field in names[1:]]
-    fields = {k:v for k,v in fields}
-    node = get_node(node_name)
-    return node(**fields)
+    :type di_str: str, DataIdentifier
+    """
+    di = DataIdentifier(di_str)
+    return di.node(di)
+
+async def aeval(di_str):
+    """
+    The asynchronous version of `eval`, see `Node.acall`.
+
+    :param di_str: the DataIdentifier.
+    :type di_str: str, DataIdentifier
+    """
+    di = DataIdentifier(di_str)
+    return await di.node.acall(di)
+
+def eval_many(di_strs, executor=None):
+    """
+    Evaluate a list of DataIdentifier strings as a batch.  Each distinct
+    DataIdentifier, including the ones requested during the evaluation, is
+    resolved only once within the batch.
+
+    :param di_strs: the DataIdentifiers.
+    :type di_strs: list of str or DataIdentifier
+    :param executor: (Optional) Evaluate with a pool of workers, see
+        `stocklab.core.executor.Executor`.
+    :type executor: Executor
+    :returns: The evaluated results, in the same order as `di_strs`.
+    """
+    dis = [DataIdentifier(di_str) for di_str in di_strs]
+    if executor is not None:
+        return executor.evaluate([(di.node.name, di.fields) for di in dis])
+    from .core.node import batch_scope
+    groups = {}
+    for di in dict.fromkeys(dis):
+        groups.setdefault(di.node, []).append(di)
+    results = {}
+    with batch_scope():
+        for node, group in groups.items():
+            results.update(zip(group, node.batch([di.fields for di in group])))
+    return [results[di] for di in dis]
+
+def plan(di_strs):
+    """
+    Evaluate DataIdentifiers against the local database only.  Crawlers are
+    not called, instead the `CrawlerTrigger`s are collected so the missing
+    data can be crawled in bulk (see `stocklab.node.Plan`).  The
+    DataIdentifiers not requiring missing data are evaluated and cached.
+
+    :param di_strs: the DataIdentifiers.
+    :type di_strs: list of str or DataIdentifier
+    :returns: The `Plan` of the missing data.
+    """
+    from .node import plan
+    return plan([DataIdentifier(di_str) for di_str in di_strs])
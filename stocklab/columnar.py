@@ -0,0 +1,291 @@
+""" This module keeps the tables of `DataNode`s as columnar files, for the
+    analytics reading whole histories at once.  It requires `pyarrow`
+    (``pip install stocklab[columnar]``), and is enabled by the `columnar`
+    option of the database configuration::
+
+        database:
+          type: sqlite
+          filename: db.sqlite
+          columnar:
+            dirname: columnar # under root_dir
+            format: parquet # or ipc, uncompressed Arrow files
+            compact_after: 64 # files of a table, 0 to compact manually
+
+    Once enabled, the records written by `get_db.update` are also appended
+    to the columnar store when they are committed, each table in a
+    directory partitioned by the schema fields with `'partition': True`
+    (defaults to the first key field), e.g.
+    ``columnar/Price/stock=acme/part-*.parquet``.  The files are never
+    modified, a record overwritten by `update_existed` is appended again and
+    the latest one is kept when reading.  Each commit appends a file per
+    partition, once a table has more than `compact_after` files it is
+    compacted (see `ColumnarStore.compact`).  Read it like::
+
+        from stocklab.db import get_db
+        with get_db('database') as db:
+            table = db.columnar.read(Price, stock='acme',
+                    date=range(1000, 2000), columns=['date', 'price'])
+
+    The filters on partition fields skip the other directories, the others
+    are pushed down to the row groups of the files.  The files are memory
+    mapped, with the `ipc` format the columns are read without copying.
+
+    The tables stored in the database before enabling the store can be
+    imported by `ColumnarStore.import_from`, `ColumnarStore.export_to` does
+    the reverse.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+_FORMATS = {'parquet': 'parquet', 'ipc': 'arrow'} # format -> file extension
+_SEQ = '_seq' # the column ordering the appended records
+
+def open_store(root_dir, config):
+    """
+    Returns the `ColumnarStore` configured by the `columnar` option of a
+    database configuration, or None if the option is not set.
+    """
+    if not config:
+        return None
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('The columnar store requires pyarrow, install it '
+                'by `pip install stocklab[columnar]`.')
+    return ColumnarStore(os.path.join(root_dir, config.get('dirname',
+        'columnar')), config.get('format', 'parquet'),
+        config.get('compact_after', 64))
+
+@contextmanager
+def _file_lock(path):
+    """Serialize the compactions of a table among processes."""
+    try:
+        import fcntl
+    except ImportError: # not a POSIX system
+        yield
+        return
+    with open(path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _arrow_type(cfg):
+    import pyarrow as pa
+    types = {
+            'string': pa.string(),
+            'text': pa.string(),
+            'integer': pa.int64(),
+            'bigint': pa.int64(),
+            'double': pa.float64(),
+            'boolean': pa.bool_(),
+            'date': pa.date32(),
+            'datetime': pa.timestamp('us'),
+            }
+    field_type = cfg.get('type', 'string')
+    assert field_type in types, \
+            f'Type {field_type} is not supported by the columnar store.'
+    return types[field_type]
+
+def _partition_fields(schema):
+    fields = [k for k, cfg in schema.items() if cfg.get('partition')]
+    if fields:
+        return fields
+    keys = [k for k, cfg in schema.items() if cfg.get('key')]
+    return keys[:1]
+
+def _predicate(field, val):
+    if isinstance(val, range):
+        assert val.step == 1
+        return (field >= val.start) & (field < val.stop)
+    if isinstance(val, (list, tuple, set)):
+        return field.isin(list(val))
+    return field == val
+
+class ColumnarStore:
+    """
+    A directory of columnar files, one partitioned dataset per table.
+
+    :param path: The directory.
+    :type path: str
+    :param format: `parquet` or `ipc` (the Arrow IPC file format), defaults
+        to `parquet`.
+    :type format: str
+    :param compact_after: Compact a table once it has more files than this,
+        0 to disable, defaults to 64.
+    :type compact_after: int
+    """
+    def __init__(self, path, format='parquet', compact_after=64):
+        import pyarrow.fs
+        assert format in _FORMATS, f'Unknown format: {format}'
+        super().__init__()
+        self.path = path
+        self.format = format
+        self.compact_after = compact_after
+        self._fs = pyarrow.fs.LocalFileSystem(use_mmap=True)
+        os.makedirs(path, exist_ok=True)
+
+    def _schema(self, node):
+        import pyarrow as pa
+        return pa.schema([(k, _arrow_type(cfg))
+            for k, cfg in node.schema.items()] + [(_SEQ, pa.int64())])
+
+    def _partitioning(self, node):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        return ds.partitioning(pa.schema([(k, _arrow_type(node.schema[k]))
+            for k in _partition_fields(node.schema)]), flavor='hive')
+
+    def write(self, node, records):
+        """
+        Append `records` (a list of `dict`) to the table of `node`, the
+        records should have been converted by the schema, see
+        `get_db.update`.
+        """
+        import pyarrow as pa
+        if not records:
+            return
+        seq = time.time_ns()
+        table = pa.Table.from_pylist([dict(rec, **{_SEQ: seq})
+            for rec in records], schema=self._schema(node))
+        self._write_table(node, table, f'part-{seq}')
+        if self.compact_after and \
+                len(self._files(node)) > self.compact_after:
+            self.compact(node)
+
+    def compact(self, node):
+        """
+        Rewrite the table of `node` into one file per partition, only the
+        latest record of each key is kept.  The readers in other processes
+        may see the records twice (the latest one is still kept), or retry
+        when the old files are removed.
+
+        :returns: The number of files replaced.
+        """
+        with _file_lock(os.path.join(self.path, f'{node.name}.lock')):
+            files = self._files(node)
+            if len(files) <= 1:
+                return 0
+            import pyarrow.dataset as ds
+            table = ds.dataset(files, schema=self._schema(node),
+                    format=self.format, partitioning=self._partitioning(node),
+                    partition_base_dir=os.path.join(self.path, node.name),
+                    filesystem=self._fs).to_table()
+            keys = [k for k, cfg in node.schema.items() if cfg.get('key')]
+            if keys:
+                table = self._latest(table, keys)
+            table = table.select(self._schema(node).names)
+            self._write_table(node, table, f'compact-{time.time_ns()}')
+            for path in files:
+                os.remove(path)
+            return len(files)
+
+    def _write_table(self, node, table, basename):
+        import pyarrow.dataset as ds
+        ext = _FORMATS[self.format]
+        ds.write_dataset(table, os.path.join(self.path, node.name),
+                format=self.format, partitioning=self._partitioning(node),
+                basename_template=f'{basename}-{os.getpid()}-{{i}}.{ext}',
+                existing_data_behavior='overwrite_or_ignore',
+                filesystem=self._fs)
+
+    def _files(self, node):
+        ext = '.' + _FORMATS[self.format]
+        return [os.path.join(root, name) for root, _, names
+                in os.walk(os.path.join(self.path, node.name))
+                for name in names if name.endswith(ext)]
+
+    def dataset(self, node):
+        """
+        Returns the `pyarrow.dataset.Dataset` of the table of `node`, or
+        None if nothing was written.
+        """
+        import pyarrow.dataset as ds
+        path = os.path.join(self.path, node.name)
+        if not os.path.isdir(path):
+            return None
+        return ds.dataset(path, schema=self._schema(node), format=self.format,
+                partitioning=self._partitioning(node), filesystem=self._fs)
+
+    def read(self, node, columns=None, latest=True, **filters):
+        """
+        Read the table of `node`.
+
+        :param columns: (Optional) The names of the columns to read.
+        :type columns: list of str
+        :param latest: Keep only the latest record of each key, defaults to
+            True.
+        :type latest: bool
+        :param filters: Select the records by the values of the fields, a
+            value can also be a `range` or a `list` of values.
+        :returns: A `pyarrow.Table`.
+        """
+        for attempt in range(3):
+            try:
+                return self._read(node, columns, latest, filters)
+            except FileNotFoundError: # removed by a compaction
+                if attempt == 2:
+                    raise
+
+    def _read(self, node, columns, latest, filters):
+        import pyarrow.dataset as ds
+        dataset = self.dataset(node)
+        if dataset is None:
+            table = self._schema(node).empty_table()
+        else:
+            predicates = [_predicate(ds.field(k), v)
+                    for k, v in filters.items()]
+            expr = None
+            for pred in predicates:
+                expr = pred if expr is None else expr & pred
+            keys = [k for k, cfg in node.schema.items() if cfg.get('key')]
+            names = list(node.schema) if columns is None else list(columns)
+            needed = names + [k for k in keys + [_SEQ] if k not in names] \
+                    if latest else names
+            table = dataset.to_table(columns=needed, filter=expr)
+            if latest and keys:
+                table = self._latest(table, keys)
+        return table.select(list(node.schema) if columns is None else columns)
+
+    def _latest(self, table, keys):
+        import pyarrow.compute as pc
+        others = [c for c in table.column_names if c not in keys]
+        opts = pc.ScalarAggregateOptions(skip_nulls=False)
+        grouped = table.sort_by(_SEQ).group_by(keys, use_threads=False)
+        table = grouped.aggregate([(c, 'last', opts) for c in others])
+        renamed = {f'{c}_last': c for c in others}
+        return table.rename_columns([renamed.get(c, c)
+            for c in table.column_names])
+
+    def import_from(self, db, node, chunk_size=100000):
+        """
+        Append the records of `node` stored in the database session `db` to
+        the columnar store.
+
+        :returns: The number of records imported.
+        """
+        db.declare_table(node.name, node.schema)
+        table = db[node.name]
+        fields = [table[k] for k in node.schema]
+        count = 0
+        while True:
+            rows = db(table).select(*fields, orderby=table.id,
+                    limitby=(count, count + chunk_size)).as_list()
+            self.write(node, rows)
+            count += len(rows)
+            if len(rows) < chunk_size:
+                return count
+
+    def export_to(self, db, node, chunk_size=100000):
+        """
+        Write the latest records of `node` in the columnar store to the
+        database session `db`, following `ignore_existed` and
+        `update_existed` of `node`.
+
+        :returns: The number of records exported.
+        """
+        db.declare_table(node.name, node.schema)
+        count = 0
+        for batch in self.read(node).to_batches(max_chunksize=chunk_size):
+            db.update(node, batch.to_pylist(), columnar=False)
+            count += batch.num_rows
+        return count
@@ -0,0 +1,121 @@
+""" This module bridges the synchronous and the asynchronous (asyncio)
+    evaluation paths.  Crawler entries and `Node.evaluate` may be either
+    plain functions or `async def` functions.
+
+    The event loop running the asynchronous evaluation (see `Node.acall`) is
+    recorded, so a synchronous evaluation running in an executor thread of
+    that loop can still wait for coroutines scheduled on it.
+"""
+import asyncio
+import inspect
+import functools
+import contextvars
+
+from . import trace
+
+__loop = None
+
+def set_loop(loop):
+    """Record the event loop used by the asynchronous evaluation."""
+    global __loop
+    __loop = loop
+
+def is_async(func):
+    """
+    :returns: True if `func` is a coroutine function, or a wrapper (e.g.
+        `stocklab.crawler.SpeedLimiter`) of a coroutine function.
+    """
+    return inspect.iscoroutinefunction(func) or getattr(func, 'is_async', False)
+
+async def _await(awaitable):
+    return await awaitable
+
+def run_sync(awaitable):
+    """
+    Wait for `awaitable` from synchronous code.  It runs on the recorded
+    event loop if the loop is running in another thread, otherwise a new
+    event loop is created.
+
+    :raises RuntimeError: If called from the thread running the event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError('Cannot wait for a coroutine inside a running '
+                'event loop, use `Node.acall` or `stocklab.aeval` instead.')
+    loop = __loop
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(
+                _await(awaitable), loop).result()
+    return asyncio.run(_await(awaitable))
+
+def iter_sync(aiterable):
+    """
+    Iterate an asynchronous iterable from synchronous code.  Like
+    `run_sync`, it runs on the recorded event loop if the loop is running in
+    another thread, otherwise on a new event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError('Cannot iterate asynchronously inside a running '
+                'event loop, use `Node.acall` or `stocklab.aeval` instead.')
+    it = aiterable.__aiter__()
+    loop = __loop
+    own_loop = None
+    if loop is None or not loop.is_running():
+        loop = own_loop = asyncio.new_event_loop()
+    def _next():
+        if own_loop is not None:
+            return own_loop.run_until_complete(it.__anext__())
+        return asyncio.run_coroutine_threadsafe(
+                _await(it.__anext__()), loop).result()
+    try:
+        while True:
+            try:
+                yield _next()
+            except StopAsyncIteration:
+                return
+    finally:
+        if own_loop is not None:
+            own_loop.run_until_complete(own_loop.shutdown_asyncgens())
+            own_loop.close()
+
+def call_entry(crawler_entry, kwargs):
+    """Call `crawler_entry` synchronously, awaitable results are waited."""
+    if trace.active is not None:
+        with trace.active.span(_entry_name(crawler_entry), 'crawl', **kwargs):
+            return _call_entry(crawler_entry, kwargs)
+    return _call_entry(crawler_entry, kwargs)
+
+def _call_entry(crawler_entry, kwargs):
+    retval = crawler_entry(**kwargs)
+    if inspect.isawaitable(retval):
+        retval = run_sync(retval)
+    return retval
+
+async def acall_entry(crawler_entry, kwargs):
+    """
+    Call `crawler_entry` asynchronously.  Synchronous entries will be run in
+    the default executor of the event loop.
+    """
+    if not is_async(crawler_entry):
+        return await run_in_executor(call_entry, crawler_entry, kwargs)
+    if trace.active is not None:
+        with trace.active.span(_entry_name(crawler_entry), 'crawl', **kwargs):
+            return await crawler_entry(**kwargs)
+    return await crawler_entry(**kwargs)
+
+def _entry_name(crawler_entry):
+    return getattr(crawler_entry, '__qualname__', str(crawler_entry))
+
+async def run_in_executor(func, *args, **kwargs):
+    """Run `func` in the default executor, in a copy of the current context."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(
+            None, functools.partial(ctx.run, func, *args, **kwargs))
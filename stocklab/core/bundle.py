@@ -3,40 +3,62 @@
     `__bundles` contains the registrated nodes/crawlers.
 
     *  `__bundles`: A list of registered nodes/crawlers. Each
-       bundle is a `dict` with four keys: `base`, `files`, `nodes`
-       and `crawlers`.  The default bundle is a `dict` with `base`
-       is None.  Other bundles will have `base` set to the path
-       to bundle modules.  Other keys represent:
+       bundle is a `dict` with six keys: `base`, `files`, `lazy`,
+       `refresh_on`, `nodes` and `crawlers`.  The default bundle is a
+       `dict` with `base` is None.  Other bundles will have `base` set to
+       the path to bundle modules.  Other keys represent:
 
-       *  `files`: list of source files.
+       *  `files`: list of source files, None until the bundle is scanned.
+       *  `lazy`: mapping from names to the source files not yet imported.
+       *  `refresh_on`: mapping from node names to the names of the
+          components refreshed on them, None until `get_nodes` needs it.
        *  `nodes`: mapping from node names to the class handle.
        *  `crawlers`: mapping from crawler names to the class handle.
+
+    The modules of a bundle are imported when their nodes/crawlers are
+    first requested.  After `configure`, the results of scanning are cached
+    in a manifest file under `root_dir`, which is invalidated by the
+    modification time of the scanned files and directories.  The entries of
+    the removed directories are dropped when the manifest is saved.
 """
 import os
+import json
 import pathlib
+import threading
 import importlib.util
 
 from .error import ExceptionWithInfo
+from .config import is_configured, get_config
+
+MANIFEST_NAME = 'bundle_manifest.json'
 
 __bundles = []
+__manifest = None
+__manifest_dirty = False
+__loading = set()
+__lock = threading.RLock()
 
 def _reset():
     """
     This is only used for testing.  To get a fresh session, we should
     reset `config`, `bundle` and `logger` modules by calling their `reset()`.
     """
-    global __bundles
+    global __bundles, __manifest, __manifest_dirty
     __bundles = []
+    __manifest = None
+    __manifest_dirty = False
     default_bundle = {
-            'base': None, 'files': [], 'nodes': {}, 'crawlers': {}
+            'base': None, 'files': [], 'lazy': {}, 'refresh_on': {},
+            'nodes': {}, 'crawlers': {}
             }
     __bundles.append(default_bundle)
 
 def bundle(bundle_path):
     """
-    Scan the bundle from a directory recursively and register Nodes and
-    Crawlers.  Only files with a name ends with `.py`, starts with a capital
-    letter, and not in a hidden folder will be registered by this function.
+    Add the bundle of a directory.  Nodes and Crawlers will be registered
+    from files with a name ends with `.py`, starts with a capital letter,
+    and not in a hidden folder (searched recursively).  The directory is
+    scanned, and each file is imported, only when needed.
     
     :param bundle_path: The path to the bundle.
     :type bundle_path: str
@@ -48,32 +70,156 @@ def bundle(bundle_path):
         bundle_base = str(pathlib.Path(bundle_path).parent.resolve())
     else: # the path points to a directory
         bundle_base = bundle_path
-    __bundles.append({
-        'base': bundle_base, 'files': [], 'nodes': {}, 'crawlers': {}})
-    curr_bundle = __bundles[-1]
-
-    # Scan the bundle folder for nodes and crawlers recurrsively
-    def _scan(path):
-        for fn in os.listdir(path):
-            if fn.startswith('.'):
-                continue
-            fp = os.path.join(path, fn)
-            if os.path.isdir(fp):
-                _scan(fp)
-            else:
-                fbase = os.path.basename(fp)
-                fname, fext = os.path.splitext(fbase)
-                if fext == '.py' and not fname.startswith('_') \
-                        and fname[0].isupper():
-                    # Record full paths first, so the nodes/crawlers
-                    # will be able to import each others through
-                    # `from stocklab.core.runtime import *`
-                    curr_bundle['files'].append(fp)
-    _scan(bundle_base)
-
-    # This is where the import from `stocklab.core.runtime` will be executed
-    for fp in curr_bundle['files']:
-        register(subject=fp, bundle=-1)
+    __bundles.append({'base': bundle_base, 'files': None, 'lazy': None,
+        'refresh_on': None, 'nodes': {}, 'crawlers': {}})
+
+def _scan(bndl):
+    """Find the source files of a bundle, the manifest is used if valid."""
+    if bndl['files'] is not None:
+        return
+    base = os.path.abspath(bndl['base'])
+    entry = _get_manifest().get(base)
+    if entry is None or not all(_mtime(fp) == mtime
+            for fp, mtime in entry['dirs'].items()):
+        dirs = {}
+        files = []
+        def _walk(path):
+            dirs[path] = _mtime(path)
+            for fn in sorted(os.listdir(path)):
+                if fn.startswith('.'):
+                    continue
+                fp = os.path.join(path, fn)
+                if os.path.isdir(fp):
+                    _walk(fp)
+                else:
+                    fname, fext = os.path.splitext(fn)
+                    if fext == '.py' and not fname.startswith('_') \
+                            and fname[0].isupper():
+                        files.append(fp)
+        _walk(base)
+        old_files = entry['files'] if entry is not None else {}
+        entry = {'dirs': dirs,
+                'files': {fp: old_files.get(fp) for fp in files}}
+        _get_manifest()[base] = entry
+        _save_manifest()
+    bndl['files'] = list(entry['files'])
+    bndl['lazy'] = {_component_name(fp): fp for fp in bndl['files']}
+
+def _lazy(bndl):
+    if bndl['lazy'] is None:
+        with __lock:
+            _scan(bndl)
+    return bndl['lazy']
+
+def _load(name):
+    """
+    Import the module of the component `name` if it is not imported.  If
+    the import fails, it is tried again on the next request.
+
+    :returns: False if no bundle has the component.
+    """
+    with __lock:
+        if name in __loading: # imported by its own module
+            return False
+        for idx, bndl in enumerate(__bundles):
+            if name in _lazy(bndl):
+                __loading.add(name)
+                try:
+                    register(subject=bndl['lazy'][name], bundle=idx)
+                finally:
+                    __loading.discard(name)
+                bndl['lazy'].pop(name, None)
+                return True
+    return False
+
+def _refresh_on(idx):
+    """
+    Returns the reverse `refresh_on` index of the bundle, it is built from
+    the manifest on the first call.
+    """
+    bndl = __bundles[idx]
+    if bndl['refresh_on'] is None:
+        index = {}
+        for fp in list(_lazy(bndl).values()):
+            for source in _file_info(idx, fp)['refresh_on']:
+                index.setdefault(source, []).append(_component_name(fp))
+        bndl['refresh_on'] = index
+    return bndl['refresh_on']
+
+def _file_info(idx, fp):
+    """
+    Returns the attributes of the component in `fp` recorded in the
+    manifest, the module is imported if they are not recorded.
+    """
+    bndl = __bundles[idx]
+    entry = _get_manifest().get(os.path.abspath(bndl['base']))
+    mtime = _mtime(fp)
+    info = entry['files'].get(fp) if entry is not None else None
+    if info is not None and info['mtime'] == mtime:
+        return info
+    name = _component_name(fp)
+    _load(name)
+    cls = bndl['nodes'].get(name) or bndl['crawlers'].get(name)
+    info = {'mtime': mtime, 'refresh_on': list(getattr(cls, 'refresh_on', {}))}
+    if entry is not None:
+        entry['files'][fp] = info
+        _set_manifest_dirty()
+    return info
+
+def _set_manifest_dirty():
+    global __manifest_dirty
+    __manifest_dirty = True
+
+def _component_name(fp):
+    return os.path.splitext(os.path.basename(fp))[0]
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _manifest_path():
+    if not is_configured():
+        return None
+    return os.path.join(get_config('root_dir'), MANIFEST_NAME)
+
+def _get_manifest():
+    global __manifest
+    if __manifest is None:
+        path = _manifest_path()
+        if path is None: # not cached until configured
+            return {}
+        __manifest = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    __manifest = json.load(f)
+            except ValueError: # corrupted, it will be rebuilt
+                pass
+    return __manifest
+
+def _save_manifest():
+    global __manifest_dirty
+    __manifest_dirty = False
+    path = _manifest_path()
+    if path is None or __manifest is None:
+        return
+    for base in [base for base in __manifest if not os.path.isdir(base)]:
+        del __manifest[base]
+    # Replace the file atomically, other processes may be reading it
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(__manifest, f)
+    os.replace(tmp_path, path)
+
+def get_bundle_paths():
+    """
+    :returns: The paths of the bundles loaded by `bundle`, so that other
+        processes can load the same bundles.
+    """
+    return [os.path.abspath(bndl['base'])
+            for bndl in __bundles if bndl['base'] is not None]
 
 def register(subject, bundle=0, allow_overwrite=False):
     """
@@ -110,8 +256,10 @@ def register(subject, bundle=0, allow_overwrite=False):
 
     from .node import Node
     from .crawler import Crawler
+    from .identifier import _reset as forget_identifiers
     if issubclass(cls, Node):
         subtype = 'nodes'
+        cls._compile_args()
     elif issubclass(cls, Crawler):
         subtype = 'crawlers'
     else:
@@ -119,11 +267,14 @@ def register(subject, bundle=0, allow_overwrite=False):
 
     assert allow_overwrite or name not in __bundles[bundle][subtype]
     __bundles[bundle][subtype][name] = cls
+    forget_identifiers()
 
 def _get(name, what, xcpt=True):
     for bndl in __bundles:
         if name in bndl[what]:
             return bndl[what][name]()
+    if _load(name):
+        return _get(name, what, xcpt)
     if xcpt:
         raise ExceptionWithInfo(
                 f'Cannot find {name} in bundles for type {what}.', __bundles)
@@ -135,4 +286,35 @@ def get_node(name):
 def get_crawler(name):
     return _get(name, what='crawlers')
 
+def has_component(name):
+    """Returns True if a node/crawler of `name` is registered."""
+    return any(name in bndl['nodes'] or name in bndl['crawlers']
+            or name in _lazy(bndl) for bndl in __bundles)
+
+def get_nodes(refresh_on=None):
+    """
+    Returns the registered nodes, their modules will be imported.
+
+    :param refresh_on: (Optional) Only returns the nodes with this node name
+        in their `refresh_on` (see `stocklab.node.MaterializedView`).  Only
+        the modules of these nodes will be imported if the manifest is
+        valid.
+    :type refresh_on: str
+    """
+    with __lock:
+        for idx, bndl in enumerate(__bundles):
+            if refresh_on is None:
+                names = list(_lazy(bndl))
+            else:
+                names = _refresh_on(idx).get(refresh_on, [])
+            for name in names:
+                if name in _lazy(bndl):
+                    _load(name)
+        if __manifest_dirty:
+            _save_manifest()
+    names = dict.fromkeys(name for bndl in __bundles
+            for name, cls in bndl['nodes'].items()
+            if refresh_on is None or refresh_on in getattr(cls, 'refresh_on', {}))
+    return [get_node(name) for name in names]
+
 _reset()
@@ -0,0 +1,285 @@
+""" This module holds the in-memory cache of evaluated DataIdentifiers.  The
+    cache backend is pluggable, see `set_backend`.  By default, a `LRUCache`
+    is created from the `cache` configuration on its first use.  Processes
+    can share the evaluated results with `SharedCache`.
+"""
+import sys
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from .config import is_configured, get_config
+
+__backend = None
+__evict_listeners = []
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    global __backend
+    __backend = None
+
+def get_backend():
+    """
+    Returns the cache backend, a `LRUCache` will be created according to the
+    `cache` configuration if no backend was set.
+    """
+    global __backend
+    if __backend is None:
+        cfg = get_config('cache') if is_configured() else None
+        __backend = LRUCache(**(cfg or {}))
+    return __backend
+
+def on_evict(listener):
+    """
+    Register `listener`, it is called with the key of each entry evicted
+    from a `LRUCache`.
+    """
+    __evict_listeners.append(listener)
+
+def _notify_evicted(key):
+    for listener in __evict_listeners:
+        listener(key)
+
+def set_backend(backend):
+    """
+    Replace the cache backend.
+
+    :param backend: An object implements the interface of `CacheBackend`.
+    :type backend: CacheBackend
+    """
+    global __backend
+    __backend = backend
+
+class CacheBackend:
+    """
+    The interface of cache backends.  Note that `None` is not a valid value
+    to be cached, it is returned by `get` on cache misses.
+    """
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, val):
+        raise NotImplementedError()
+
+    def discard(self, key):
+        raise NotImplementedError()
+
+    def flush(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        :returns: A `dict` of counters, including `hits`, `misses`,
+            `evictions`, `entries` and `bytes`.
+        """
+        raise NotImplementedError()
+
+def _node_name(key):
+    return key.split('.', 1)[0]
+
+class LRUCache(CacheBackend):
+    """
+    A thread-safe cache with least-recently-used eviction.  All limits are
+    optional, the cache grows without limit if none of them is set.
+
+    :param max_entries: Maximum number of cached entries.
+    :type max_entries: int
+    :param max_bytes: Maximum estimated size (see `sizeof`) of cached
+        entries.
+    :type max_bytes: int
+    :param ttl: Time-to-live of an entry in seconds.
+    :type ttl: float
+    :param node_limits: Maximum number of entries per node, e.g.
+        `{'Price': 10000}`.
+    :type node_limits: dict
+    :param sizeof: The function to estimate the size of a cached value,
+        defaults to `sys.getsizeof`.
+    :type sizeof: callable
+    """
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+            node_limits=None, sizeof=sys.getsizeof):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.node_limits = node_limits or {}
+        self.sizeof = sizeof
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self.flush()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            val, _, expire = entry
+            if expire is not None and expire < time.monotonic():
+                self._evict(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            node_keys = self._node_keys.get(_node_name(key))
+            if node_keys is not None:
+                node_keys.move_to_end(key)
+            self._hits += 1
+            return val
+
+    def set(self, key, val):
+        size = self.sizeof(key) + self.sizeof(val)
+        expire = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (val, size, expire)
+            self._bytes += size
+            name = _node_name(key)
+            if name in self.node_limits:
+                node_keys = self._node_keys.setdefault(name, OrderedDict())
+                node_keys[key] = None
+                while len(node_keys) > self.node_limits[name]:
+                    self._evict(next(iter(node_keys)))
+            while self._entries and (
+                    (self.max_entries and len(self._entries) > self.max_entries)
+                    or (self.max_bytes and self._bytes > self.max_bytes)):
+                self._evict(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def flush(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._node_keys = {}
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    }
+
+    def _evict(self, key):
+        self._remove(key)
+        self._evictions += 1
+        _notify_evicted(key)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        node_keys = self._node_keys.get(_node_name(key))
+        if node_keys is not None:
+            node_keys.pop(key, None)
+
+class SharedCache(CacheBackend):
+    """
+    A cache shared by processes (e.g. the workers of
+    `stocklab.core.executor.Executor`) through a SQLite file.  Values are
+    pickled, and the entries are also kept in a `local` backend to avoid
+    reading the file for the hot entries.  The entries set are written to
+    the file in batches, by `commit` or once `batch_size` entries are
+    pending, other processes do not see them before.
+
+    :param path: Path to the SQLite file.
+    :type path: str
+    :param local: (Optional) The in-process backend, defaults to an
+        unlimited `LRUCache`.
+    :type local: CacheBackend
+    :param batch_size: The number of pending entries written at once.
+    :type batch_size: int
+    """
+    def __init__(self, path, local=None, batch_size=1000):
+        super().__init__()
+        self.path = path
+        self.local = local if local is not None else LRUCache()
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = {} # key -> pickled value, not written yet
+        self._hits = 0
+        self._misses = 0
+        self._conn = sqlite3.connect(path, timeout=30,
+                isolation_level=None, check_same_thread=False)
+        # This is a cache, durability is not required
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+
+    def get(self, key):
+        val = self.local.get(key)
+        if val is not None:
+            return val
+        with self._lock:
+            blob = self._pending.get(key) # evicted from `local`
+            if blob is not None:
+                return pickle.loads(blob)
+            row = self._conn.execute('SELECT value FROM entries WHERE key = ?',
+                    (key,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        val = pickle.loads(row[0])
+        self.local.set(key, val)
+        return val
+
+    def set(self, key, val):
+        self.local.set(key, val)
+        blob = pickle.dumps(val, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pending[key] = blob
+            if len(self._pending) >= self.batch_size:
+                self._commit()
+
+    def commit(self):
+        """Write the pending entries to the file."""
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        with self._conn:
+            self._conn.execute('BEGIN') # in one transaction
+            self._conn.executemany('INSERT OR REPLACE INTO entries '
+                    '(key, value) VALUES (?, ?)', pending.items())
+
+    def discard(self, key):
+        self.local.discard(key)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def flush(self):
+        self.local.flush()
+        with self._lock:
+            self._pending = {}
+            self._conn.execute('DELETE FROM entries')
+
+    def stats(self):
+        """Same as `CacheBackend.stats`, plus the counters of the file."""
+        stats = self.local.stats()
+        with self._lock:
+            stats['shared_hits'] = self._hits
+            stats['shared_misses'] = self._misses
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
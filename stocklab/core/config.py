@@ -1,14 +1,23 @@
 import os
 
 __config = None
+__source = None
 
 def _reset():
     """
     This is only used for testing.  To get a fresh session, we should
     reset `config`, `bundle` and `logger` modules by calling their `reset()`.
     """
-    global __config
+    global __config, __source
     __config = None
+    __source = None
+
+def get_source():
+    """
+    :returns: The path to the configuration file passed to `configure`, so
+        that other processes can be configured identically.
+    """
+    return __source
 
 def is_configured():
     return __config is not None
@@ -30,7 +39,7 @@ def configure(config):
     :raises NotImplementedError: Currently, only configuration by file
         is implemented.
     """
-    global __config
+    global __config, __source
     assert not is_configured()
 
     if os.path.isfile(config):
@@ -43,6 +52,7 @@ def configure(config):
         __config = load(yml_file.read(), Loader=Loader)
         yml_file.close()
         relative_path_base = os.path.dirname(os.path.realpath(config))
+        __source = os.path.realpath(config)
     else:
         assert type(config) is not str, f'File {config} cannot be opened.'
         relative_path_base = os.getcwd()
@@ -54,6 +64,6 @@ def configure(config):
                 relative_path_base, __config['root_dir'])
     __config['root_dir'] = os.path.normpath(__config['root_dir'])
 
-    import logging
     from . import logger
-    logger.get_instance().setLevel(getattr(logging, __config['log_level']))
+    logger.get_instance()
+    logger.apply_config()
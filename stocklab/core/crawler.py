@@ -16,6 +16,97 @@ class CrawlerTrigger(Exception):
         super().__init__()
         self.kwargs = kwargs
 
+    def key(self):
+        """Returns the canonical string of `kwargs`."""
+        return repr(sorted(self.kwargs.items()))
+
     def __str__(self):
         # TODO: Expose more information?
         return f'CrawlerTrigger {self.kwargs}'
+
+class Contiguous:
+    """
+    A trigger merging rule (see `merge_triggers`).  Integer values next to
+    each other are merged into a `range`.
+
+    :param max_len: The maximum length of a merged `range`, defaults to None
+        (unlimited).
+    :type max_len: int
+    """
+    def __init__(self, max_len=None):
+        super().__init__()
+        self.max_len = max_len
+
+    def merge(self, values):
+        merged = []
+        for val in sorted(set(values)):
+            if merged and merged[-1][1] == val - 1 and (self.max_len is None
+                    or val - merged[-1][0] < self.max_len):
+                merged[-1][1] = val
+            else:
+                merged.append([val, val])
+        return [range(lo, hi + 1) for lo, hi in merged]
+
+class Collect:
+    """
+    A trigger merging rule (see `merge_triggers`).  Values are merged into a
+    `list`.
+
+    :param max_len: The maximum length of a merged `list`, defaults to None
+        (unlimited).
+    :type max_len: int
+    """
+    def __init__(self, max_len=None):
+        super().__init__()
+        self.max_len = max_len
+
+    def merge(self, values):
+        values = list(dict.fromkeys(values))
+        step = self.max_len or len(values)
+        return [values[i:i + step] for i in range(0, len(values), step)]
+
+def _hashable(val):
+    return tuple(val) if type(val) is list else val
+
+def get_merging_rules(crawler_entry):
+    """
+    :returns: The merging rules declared for `crawler_entry` (see
+        `stocklab.crawler.coalesce`), or None if not declared.
+    """
+    while crawler_entry is not None:
+        if hasattr(crawler_entry, 'coalesce'):
+            return crawler_entry.coalesce
+        crawler_entry = getattr(crawler_entry, '__wrapped__', None)
+    return None
+
+def merge_triggers(triggers, rules):
+    """
+    Merge `CrawlerTrigger`s into fewer ones.  Rules are applied field by
+    field in the given order.  Triggers are merged on a field only if all
+    other fields are equal.
+
+    :param triggers: The triggers to be merged.
+    :type triggers: list of CrawlerTrigger
+    :param rules: Mapping from field names to merging rules (e.g.
+        `Contiguous`, `Collect`).
+    :type rules: dict
+    :returns: list of CrawlerTrigger
+    """
+    kwargs_list = list({
+        tuple(sorted(t.kwargs.items())): t.kwargs for t in triggers
+        }.values())
+    for field, rule in rules.items():
+        groups = {}
+        merged_list = []
+        for kwargs in kwargs_list:
+            if field not in kwargs:
+                merged_list.append(kwargs)
+                continue
+            others = tuple(sorted((k, _hashable(v))
+                for k, v in kwargs.items() if k != field))
+            groups.setdefault(others, (kwargs, []))[1].append(kwargs[field])
+        for kwargs, values in groups.values():
+            for merged in rule.merge(values):
+                merged_list.append({**kwargs, field: merged})
+        kwargs_list = merged_list
+    return [CrawlerTrigger(**kwargs) for kwargs in kwargs_list]
@@ -0,0 +1,127 @@
+""" This module records the dependencies between DataIdentifiers observed
+    during the evaluation, so the cached results can be invalidated
+    selectively.  When a DataIdentifier is requested while another one is
+    being evaluated, an edge from the requested one to the requesting one is
+    recorded.  `invalidate` removes the given DataIdentifiers and all of
+    their transitive dependents from the cache (and the persisted results,
+    see `Node.persist`), e.g. after `get_db.update` overwrites records.
+
+    The edges are kept in memory of the current process, the edges of a
+    DataIdentifier are dropped when it is evicted from the cache.  The
+    persisted results (see `stocklab.core.persist`) are stored with the
+    DataIdentifiers they were evaluated from, so they are also invalidated
+    in the later processes.  Edges observed by the workers of a process pool
+    (see `stocklab.core.executor`) are not recorded.
+"""
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from . import cache
+from . import persist
+
+__dependents = {} # path -> set of the paths requested it
+__requires = {} # path -> set of the paths it requested
+__lock = threading.Lock()
+__evaluating = contextvars.ContextVar('evaluating', default=None)
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    with __lock:
+        __dependents.clear()
+        __requires.clear()
+
+def record(path):
+    """Record that `path` is requested by the DataIdentifier being evaluated."""
+    parent = __evaluating.get()
+    if parent is None:
+        return
+    with __lock:
+        __dependents.setdefault(path, set()).add(parent)
+        __requires.setdefault(parent, set()).add(path)
+
+@contextmanager
+def evaluating(path):
+    """The DataIdentifiers requested within this context depend on `path`."""
+    token = __evaluating.set(path)
+    try:
+        yield
+    finally:
+        __evaluating.reset(token)
+
+def dependents(paths):
+    """
+    :returns: The set of `paths` and the DataIdentifiers depending on them,
+        directly or transitively.
+    """
+    found = set()
+    pending = list(paths)
+    with __lock:
+        while pending:
+            path = pending.pop()
+            if path in found:
+                continue
+            found.add(path)
+            pending.extend(__dependents.get(path, ()))
+    return found
+
+def inputs(path):
+    """
+    :returns: The set of the DataIdentifiers `path` requested, directly or
+        transitively.
+    """
+    found = set()
+    pending = [path]
+    with __lock:
+        while pending:
+            for child in __requires.get(pending.pop(), ()):
+                if child not in found:
+                    found.add(child)
+                    pending.append(child)
+    return found
+
+def invalidate(paths):
+    """
+    Remove `paths` and their dependents from the cache, the dependents will
+    be evaluated again on the next request.
+
+    :returns: The number of the DataIdentifiers invalidated.
+    """
+    found = set()
+    pending = set(paths)
+    while pending: # the persisted results may have dependents in memory
+        found |= dependents(pending)
+        pending = persist.dependents(found) - found
+    backend = cache.get_backend()
+    with __lock:
+        for path in found:
+            __dependents.pop(path, None) # recorded again on evaluation
+            _unlink(path)
+    for path in found:
+        backend.discard(path)
+        persist.discard(path)
+    return len(found)
+
+def prune(path):
+    """Drop the edges of the DataIdentifiers requested by `path`."""
+    with __lock:
+        _unlink(path)
+
+def _unlink(path):
+    for child in __requires.pop(path, ()):
+        parents = __dependents.get(child)
+        if parents is not None:
+            parents.discard(path)
+            if not parents:
+                del __dependents[child]
+
+cache.on_evict(prune) # an evicted result is evaluated again when requested
+
+def forget():
+    """Drop all of the edges, e.g. when the whole cache is flushed."""
+    with __lock:
+        __dependents.clear()
+        __requires.clear()
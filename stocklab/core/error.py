@@ -14,6 +14,10 @@ class NoLongerAvailable(Exception):
     """
     pass
 
+class ReadOnlyError(ExceptionWithInfo):
+    """Writing to a database opened with the `read_only` option."""
+    pass
+
 class ParserError(ExceptionWithInfo):
     """Indicating there's something wrong during the data parsing."""
     pass
@@ -0,0 +1,317 @@
+""" This module provides `Executor`, which evaluates DataIdentifiers on a pool
+    of threads or processes.
+
+    Instead of recursing into the dependencies, the DataIdentifiers are
+    resolved as tasks.  A task requesting unresolved DataIdentifiers stops
+    with `PendingDependency`, the requested DataIdentifiers are then scheduled
+    as new tasks, and the stopped task is run again after they are resolved.
+    Therefore independent branches are evaluated concurrently, and a deep
+    chain of nodes does not hit the recursion limit.
+
+    A task requesting its dependencies one after another (e.g. in a loop
+    depending on the previous values) would be run again for each of them.
+    After being stopped `_MAX_ROUNDS` times, a task is run inline instead:
+    its remaining dependencies are resolved recursively by the worker, so the
+    evaluation of a node is repeated a bounded number of times.
+
+    The workers of the `process` pool share the evaluated results through a
+    `stocklab.core.cache.SharedCache`, so a DataIdentifier resolved by one
+    worker is a cache hit for the others.
+"""
+import os
+import sys
+import math
+import contextvars
+import multiprocessing
+import concurrent.futures as futures
+
+from . import bundle
+from . import cache
+from .config import get_source, is_configured, get_config
+from .error import ExceptionWithInfo
+from .node import PendingDependency, task_scope, batch_scope
+from .node import get_cache, set_cache
+
+_MAX_ROUNDS = 2 # stops by `PendingDependency` before a task runs inline
+
+def _init_worker(config_source, bundle_paths, shared_cache):
+    # The main module of the worker may have done some of these
+    import stocklab
+    loaded = bundle.get_bundle_paths()
+    for path in bundle_paths:
+        if path not in loaded:
+            stocklab.bundle(path)
+    if not is_configured():
+        stocklab.configure(config_source)
+    if shared_cache is not None:
+        cache.set_backend(cache.SharedCache(shared_cache,
+            local=cache.LRUCache(**(get_config('cache') or {}))))
+
+def _run_task(node_name, fields_list, known, inline=False):
+    """
+    Resolve DataIdentifiers of a node.
+
+    :param inline: Resolve the unresolved dependencies recursively instead
+        of stopping with `PendingDependency`.
+    :type inline: bool
+    :returns: A tuple `(resolved, pending)`.  `resolved` maps paths to the
+        evaluated values, `pending` maps paths to the dependencies (see
+        `PendingDependency.deps`) required to resolve them.
+    """
+    node = bundle.get_node(node_name)
+    paths = [node.path(**fields) for fields in fields_list]
+    resolved = {}
+    pending = {}
+    if inline:
+        with batch_scope() as memo:
+            memo.update(known)
+            return dict(zip(paths, node.batch(fields_list))), pending
+    with task_scope(set(paths), known):
+        try:
+            return dict(zip(paths, node.batch(fields_list))), pending
+        except PendingDependency as p:
+            if len(paths) == 1:
+                return resolved, {paths[0]: p.deps}
+        # Find out the dependencies of each DataIdentifier, the resolved ones
+        # are available from the cache or the memo of the task
+        for path, fields in zip(paths, fields_list):
+            try:
+                resolved[path] = node.batch([fields])[0]
+            except PendingDependency as p:
+                pending[path] = p.deps
+    return resolved, pending
+
+def _run_in_process(*args):
+    """
+    Run `_run_task` in a worker process, the results are written to the
+    `SharedCache` once the task is done.
+    """
+    try:
+        return _run_task(*args)
+    finally:
+        backend = cache.get_backend()
+        if isinstance(backend, cache.SharedCache):
+            backend.commit()
+
+def _run_in_thread(*args):
+    """Run `_run_task` in a worker thread, its database sessions are closed."""
+    try:
+        return _run_task(*args)
+    finally:
+        _close_sessions()
+
+class Executor:
+    """
+    Evaluates DataIdentifiers on a pool of workers.  The nodes requested by a
+    task are resolved by the workers, so they must be registered in every
+    worker.  For the `process` pool, the workers load the bundles (see
+    `stocklab.bundle`) and the configuration file of the current process,
+    nodes registered otherwise are not available.
+
+    The pool is shut down after each evaluation, unless the executor is used
+    as a context manager, in which case the `thread` pool is kept for the
+    evaluations within the context::
+
+        with Executor(max_workers=4) as executor:
+            stocklab.eval_many(di_strs, executor=executor)
+
+    The database sessions (see `stocklab.db.get_db`) opened by a task in a
+    worker thread are closed when the task is done.
+
+    :param pool: `thread` or `process`, defaults to `thread`.
+    :type pool: str
+    :param max_workers: The number of workers, defaults to the number of
+        processors.
+    :type max_workers: int
+    :param shared_cache: Share the results among the workers of the
+        `process` pool, defaults to True.
+    :type shared_cache: bool
+    """
+    def __init__(self, pool='thread', max_workers=None, shared_cache=True):
+        assert pool in ['thread', 'process'], f'Unknown pool type: {pool}'
+        super().__init__()
+        self.pool = pool
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.shared_cache = shared_cache
+        self._threads = None # the `thread` pool, kept within the context
+        self._entered = False
+
+    def __enter__(self):
+        self._entered = True
+        return self
+
+    def __exit__(self, *exc):
+        self._entered = False
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop the workers of the `thread` pool.  The pool is created again by
+        the next `evaluate`.
+        """
+        pool, self._threads = self._threads, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def evaluate(self, requests):
+        """
+        :param requests: The DataIdentifiers, each as a tuple of the node
+            name and the fields.
+        :type requests: list of tuple
+        :returns: The evaluated results, in the same order as `requests`.
+        """
+        specs = {}
+        roots = []
+        for node_name, fields in requests:
+            node = bundle.get_node(node_name)
+            fields = node.type_normalization(dict(fields))
+            path = node.path(**fields)
+            specs[path] = (node_name, fields)
+            roots.append(path)
+        shared_cache = None
+        if self.pool == 'process' and self.shared_cache:
+            shared_cache = os.path.join(get_config('root_dir'),
+                    f'shared_cache.{os.getpid()}.{id(self)}.sqlite')
+        pool = self._create_pool(shared_cache)
+        schedule = _Schedule(self, pool, specs)
+        try:
+            values = schedule.run(dict.fromkeys(roots))
+        except BaseException:
+            for future in schedule.running:
+                future.cancel()
+            if self.pool == 'thread':
+                futures.wait(schedule.running)
+            else:
+                pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            if self.pool == 'process':
+                pool.shutdown(wait=True)
+            elif not self._entered:
+                self.shutdown()
+            if shared_cache is not None:
+                _remove_sqlite(shared_cache)
+        return [values[path] for path in roots]
+
+    def _create_pool(self, shared_cache):
+        if self.pool == 'thread':
+            if self._threads is None:
+                self._threads = futures.ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+            return self._threads
+        # Forked workers would share the database connections with the
+        # current process, spawn fresh ones instead
+        return futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(get_source(), bundle.get_bundle_paths(),
+                    shared_cache))
+
+def _close_sessions():
+    """Close the database sessions of the current thread, if any."""
+    db = sys.modules.get('stocklab.db') # avoid importing pyDAL
+    # Being imported by another thread, no session was opened by this one
+    if db is not None and hasattr(db, 'close_db'):
+        db.close_db()
+
+def _remove_sqlite(path):
+    for suffix in ['', '-wal', '-shm']:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+class _Schedule:
+    """The states of the tasks of an `Executor.evaluate` call."""
+    def __init__(self, executor, pool, specs):
+        super().__init__()
+        self.executor = executor
+        self.pool = pool
+        self.specs = specs # path -> (node name, fields)
+        self.values = {} # path -> value
+        self.deps = {} # path -> all dependencies discovered
+        self.waiting = {} # path -> unresolved dependencies
+        self.parents = {} # path -> paths waiting for it
+        self.rounds = {} # path -> times stopped by `PendingDependency`
+        self.scheduled = set()
+        self.running = {} # future -> paths
+
+    def run(self, roots):
+        ready = []
+        for path in roots:
+            val = get_cache(path)
+            if val is None:
+                ready.append(path)
+            else:
+                self.values[path] = val
+        self.scheduled.update(ready)
+        self._submit(ready)
+        while self.running:
+            done, _ = futures.wait(self.running,
+                    return_when=futures.FIRST_COMPLETED)
+            ready = []
+            for future in done:
+                self.running.pop(future)
+                resolved, pending = future.result()
+                for path, val in resolved.items():
+                    ready += self._on_resolved(path, val)
+                for path, deps in pending.items():
+                    ready += self._on_pending(path, deps)
+            self._submit(ready)
+        if self.waiting:
+            raise ExceptionWithInfo('Circular dependency detected.',
+                    list(self.waiting))
+        return self.values
+
+    def _on_resolved(self, path, val):
+        self.values[path] = val
+        set_cache(path, val)
+        ready = []
+        for parent in self.parents.pop(path, ()):
+            self.waiting[parent].discard(path)
+            if not self.waiting[parent]:
+                del self.waiting[parent]
+                ready.append(parent)
+        return ready
+
+    def _on_pending(self, path, deps):
+        ready = []
+        unresolved = set()
+        self.rounds[path] = self.rounds.get(path, 0) + 1
+        for node_name, dep, fields in deps:
+            self.deps.setdefault(path, set()).add(dep)
+            self.specs.setdefault(dep, (node_name, fields))
+            if dep in self.values:
+                continue
+            unresolved.add(dep)
+            self.parents.setdefault(dep, set()).add(path)
+            if dep not in self.scheduled:
+                self.scheduled.add(dep)
+                ready.append(dep)
+        if unresolved:
+            self.waiting[path] = unresolved
+        else: # resolved by other tasks in the meantime
+            ready.append(path)
+        return ready
+
+    def _submit(self, paths):
+        groups = {}
+        for path in paths:
+            inline = self.rounds.get(path, 0) >= _MAX_ROUNDS
+            groups.setdefault((self.specs[path][0], inline), []).append(path)
+        for (node_name, inline), group in groups.items():
+            # Tasks of the same node are split among the workers, a task of
+            # a `DataNode` retrieves its missing data with merged crawls
+            size = math.ceil(len(group) / self.executor.max_workers)
+            for i in range(0, len(group), size):
+                chunk = group[i:i + size]
+                known = {dep: self.values[dep]
+                        for path in chunk for dep in self.deps.get(path, ())}
+                args = (node_name, [self.specs[path][1] for path in chunk],
+                        known, inline)
+                if self.executor.pool == 'process':
+                    future = self.pool.submit(_run_in_process, *args)
+                else: # e.g. the spans of `trace` are nested in the caller's
+                    ctx = contextvars.copy_context()
+                    future = self.pool.submit(ctx.run, _run_in_thread, *args)
+                self.running[future] = chunk
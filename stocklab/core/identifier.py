@@ -0,0 +1,130 @@
+""" This module provides `DataIdentifier`, the parsed form of DataIdentifier
+    strings.  Parsing resolves the node and normalizes the fields once, so a
+    `DataIdentifier` kept by the caller can be evaluated repeatedly without
+    parsing, looking up bundles or building the cache key again.
+
+    Parsed DataIdentifiers are interned, a string is parsed only once unless
+    more than `_MAX_INTERNED` strings were parsed after it.  The interned
+    DataIdentifiers are forgotten when a node is registered.
+"""
+from . import bundle
+
+_MAX_INTERNED = 65536
+
+__interned = {}
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    __interned.clear()
+
+def _interned(key):
+    return __interned.get(key)
+
+def _intern(key, di):
+    if len(__interned) >= _MAX_INTERNED:
+        # Drop the oldest item, as `re` does for compiled patterns
+        try:
+            del __interned[next(iter(__interned))]
+        except (StopIteration, RuntimeError, KeyError):
+            pass
+    __interned[key] = di
+    return di
+
+class DataIdentifier(str):
+    """
+    A parsed DataIdentifier.  Its string value is the canonical form (fields
+    sorted and normalized, see `Node.path`), which is also the cache key, so
+    it can be used wherever the path string is used.  Use it like::
+
+        di = DataIdentifier('Price.stock:acme.date_idx:1000')
+        di() # evaluate
+        price = DataIdentifier('Price') # fields can be given later
+        price(stock='acme', date_idx=1000)
+        price.batch([{'stock': 'acme', 'date_idx': d} for d in dates])
+
+    :param di_str: The DataIdentifier string, the trailing fields can be
+        omitted.
+    :type di_str: str
+
+    As `DataIdentifier` used to be an alias of `get_node`, the attributes
+    other than the ones of `str` are looked up on the node, e.g.
+    ``DataIdentifier('Price').schema``.
+
+    Attributes:
+
+    *  node: The node object.
+    *  fields: The normalized fields, which should not be modified.
+    """
+    def __new__(cls, di_str):
+        if isinstance(di_str, DataIdentifier):
+            return di_str
+        di = _interned(di_str)
+        if di is not None:
+            return di
+        names = di_str.split('.')
+        fields = dict(field.split(':') for field in names[1:])
+        return _intern(di_str, cls.of(bundle.get_node(names[0]), fields))
+
+    @classmethod
+    def of(cls, node, fields, partial=True):
+        """
+        Create the DataIdentifier of `node` with `fields`.
+
+        :param node: The node object.
+        :type node: Node
+        :param fields: The fields, the values will be normalized.
+        :type fields: dict
+        :param partial: Allow fields to be omitted, defaults to True.
+        :type partial: bool
+        """
+        fields = node.type_normalization(dict(fields), partial=partial)
+        path = node.path(**fields)
+        di = _interned(path)
+        if di is not None and di.node is node:
+            return di
+        di = str.__new__(cls, path)
+        di.node = node
+        di.fields = fields
+        di.complete = len(fields) == len(node.args)
+        return _intern(path, di)
+
+    def __getattr__(self, name):
+        if name == 'node' or name.startswith('__'): # not parsed yet
+            raise AttributeError(name)
+        return getattr(self.node, name)
+
+    def __reduce__(self):
+        # Parse again on unpickling, as the node object is not picklable
+        return (DataIdentifier, (str(self),))
+
+    def __call__(self, **fields):
+        """
+        Evaluate the DataIdentifier, the omitted fields are given by
+        `fields`.
+        """
+        if not fields:
+            return self.node(self)
+        if not self.fields:
+            return self.node(**fields)
+        return self.node(**self.fields, **fields)
+
+    async def acall(self, **fields):
+        """The asynchronous version of `__call__`, see `Node.acall`."""
+        if not fields:
+            return await self.node.acall(self)
+        if not self.fields:
+            return await self.node.acall(**fields)
+        return await self.node.acall(**self.fields, **fields)
+
+    def batch(self, fields_list):
+        """
+        Evaluate the DataIdentifiers completed by each of `fields_list`, see
+        `Node.batch`.
+        """
+        if not self.fields:
+            return self.node.batch(fields_list)
+        return self.node.batch([{**self.fields, **fields}
+            for fields in fields_list])
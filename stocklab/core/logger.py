@@ -1,9 +1,32 @@
+""" This module sets up the loggers of stocklab.  Records are put in a queue
+    by the logging thread, a background thread (`QueueListener`) writes them
+    to stderr, so logging does not block on the stream.
+
+    Log with the %-style arguments, e.g. ``logger.debug('Crawled %s', path)``,
+    instead of f-strings, so the messages filtered out by the log level are
+    never formatted.  The messages (and the tracebacks) of the records passing
+    the level are formatted by the logging thread before being queued.
+
+    The output is human-readable text by default, or JSON lines (one object
+    per record) if `log_format` is set to `json` in the configuration.
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
 
 from .config import is_configured, get_config
 
 __global_logger = None
 __loggers = {}
+__queue = None
+__listener = None
+__lock = threading.Lock()
 
 def _reset():
     """
@@ -11,19 +34,106 @@ def _reset():
     reset `config`, `bundle` and `logger` modules by calling their `reset()`.
     """
     global __global_logger, __loggers
+    _stop()
     __global_logger = None
     __loggers = {}
 
+class _TextFormatter(logging.Formatter):
+    def formatMessage(self, record):
+        if record.name == 'stocklab':
+            return f'[{record.levelname}] {record.message}'
+        return f'[{record.levelname}] ({record.name}) : {record.message}'
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+                'time': record.created,
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'thread': record.threadName,
+                }
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike `QueueHandler`, the formatter is left to the listener, only
+        # the message and the traceback are formatted here
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+def _formatter():
+    log_format = get_config('log_format') if is_configured() else None
+    if log_format == 'json':
+        return _JsonFormatter()
+    assert log_format in [None, 'text'], f'Unknown log_format: {log_format}'
+    return _TextFormatter()
+
+def _start():
+    """Returns the queue of the listener, it is started on the first call."""
+    global __queue, __listener
+    with __lock:
+        if __listener is None:
+            __queue = queue.SimpleQueue()
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(_formatter())
+            __listener = logging.handlers.QueueListener(__queue, handler)
+            __listener.start()
+            atexit.register(_stop)
+        return __queue
+
+def _stop():
+    """Write the queued records and stop the listener."""
+    global __listener
+    with __lock:
+        listener, __listener = __listener, None
+    if listener is not None:
+        listener.stop()
+        atexit.unregister(_stop)
+
+def _after_fork():
+    # The listener thread does not exist in the child process
+    global __listener, __lock
+    __listener = None
+    __lock = threading.Lock()
+    q = _start()
+    for logger in [__global_logger] + list(__loggers.values()):
+        for handler in getattr(logger, 'handlers', []):
+            if isinstance(handler, _QueueHandler):
+                handler.queue = q
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def apply_config():
+    """
+    Apply `log_level` and `log_format` of the configuration, it is called
+    by `configure`.
+    """
+    _stop() # restarted with the configured format
+    q = _start()
+    for logger in [__global_logger] + list(__loggers.values()):
+        if logger is None:
+            continue
+        logger.setLevel(getattr(logging, get_config('log_level')))
+        for handler in logger.handlers:
+            if isinstance(handler, _QueueHandler):
+                handler.queue = q
+
 def _create(name, level):
     logger = logging.getLogger(name)
-    log_handler = logging.StreamHandler()
-    if name == 'stocklab':
-        fmt = f"[%(levelname)s] %(message)s"
-    else:
-        fmt = f"[%(levelname)s] ({name}) : %(message)s"
-    log_format = logging.Formatter(fmt)
-    log_handler.setFormatter(log_format)
-    logger.addHandler(log_handler)
+    for handler in list(logger.handlers): # created before `_reset`
+        if isinstance(handler, _QueueHandler):
+            logger.removeHandler(handler)
+    logger.addHandler(_QueueHandler(_start()))
     logger.setLevel(getattr(logging, level))
     return logger
 
@@ -32,7 +142,7 @@ def get_instance(name=None):
     Returns the logger if it exists, otherwise setup a logger with stocklab
     logging format.  Since the configuration specifies the log level,
     stocklab must be configured before getting a logger.
-    
+
     :param name: The name of the logger, defaults to None.
     :type name: str
     :returns: logging.Logger
@@ -1,32 +1,157 @@
+import asyncio
+import weakref
+import threading
+from contextlib import contextmanager
+
 from . import StocklabObject
+from . import aio
+from . import cache
+from . import deps
+from . import persist
+from . import trace
 from .config import get_config
 from .runtime import Surrogate
 from .crawler import CrawlerTrigger
 
-__cache = {}
-
 def set_cache(key, val):
-    global __cache
-    __cache[key] = val
+    cache.get_backend().set(key, val)
 
 def get_cache(key):
-    global __cache
-    if key not in __cache:
-        return None
-    return __cache[key]
+    """Returns the cached value of `key`, or None if not cached."""
+    return cache.get_backend().get(key)
 
 def flush_cache():
-    global __cache
-    __cache = {}
+    cache.get_backend().flush()
+    deps.forget()
+
+def cache_stats():
+    """Returns the counters (hits, misses, etc.) of the cache backend."""
+    return cache.get_backend().stats()
+
+__batch = threading.local()
+
+@contextmanager
+def batch_scope():
+    """
+    Within this context, each distinct DataIdentifier is resolved at most once
+    regardless of the state of the cache.  Nested scopes share the same memo.
+    """
+    if getattr(__batch, 'memo', None) is not None:
+        yield __batch.memo
+        return
+    __batch.memo = {}
+    try:
+        yield __batch.memo
+    finally:
+        __batch.memo = None
+
+def _batch_memo():
+    return getattr(__batch, 'memo', None)
+
+_inflight = weakref.WeakKeyDictionary() # event loop -> {path: future}
+
+__task = threading.local()
+
+class PendingDependency(Exception):
+    """
+    Raised during an executor task (see `stocklab.core.executor`) when the
+    evaluation requires DataIdentifiers not yet resolved.  The executor will
+    schedule them and evaluate the task again afterward.
+    """
+    def __init__(self, node_name, deps):
+        super().__init__()
+        self.deps = [(node_name, path, fields) for path, fields in deps]
+
+    def __str__(self):
+        return f'PendingDependency {[path for _, path, _ in self.deps]}'
+
+@contextmanager
+def task_scope(paths, known):
+    """
+    Within this context, only DataIdentifiers in `paths` will be resolved,
+    requesting other unresolved DataIdentifiers raises `PendingDependency`.
+
+    :param paths: Paths of the DataIdentifiers to resolve.
+    :type paths: set
+    :param known: Resolved DataIdentifiers, mapping from paths to values.
+    :type known: dict
+    """
+    assert _task_paths() is None
+    __task.paths = paths
+    try:
+        with batch_scope() as memo:
+            memo.update(known)
+            yield
+    finally:
+        __task.paths = None
+
+def _task_paths():
+    return getattr(__task, 'paths', None)
+
+__plan = threading.local()
+
+class MissingData(Exception):
+    """
+    Raised in the plan mode (see `plan_scope`) instead of crawling the data
+    missing from the database.
+    """
+    def __init__(self, node_name, triggers):
+        super().__init__()
+        self.node_name = node_name
+        self.triggers = triggers
+
+    def __str__(self):
+        return f'MissingData {self.node_name} {self.triggers}'
+
+@contextmanager
+def plan_scope():
+    """
+    Within this context, crawlers are not called.  The `CrawlerTrigger`s are
+    recorded in the yielded `dict`, mapping from node names to the triggers
+    (keyed by their arguments), and the evaluations requiring the missing
+    data stop with `MissingData`.
+    """
+    assert _plan() is None
+    __plan.triggers = {}
+    try:
+        yield __plan.triggers
+    finally:
+        __plan.triggers = None
+
+def _plan():
+    return getattr(__plan, 'triggers', None)
+
+def record_triggers(node_name, triggers):
+    """
+    In the plan mode, record `triggers` and raise `MissingData`.  Otherwise
+    do nothing.
+    """
+    plan = _plan()
+    if plan is None:
+        return
+    recorded = plan.setdefault(node_name, {})
+    for t in triggers:
+        recorded.setdefault(t.key(), t)
+    raise MissingData(node_name, triggers)
 
 class Node(StocklabObject):
     """
     The base class for stocklab Nodes.  Nodes are callable, parameters are
     fields in the DataIdentifier.  It will return the evaluated result for a
     DataIdentifier.
+
+    Attrubutes:
+
+    *  persist: Keep the evaluated results in a file under `root_dir`, so
+        they are available to later runs.  The results will be evaluated
+        again if the source code of the node changes.  Only pure nodes
+        should set this. (defaults to: False)
     """
     def __init__(self):
         super().__init__()
+        self.default_attr('persist', False)
+        if self.persist:
+            self._persist_version = persist.source_version(type(self))
         if hasattr(type(self), 'crawler_entry') and \
                 isinstance(type(self).crawler_entry, Surrogate):
             type(self).crawler_entry = \
@@ -42,40 +167,229 @@ class Node(StocklabObject):
         return '.'.join([self.name] + [
             f'{k}:{v}' for k, v in sorted(kwargs.items()) if k != 'self'])
 
-    def type_normalization(self, kwargs):
+    def type_normalization(self, kwargs, partial=False):
         """
         Convert types for the fields according to the node's Args
         declaration.
 
+        :param partial: Allow fields to be omitted, defaults to False.
+        :type partial: bool
         :returns: Checked & type casted parameters.
         """
-        assert len(self.args) == len(kwargs), f'Invalid fields: {kwargs}'
-        assert all([k in self.args for k in kwargs]), \
-                f'Invalid fields: {kwargs}'
-        for arg_name in kwargs:
-            arg_type = self.args[arg_name].type
-            arg_val = kwargs[arg_name]
-            if type(arg_type) is type:
-                kwargs[arg_name] = arg_type(arg_val)
+        normalize = vars(type(self)).get('_normalize')
+        if normalize is None:
+            normalize = type(self)._compile_args()
+        return normalize(kwargs, partial)
+
+    @classmethod
+    def _compile_args(cls):
+        """
+        Build the function normalizing the fields from the `Args`
+        declaration, it is called when the node is registered.
+        """
+        try:
+            args = cls.args
+        except AttributeError: # not a concrete node
+            args = Args()
+        names = frozenset(args)
+        converters = {}
+        for arg_name, arg in args.items():
+            if type(arg.type) is type:
+                converters[arg_name] = arg.type
             else: # Arg is enum
-                assert type(arg_type) is list
-                assert arg_val in arg_type
-        return kwargs
+                assert type(arg.type) is list
+                converters[arg_name] = _oneof(arg_name, frozenset(arg.type))
+
+        def _normalize(kwargs, partial=False):
+            assert partial or len(kwargs) == len(names), \
+                    f'Invalid fields: {kwargs}'
+            assert names.issuperset(kwargs), f'Invalid fields: {kwargs}'
+            for arg_name, arg_val in kwargs.items():
+                kwargs[arg_name] = converters[arg_name](arg_val)
+            return kwargs
+        cls._normalize = _normalize
+        return _normalize
 
-    def __call__(self, **kwargs):
+    def __call__(self, _di=None, **kwargs):
+        """
+        :param _di: (Optional) A `DataIdentifier` of this node, instead of
+            the fields.
+        :type _di: DataIdentifier
+        """
+        if _di is not None:
+            assert _di.node is self and _di.complete and not kwargs, \
+                    f'Invalid DataIdentifier: {_di}'
+            return self._lookup(_di, _di.fields)
         kwargs = self.type_normalization(kwargs)
-        path = self.path(**kwargs)
-        if get_cache(path) is None:
-            retval = self._resolve(**kwargs)
+        return self._lookup(self.path(**kwargs), kwargs)
+
+    def batch(self, fields_list):
+        """
+        Evaluate a list of DataIdentifiers of this node.  Duplicated
+        DataIdentifiers (including the ones requested by the dependencies)
+        are resolved only once.
+
+        :param fields_list: The fields of each DataIdentifier.
+        :type fields_list: list of dict
+        :returns: The evaluated results, in the same order as `fields_list`.
+        """
+        with batch_scope():
+            fields_list = [self.type_normalization(dict(fields))
+                    for fields in fields_list]
+            paths = [self.path(**fields) for fields in fields_list]
+            self._require(paths, fields_list)
+            results = {}
+            for path, fields in zip(paths, fields_list):
+                if path not in results:
+                    results[path] = self._lookup(path, fields)
+            return [results[path] for path in paths]
+
+    def _require(self, paths, fields_list):
+        """
+        Raise `PendingDependency` for all of the DataIdentifiers not allowed
+        to be resolved in the current executor task.
+        """
+        own = _task_paths()
+        if own is None:
+            return
+        memo = _batch_memo()
+        missing = [(path, fields) for path, fields in zip(paths, fields_list)
+                if path not in own and path not in memo
+                and get_cache(path) is None]
+        if missing:
+            raise PendingDependency(self.name, missing)
+
+    def _lookup(self, path, kwargs):
+        if trace.active is not None:
+            with trace.active.span(path, 'node', cache='hit'):
+                return self._lookup_untraced(path, kwargs)
+        return self._lookup_untraced(path, kwargs)
+
+    def _lookup_untraced(self, path, kwargs):
+        deps.record(path)
+        memo = _batch_memo()
+        if memo is not None and path in memo:
+            if trace.active is not None:
+                trace.active.annotate(cache='memo')
+            return memo[path]
+        retval = get_cache(path)
+        if retval is None:
+            own = _task_paths()
+            if own is not None and path not in own:
+                raise PendingDependency(self.name, [(path, kwargs)])
+            retval = self._load_persisted(path)
+            if retval is None:
+                with deps.evaluating(path):
+                    retval = self._resolve_traced(kwargs)
+                self._save_persisted(path, retval)
+            elif trace.active is not None:
+                trace.active.annotate(cache='persisted')
             assert retval is not None # TODO: do more sophiscated check
             set_cache(path, retval)
-        return get_cache(path)
+        if memo is not None:
+            memo[path] = retval
+        return retval
+
+    async def acall(self, _di=None, **kwargs):
+        """
+        The asynchronous version of `__call__`.  Crawler entries defined with
+        `async def` are awaited on the running event loop, synchronous
+        evaluations run in the default executor of the loop.  Concurrent
+        calls for the same DataIdentifier share a single resolution.
+        """
+        if _di is not None:
+            assert _di.node is self and _di.complete and not kwargs, \
+                    f'Invalid DataIdentifier: {_di}'
+            path, kwargs = _di, _di.fields
+        else:
+            kwargs = self.type_normalization(kwargs)
+            path = self.path(**kwargs)
+        if trace.active is not None:
+            with trace.active.span(path, 'node', cache='hit'):
+                return await self._alookup(path, kwargs)
+        return await self._alookup(path, kwargs)
+
+    async def _alookup(self, path, kwargs):
+        deps.record(path)
+        memo = _batch_memo()
+        if memo is not None and path in memo:
+            if trace.active is not None:
+                trace.active.annotate(cache='memo')
+            return memo[path]
+        retval = get_cache(path)
+        if retval is None:
+            loop = asyncio.get_running_loop()
+            aio.set_loop(loop)
+            inflight = _inflight.setdefault(loop, {})
+            if path in inflight:
+                if trace.active is not None:
+                    trace.active.annotate(cache='inflight')
+                return await asyncio.shield(inflight[path])
+            future = inflight[path] = loop.create_future()
+            try:
+                retval = self._load_persisted(path)
+                if retval is None:
+                    with deps.evaluating(path):
+                        retval = await self._aresolve_traced(kwargs)
+                    self._save_persisted(path, retval)
+                assert retval is not None # TODO: do more sophiscated check
+                set_cache(path, retval)
+                future.set_result(retval)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                future.exception() # retrieved by the raise below
+                raise
+            finally:
+                del inflight[path]
+        if memo is not None:
+            memo[path] = retval
+        return retval
+
+    def _load_persisted(self, path):
+        if not self.persist:
+            return None
+        return persist.get_store().get(path, self._persist_version)
+
+    def _save_persisted(self, path, retval):
+        if self.persist and retval is not None:
+            persist.get_store().set(path, self._persist_version, retval,
+                    deps.inputs(path))
+
+    def _resolve_traced(self, kwargs):
+        if trace.active is None:
+            return self._resolve(**kwargs)
+        trace.active.annotate(cache='miss')
+        with trace.active.span(self.name, 'evaluate'):
+            return self._resolve(**kwargs)
 
     def _resolve(self, **kwargs):
         try:
-            return type(self).evaluate(**kwargs)
+            retval = type(self).evaluate(**kwargs)
+            if aio.is_async(type(self).evaluate):
+                retval = aio.run_sync(retval)
+            return retval
+        except CrawlerTrigger as t:
+            record_triggers(self.name, [t])
+            return aio.call_entry(type(self).crawler_entry, t.kwargs)
+
+    async def _aresolve_traced(self, kwargs):
+        if trace.active is None:
+            return await self._aresolve(**kwargs)
+        trace.active.annotate(cache='miss')
+        with trace.active.span(self.name, 'evaluate'):
+            return await self._aresolve(**kwargs)
+
+    async def _aresolve(self, **kwargs):
+        if not aio.is_async(type(self).evaluate):
+            return await aio.run_in_executor(self._resolve, **kwargs)
+        try:
+            return await type(self).evaluate(**kwargs)
         except CrawlerTrigger as t:
-            return type(self).crawler_entry(**t.kwargs)
+            record_triggers(self.name, [t])
+            return await aio.acall_entry(type(self).crawler_entry, t.kwargs)
 
     def evaluate(**kwargs):
         """
@@ -84,6 +398,12 @@ class Node(StocklabObject):
         """
         raise NotImplementedError()
 
+def _oneof(arg_name, enums):
+    def _check(arg_val):
+        assert arg_val in enums, f'Invalid value for {arg_name}: {arg_val}'
+        return arg_val
+    return _check
+
 class Arg(dict):
     """
     Used in node declarations. A `dict` of field specifications.
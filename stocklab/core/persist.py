@@ -0,0 +1,146 @@
+""" This module provides the on-disk store for the results of nodes with the
+    `persist` attribute set.  The results are pickled and saved in a SQLite
+    file under `root_dir`, keyed by the DataIdentifier.  Each result is
+    versioned by the source code of its node, so results of a modified node
+    will be evaluated again.  The DataIdentifiers a result was evaluated
+    from are stored along with it, so the result is invalidated by the
+    changes of them in the later processes too (see `stocklab.core.deps`).
+"""
+import os
+import atexit
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import threading
+
+from .config import get_config
+
+__store = None
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    global __store
+    if __store is not None:
+        __store.close()
+    __store = None
+
+def _store_path():
+    cfg = get_config('persist') or {}
+    filename = cfg.get('filename', 'results.sqlite')
+    return os.path.join(get_config('root_dir'), filename)
+
+def get_store():
+    """
+    Returns the store, it will be opened according to the `persist`
+    configuration on the first call.
+    """
+    global __store
+    if __store is None:
+        __store = PersistentStore(_store_path())
+    return __store
+
+def discard(key):
+    """Remove the stored result of `key`, if the store was opened."""
+    if __store is not None:
+        __store.discard(key)
+
+def dependents(keys):
+    """
+    :returns: The set of the stored results evaluated from any of `keys`,
+        the store is opened if its file exists.
+    """
+    if __store is None and not os.path.exists(_store_path()):
+        return set()
+    return get_store().dependents(keys)
+
+def source_version(cls):
+    """
+    :returns: A digest of the source code of `cls`, or its qualified name if
+        the source code is not available.
+    """
+    try:
+        src = inspect.getsource(cls)
+    except (OSError, TypeError):
+        src = f'{cls.__module__}.{cls.__qualname__}'
+    return hashlib.sha1(src.encode()).hexdigest()
+
+class PersistentStore:
+    """
+    A key-value store backed by SQLite.  Each write is committed at once,
+    so the store never holds the write lock between calls, and other
+    processes can write the same file.  The file is in the WAL mode, the
+    readers do not block the writer.
+
+    :param path: Path to the SQLite file.
+    :type path: str
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                'path TEXT PRIMARY KEY, version TEXT NOT NULL, '
+                'value BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS inputs ('
+                'input TEXT NOT NULL, path TEXT NOT NULL, '
+                'PRIMARY KEY (input, path))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS inputs_path '
+                'ON inputs (path)')
+        self._conn.commit()
+        atexit.register(self.close)
+
+    def get(self, key, version):
+        """Returns the stored value of `key`, or None if not stored."""
+        with self._lock:
+            row = self._conn.execute(
+                    'SELECT value FROM results WHERE path = ? AND version = ?',
+                    (key, version)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def set(self, key, version, val, inputs=()):
+        """
+        Store `val` of `key`.
+
+        :param inputs: The keys `val` was evaluated from, see `dependents`.
+        :type inputs: iterable
+        """
+        blob = pickle.dumps(val, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn: # committed, or rolled back on errors
+            self._conn.execute('INSERT OR REPLACE INTO results '
+                    '(path, version, value) VALUES (?, ?, ?)',
+                    (key, version, blob))
+            self._conn.execute('DELETE FROM inputs WHERE path = ?', (key,))
+            self._conn.executemany('INSERT INTO inputs (input, path) '
+                    'VALUES (?, ?)', [(i, key) for i in inputs])
+
+    def discard(self, key):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM results WHERE path = ?', (key,))
+            self._conn.execute('DELETE FROM inputs WHERE path = ?', (key,))
+
+    def dependents(self, keys):
+        """Returns the set of the stored keys evaluated from any of `keys`."""
+        keys = list(keys)
+        found = set()
+        with self._lock:
+            for i in range(0, len(keys), 900): # the limit of host parameters
+                chunk = keys[i:i + 900]
+                rows = self._conn.execute('SELECT DISTINCT path FROM inputs '
+                        'WHERE input IN ({})'.format(
+                            ', '.join('?' for _ in chunk)), chunk)
+                found.update(row[0] for row in rows)
+        return found
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
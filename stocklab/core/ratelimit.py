@@ -0,0 +1,169 @@
+""" This module provides token buckets to limit the rate of requests, see
+    `stocklab.crawler.speed_limiter`.  The buckets implement GCRA (the
+    generic cell rate algorithm): the state of a bucket is a single
+    timestamp, the theoretical arrival time (TAT) of the next request.
+
+    Named buckets (see `get_bucket`) are shared by every caller of the same
+    name.  Once stocklab is configured, their states are kept in a SQLite
+    file under `root_dir`, so that the threads and the processes (e.g. the
+    workers of `stocklab.core.executor.Executor`) share the quota.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import threading
+
+from .config import is_configured, get_config
+
+__buckets = {}
+__lock = threading.Lock()
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    with __lock:
+        for bucket in __buckets.values():
+            bucket.close()
+        __buckets.clear()
+
+def get_bucket(name, rate, burst=1, path=None):
+    """
+    Returns the bucket of `name`, it will be created on the first call.
+
+    :param name: The name of the bucket, e.g. the host of a data source.
+    :type name: str
+    :param rate: The sustained number of requests per second.
+    :type rate: float
+    :param burst: The number of requests allowed at once, defaults to 1.
+    :type burst: int
+    :param path: (Optional) The SQLite file keeping the state, see
+        `TokenBucket`.
+    :type path: str
+    """
+    with __lock:
+        bucket = __buckets.get(name)
+        if bucket is None:
+            bucket = __buckets[name] = TokenBucket(rate, burst, name, path)
+    assert (bucket.rate, bucket.burst) == (rate, burst), \
+            f'Bucket {name} was created with different parameters.'
+    return bucket
+
+class TokenBucket:
+    """
+    A token bucket refilled by `rate` tokens per second, which holds at most
+    `burst` tokens.  Each request takes a token.
+
+    :param rate: The sustained number of requests per second.
+    :type rate: float
+    :param burst: The capacity of the bucket, defaults to 1.
+    :type burst: int
+    :param name: (Optional) The name to share the state with other
+        processes, see the module documentation.
+    :type name: str
+    :param path: (Optional) The SQLite file keeping the state of named
+        buckets, defaults to `rate_limits.sqlite` under `root_dir`.
+    :type path: str
+    """
+    def __init__(self, rate, burst=1, name=None, path=None):
+        assert rate > 0 and burst >= 1
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self.path = path
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._tat = 0.0
+        self._conn = None
+        self._pid = None
+
+    def acquire(self, blocking=True):
+        """
+        Take a token.
+
+        :param blocking: If False, return immediately when no token is
+            available, defaults to True.
+        :type blocking: bool
+        :returns: True if the token was taken.
+        """
+        delay = self._take(reserve=blocking)
+        if not blocking:
+            return delay == 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    async def aacquire(self):
+        """Same as `acquire`, but wait with `asyncio.sleep`."""
+        delay = self._take(reserve=True)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return True
+
+    def wait_time(self):
+        """
+        :returns: The seconds to wait until a token is available, the token
+            is not taken.
+        """
+        return self._update(lambda tat: (tat, self._delay(tat)[1]))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def _delay(self, tat):
+        now = time.time()
+        new_tat = max(tat, now) + self.interval
+        return new_tat, max(new_tat - now - self.interval * self.burst, 0.0)
+
+    def _take(self, reserve):
+        """
+        Take a token, the waiting time is returned.  If no token is
+        available, the next one is reserved if `reserve` is set, otherwise
+        the bucket is not changed.
+        """
+        def _step(tat):
+            new_tat, delay = self._delay(tat)
+            if delay > 0 and not reserve:
+                return tat, delay
+            return new_tat, delay
+        return self._update(_step)
+
+    def _update(self, step):
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                self._tat, retval = step(self._tat)
+                return retval
+            # Lock the database, so the read-modify-write is atomic among
+            # the processes
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tat FROM buckets WHERE name = ?',
+                        (self.name,)).fetchone()
+                tat, retval = step(0.0 if row is None else row[0])
+                conn.execute('INSERT OR REPLACE INTO buckets (name, tat) '
+                        'VALUES (?, ?)', (self.name, tat))
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return retval
+
+    def _connect(self):
+        if self.name is None or (self.path is None and not is_configured()):
+            return None
+        if self._conn is None or self._pid != os.getpid():
+            path = self.path or os.path.join(get_config('root_dir'),
+                    'rate_limits.sqlite')
+            self._conn = sqlite3.connect(path, timeout=30,
+                    isolation_level=None, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                    'name TEXT PRIMARY KEY, tat REAL NOT NULL)')
+            self._pid = os.getpid()
+        return self._conn
@@ -1,5 +1,6 @@
-import os
 import sys
+import importlib.abc
+import importlib.util
 
 from . import bundle
 
@@ -42,23 +43,35 @@ class Surrogate:
     def __repr__(self):
         return self.__str__()
 
-class StocklabRuntimeImporter:
-    """The customized import hook to import stocklab components."""
-    objs = []
-    def find_module(self, module_name, package_path):
-        if module_name in StocklabRuntimeImporter.objs:
-            return self
+class StocklabRuntimeImporter(importlib.abc.MetaPathFinder,
+        importlib.abc.Loader):
+    """
+    The customized import hook to import stocklab components, the imported
+    "module" is the `Surrogate` of the component.
+    """
+    def find_spec(self, module_name, package_path, target=None):
+        if package_path is None and bundle.has_component(module_name):
+            return importlib.util.spec_from_loader(module_name, self)
         else:
             return None
 
-    def load_module(self, module_name):
-        sys.modules[module_name] = Surrogate(module_name)
+    def create_module(self, spec):
+        return Surrogate(spec.name)
+
+    def exec_module(self, module):
+        pass
 
 sys.meta_path.append(StocklabRuntimeImporter())
 
-for bndl in bundle.__bundles:
-    for fp in bndl['files']:
-        fbase = os.path.basename(fp)
-        fname, fext = os.path.splitext(fbase)
-        StocklabRuntimeImporter.objs.append(fname)
-        exec(f'import {fname}')
+def __getattr__(name):
+    """
+    Returns the `Surrogate` of a registered node/crawler, the module of the
+    node/crawler is not imported.
+    """
+    if name == '__all__':
+        return [name for bndl in bundle.__bundles
+                for name in list(bndl['nodes']) + list(bndl['crawlers'])
+                + list(bundle._lazy(bndl))]
+    if not name.startswith('__') and bundle.has_component(name):
+        return Surrogate(name)
+    raise AttributeError(f'module {__name__} has no attribute {name}')
@@ -0,0 +1,142 @@
+""" This module records the evaluation as a tree of spans, use it like::
+
+        with tracing() as tracer:
+            stocklab.eval('MovingAverage.stock:acme.date_idx:1000.window:5')
+        tracer.to_json('trace.json')
+        tracer.to_chrome_trace('trace_chrome.json') # see chrome://tracing
+
+    Each top-level DataIdentifier is a root span.  The kinds of spans are:
+
+    *  `node`: A DataIdentifier requested, attribute `cache` tells whether
+       it was found in the cache (`hit`, `miss` or `memo` of a batch).
+    *  `evaluate`: The evaluation of a node (including the database queries).
+    *  `crawl`: A call to a crawler entry.
+    *  `db.update`: The ingestion of the crawled records.
+
+    When tracing is disabled (`active` is None), the only overhead is the
+    check of `active` at each instrumented point.
+"""
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+active = None
+_current = contextvars.ContextVar('stocklab_trace_span', default=None)
+
+@contextmanager
+def tracing():
+    """
+    Enable tracing within this context.
+
+    :returns: The `Tracer` recording the evaluation.
+    """
+    global active
+    assert active is None, 'Tracing was already enabled.'
+    active = Tracer()
+    try:
+        yield active
+    finally:
+        active = None
+
+class Span:
+    """A timed operation, see the module documentation for the kinds."""
+    def __init__(self, name, kind, start, attrs):
+        super().__init__()
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = None
+        self.attrs = attrs
+        self.children = []
+        self.thread = threading.get_ident()
+
+    def crawl_count(self):
+        own = 1 if self.kind == 'crawl' else 0
+        return own + sum(child.crawl_count() for child in self.children)
+
+    def to_dict(self):
+        return {
+                'name': self.name,
+                'kind': self.kind,
+                'start': self.start,
+                'duration': self.end - self.start,
+                'attrs': self.attrs,
+                'crawls': self.crawl_count(),
+                'children': [child.to_dict() for child in self.children],
+                }
+
+class Tracer:
+    """
+    Records spans.  Timestamps are in seconds, relative to the creation of
+    the tracer.
+    """
+    def __init__(self):
+        super().__init__()
+        self.roots = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, kind, **attrs):
+        parent = _current.get()
+        span = Span(name, kind, time.perf_counter() - self._origin, attrs)
+        if parent is None:
+            with self._lock:
+                self.roots.append(span)
+        else:
+            parent.children.append(span)
+        token = _current.set(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter() - self._origin
+            _current.reset(token)
+
+    def annotate(self, **attrs):
+        """Add attributes to the current span."""
+        span = _current.get()
+        if span is not None:
+            span.attrs.update(attrs)
+
+    def to_dict(self):
+        return [span.to_dict() for span in self.roots]
+
+    def to_json(self, path=None):
+        """
+        :param path: (Optional) The file to write.
+        :returns: The span trees in JSON.
+        """
+        return self._dump(self.to_dict(), path)
+
+    def to_chrome_trace(self, path=None):
+        """
+        :param path: (Optional) The file to write.
+        :returns: The spans in the Chrome trace event format.
+        """
+        events = []
+        def _add(span):
+            events.append({
+                'name': span.name,
+                'cat': span.kind,
+                'ph': 'X',
+                'ts': span.start * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': os.getpid(),
+                'tid': span.thread,
+                'args': span.attrs,
+                })
+            for child in span.children:
+                _add(child)
+        for span in self.roots:
+            _add(span)
+        return self._dump({'traceEvents': events}, path)
+
+    def _dump(self, obj, path):
+        dumped = json.dumps(obj, default=str)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(dumped)
+        return dumped
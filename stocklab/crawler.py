@@ -4,53 +4,84 @@ to excecute, but these are common patterns for crawlers in applications.
 """
 
 import time
+import asyncio
+import weakref
+import warnings
+import functools
+import threading
 
 from .core.crawler import *
+from .core.aio import is_async
+from .core.ratelimit import TokenBucket, get_bucket
 from .core.logger import get_instance as get_logger
 
 class SpeedLimiter:
     """
     A helper class to limit the frequency of a function call (e.g. remote
-    access).
+    access) with a token bucket (see `stocklab.core.ratelimit`).  Coroutine
+    functions are throttled with `asyncio.sleep`, so other tasks can run
+    while waiting.
     """
-    def __init__(self, func, max_speed, tick_period):
+    def __init__(self, func, max_speed, tick_period=None, burst=1,
+            bucket=None):
         super().__init__()
+        _warn_tick_period(tick_period)
+        functools.update_wrapper(self, func, updated=())
+        self.is_async = is_async(func)
         self.func = func
         self.max_speed = max_speed
-        self.tick_period = tick_period
-        self.last_req = None
+        self.burst = burst
+        self.bucket_name = bucket or f'{func.__module__}.{func.__qualname__}'
 
-    def speed(self):
-        if self.last_req is None:
-            return 0.0
-        now = time.time()
-        return 1.0 / (now - self.last_req)
+    @property
+    def bucket(self):
+        return get_bucket(self.bucket_name, self.max_speed, self.burst)
 
     def __call__(self, *args, **kwargs):
-        speed = self.speed()
-        while self.speed() > self.max_speed:
-            time.sleep(self.tick_period)
-            speed = self.speed()
-        retval = self.func(*args, **kwargs)
-        get_logger().debug(f'Request sent, speed={speed} (from SpeedLimiter)')
-        self.last_req = time.time()
-        return retval
-
-def speed_limiter(max_speed, tick_period=0.01):
+        if self.is_async:
+            return self._acall(*args, **kwargs)
+        self.bucket.acquire()
+        get_logger().debug('Request sent, bucket=%s (from SpeedLimiter)',
+                self.bucket_name)
+        return self.func(*args, **kwargs)
+
+    async def _acall(self, *args, **kwargs):
+        await self.bucket.aacquire()
+        get_logger().debug('Request sent, bucket=%s (from SpeedLimiter)',
+                self.bucket_name)
+        return await self.func(*args, **kwargs)
+
+def _warn_tick_period(tick_period):
+    if tick_period is not None:
+        warnings.warn('tick_period is deprecated and ignored, the calls are '
+                'limited by a token bucket, see `burst`.', DeprecationWarning,
+                stacklevel=3)
+
+def speed_limiter(max_speed, tick_period=None, burst=1, bucket=None):
     """
     The decorator for `SpeedLimiter`.  Use it like::
 
-        @speed_limiter(max_speed=10)
+        @speed_limiter(max_speed=10, burst=5, bucket='example.com')
         def my_action(myparam):
             do_something()
 
-    :param max_speed: The peak throughput limitation. Specified the number in
-        `call/second`.
+    The functions limited with the same `bucket` share the quota, in all
+    threads and processes.
+
+    :param max_speed: The sustained throughput limitation. Specified the
+        number in `call/second`.
     :type max_speed: float
-    :param tick_period: The cooldown interval in seconds, defaults to 0.01.
+    :param tick_period: Deprecated and ignored, it was the cooldown
+        interval in seconds.
     :type tick_period: float
+    :param burst: The number of calls allowed at once, defaults to 1.
+    :type burst: int
+    :param bucket: (Optional) The name of the token bucket, defaults to the
+        qualified name of the function.
+    :type bucket: str
     """
-    return lambda f: SpeedLimiter(f, max_speed, tick_period)
+    _warn_tick_period(tick_period)
+    return lambda f: SpeedLimiter(f, max_speed, burst=burst, bucket=bucket)
 
 class RetryHelper:
     """
@@ -59,29 +90,46 @@ class RetryHelper:
     def __init__(self, func, max_retry, interval, retry_on):
         assert max_retry >= 0
         super().__init__()
+        functools.update_wrapper(self, func, updated=())
+        self.is_async = is_async(func)
         self.func = func
         self.max_retry = max_retry
         self.interval = interval
         self.retry_on = retry_on
 
     def __call__(self, *args, **kwargs):
+        if self.is_async:
+            return self._acall(*args, **kwargs)
         retry_count = 0
         while True:
             try:
                 return self.func(*args, **kwargs)
             except Exception as e:
-                if isinstance(e, self.retry_on):
-                    retry_count += 1
-                    if retry_count > self.max_retry:
-                        raise e
-                    e_name = type(e).__name__
-                    e_msg = str(e)
-                    e_str = f'{e_name}({e_msg})' if e_msg else e_name
-                    get_logger().info(f'Got {e_str}, waiting for '
-                            'retry... (from RetryHelper)')
-                    time.sleep(self.interval)
-                else:
-                    raise e
+                retry_count = self._on_error(e, retry_count)
+                time.sleep(self.interval)
+
+    async def _acall(self, *args, **kwargs):
+        retry_count = 0
+        while True:
+            try:
+                return await self.func(*args, **kwargs)
+            except Exception as e:
+                retry_count = self._on_error(e, retry_count)
+                await asyncio.sleep(self.interval)
+
+    def _on_error(self, e, retry_count):
+        if isinstance(e, self.retry_on):
+            retry_count += 1
+            if retry_count > self.max_retry:
+                raise e
+            e_name = type(e).__name__
+            e_msg = str(e)
+            e_str = f'{e_name}({e_msg})' if e_msg else e_name
+            get_logger().info('Got %s, waiting for retry... (from '
+                    'RetryHelper)', e_str)
+            return retry_count
+        else:
+            raise e
 
 def retry_helper(max_retry, interval=5, retry_on=(Exception,)):
     """
@@ -100,3 +148,68 @@ def retry_helper(max_retry, interval=5, retry_on=(Exception,)):
     :type retry_on: list
     """
     return lambda f: RetryHelper(f, max_retry, interval, retry_on)
+
+class ConcurrencyLimiter:
+    """
+    A helper class to limit the number of concurrent calls of a function.
+    For coroutine functions, the limit applies to each event loop.
+    """
+    def __init__(self, func, max_concurrency):
+        assert max_concurrency > 0
+        super().__init__()
+        functools.update_wrapper(self, func, updated=())
+        self.is_async = is_async(func)
+        self.func = func
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    def __call__(self, *args, **kwargs):
+        if self.is_async:
+            return self._acall(*args, **kwargs)
+        with self._semaphore:
+            return self.func(*args, **kwargs)
+
+    async def _acall(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_semaphores:
+            self._async_semaphores[loop] = \
+                    asyncio.Semaphore(self.max_concurrency)
+        async with self._async_semaphores[loop]:
+            return await self.func(*args, **kwargs)
+
+def concurrency_limiter(max_concurrency):
+    """
+    The decorator for `ConcurrencyLimiter`.  Use it like::
+
+        @concurrency_limiter(max_concurrency=8)
+        async def my_action(myparam):
+            await do_something()
+
+    :param max_concurrency: The maximum number of calls in flight.
+    :type max_concurrency: int
+    """
+    return lambda f: ConcurrencyLimiter(f, max_concurrency)
+
+def coalesce(**rules):
+    """
+    Declare how the `CrawlerTrigger`s of a crawler entry can be merged, so
+    that the missing data of a batch (see `Node.batch`) will be retrieved
+    with the minimal number of crawler calls.  Use it like::
+
+        @coalesce(date=Contiguous(max_len=31), stock_id=Collect())
+        def my_action(date, stock_id):
+            for d in date: # a `range`
+                for s in stock_id: # a `list`
+                    do_something()
+
+    The fields with a rule will always receive the merged value, even if
+    there is only one trigger.
+
+    :param rules: Mapping from field names to merging rules, see
+        `merge_triggers`.
+    """
+    def _decorator(func):
+        func.coalesce = rules
+        return func
+    return _decorator
@@ -1,9 +1,37 @@
 """TODO: refactor this entire file."""
+import os
+import time
+import random
+import threading
 import pydal
-from contextlib import ContextDecorator
+from pydal.helpers.classes import ExecutionHandler
+from contextlib import ContextDecorator, contextmanager
 
 from .core.logger import get_instance as get_logger
 from .core.config import get_config
+from .core.error import ReadOnlyError
+from .node import refresh_views, invalidate
+from .columnar import open_store
+
+_MAX_SQL_VARS = 900 # SQLite allows 999 host parameters by default
+_MAX_BACKOFF = 2.0 # seconds
+_RAW_TYPES = ['string', 'text', 'integer', 'bigint', 'double']
+_TYPE_MAP = {
+    'string': str,
+    'text': str,
+    'integer': int,
+    }
+_converters = {}
+_MISSING_TABLE = 'stocklab_missing'
+_MISSING_SCHEMA = {
+    'node': {'key': True},
+    'trigger': {'type': 'text', 'key': True},
+    'expires': {'type': 'double'},
+    }
+
+__local = threading.local()
+__lock = threading.Lock()
+__sessions = []
 
 def _get_keys(schema):
   return [field_name
@@ -11,73 +39,440 @@ def _get_keys(schema):
       if 'key' in field_config and field_config['key']
       ]
 
-class get_db(pydal.DAL, ContextDecorator):
-  _cfg_inst = {}
-  _inst_cnt = {}
-  def __init__(self, config_name, *args, **kwargs):
-    self.__args = args
-    self.__kwargs = kwargs
+def _and(queries):
+  query = queries[0]
+  for q in queries[1:]:
+    query &= q
+  return query
+
+def _get_converter(name, schema):
+  """
+  Returns a function which applies `pre_proc` and checks the field types of
+  a record.  The function is compiled once per schema.
+  """
+  if name in _converters and _converters[name][0] is schema:
+    return _converters[name][1]
+
+  def _proc(key, cfg):
+    field_type = cfg['type'] if 'type' in cfg else 'string'
+    pre_proc = cfg['pre_proc'] if 'pre_proc' in cfg else None
+    req_type = _TYPE_MAP.get(field_type)
+    def _conv(val):
+      processed = pre_proc(val) if pre_proc else val
+      if req_type and processed is not None:
+        assert type(processed) is req_type, 'type error in DB insertion.' +\
+            f' Field {key} requires {field_type}, got {type(processed)}'
+      return processed
+    return _conv
+  procs = {k: _proc(k, cfg) for k, cfg in schema.items()}
+  def _convert(rec):
+    return {k: procs[k](v) for k, v in rec.items()}
+  _converters[name] = (schema, _convert)
+  return _convert
+
+def _reset():
+  """
+  This is only used for testing.  To get a fresh session, we should
+  reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+  """
+  global __sessions
+  with __lock:
+    sessions, __sessions = __sessions, []
+  for db in sessions:
+    if db._thread == threading.get_ident():
+      db.close_session()
+  __local.sessions = {}
+
+def close_db():
+  """
+  Commit and close the database sessions of the current thread.  A new
+  session will be opened by the next `get_db`.
+  """
+  for db in list(getattr(__local, 'sessions', {}).values()):
+    db.close_session()
+    _forget(db)
+
+def _get_session(config_name):
+  sessions = getattr(__local, 'sessions', None)
+  if sessions is None:
+    sessions = __local.sessions = {}
+  if config_name not in sessions:
+    db = Database.connect(config_name)
+    sessions[config_name] = db
+    with __lock:
+      # The connections of the exited threads were dropped along with their
+      # thread-local storage (see pyDAL's `ConnectionPool`)
+      __sessions[:] = [sess for sess in __sessions if sess._owner.is_alive()]
+      __sessions.append(db)
+  return sessions[config_name]
+
+def _forget(db):
+  global __sessions
+  __local.sessions.pop(db.config_name, None)
+  with __lock:
+    __sessions = [sess for sess in __sessions if sess is not db]
+
+@contextmanager
+def _migration_lock(folder):
+  """Serialize pyDAL's migrations (and its metadata files) among processes."""
+  try:
+    import fcntl
+  except ImportError: # not a POSIX system
+    yield
+    return
+  with open(os.path.join(folder, 'migrate.lock'), 'w') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _retry_locked(func, db, retries, commit=False):
+  """
+  Wrap `func` to retry with an exponential backoff if SQLite reports
+  `database is locked` (after waiting for the busy timeout) when a
+  transaction begins, or when it commits if `commit` is set.  A statement
+  failed within a transaction is not retried, since the transaction should
+  be rolled back and run again as a whole.
+  """
+  def _retrying(*args, **kwargs):
+    for attempt in range(retries + 1):
+      try:
+        return func(*args, **kwargs)
+      except Exception as e:
+        if attempt == retries or 'database is locked' not in str(e):
+          raise
+        if not commit and db._adapter.connection.in_transaction:
+          raise
+        delay = min(0.05 * 2 ** attempt, _MAX_BACKOFF) * random.uniform(0.5, 1)
+        db.logger.warning('Database is locked, retrying in %.2fs', delay)
+        time.sleep(delay)
+  return _retrying
+
+def _tune_sqlite(db, config):
+  """
+  Apply the concurrency options of a SQLite database configuration, see
+  `Database.connect`.
+  """
+  retries = config.get('retries', 0)
+  if retries:
+    adapter = db._adapter
+    adapter.execute = _retry_locked(adapter.execute, db, retries)
+    adapter.commit = _retry_locked(adapter.commit, db, retries, commit=True)
+  db._retries = retries
+  pragmas = {}
+  if config.get('wal'):
+    pragmas['journal_mode'] = 'WAL'
+    pragmas['synchronous'] = 'NORMAL' # durable enough with WAL
+  pragmas.update(config.get('pragmas') or {})
+  if db.read_only:
+    pragmas.pop('journal_mode', None) # it writes to the file
+    pragmas['query_only'] = 'ON'
+  for name, val in pragmas.items():
+    db.executesql(f'PRAGMA {name}={val};')
+
+class _ExplainHandler(ExecutionHandler):
+  """
+  Report the queries scanning a table without an index, they are logged and
+  recorded in `Database.full_scans`.  Enabled by the `explain` option of
+  the database configuration.
+  """
+  def before_execute(self, command):
+    if not command.lstrip().upper().startswith('SELECT'):
+      return
+    db = self.adapter.db
+    scans = [detail for detail in db.explain(command)
+        if detail.startswith('SCAN') and 'INDEX' not in detail
+        and 'CONSTANT ROW' not in detail and 'subquery' not in detail]
+    if scans:
+      db.full_scans.append(command)
+      db.logger.warning('Query without index (%s): %s', ', '.join(scans),
+          command)
+
+class get_db(ContextDecorator):
+  """
+  The context to access the database session of the current thread.  Each
+  thread keeps its own session (a `Database`) for each config name, so the
+  connection and the table definitions are kept between contexts.  Writes
+  are committed when the outermost context exits.
+
+  :param config_name: The name of the database configuration.
+  :type config_name: str
+  """
+  def __init__(self, config_name):
     self.config_name = config_name
-    if config_name not in get_db._inst_cnt:
-      get_db._inst_cnt[config_name] = 1
-    else:
-      get_db._inst_cnt[config_name] += 1
 
   def __enter__(self):
-    if get_db._inst_cnt[self.config_name] > 1:
-      self._singleton = get_db._cfg_inst[self.config_name]
-      return self._singleton
-    else:
-      self._singleton = None
-    self.config = get_config(self.config_name)
-    assert self.config, f'Failed to get config: {self.config_name}'
-    self.logger = get_logger(f'stocklab_db__{self.config_name}')
-    get_db._cfg_inst[self.config_name] = self
-
-    assert self.config['type'] in ['sqlite', 'mssql']
-    if self.config['type'] == 'sqlite':
-      import os
-      db_path = os.path.join(get_config('root_dir'), self.config['filename'])
-      uri = f'sqlite://{db_path}'
-    elif self.config['type'] == 'mssql':
-      host = self.config['host']
-      user = self.config['user']
-      password = self.config['password']
-      driver = self.config['driver']
-      uri = f'mssql4://{user}:{password}@{host}/stocklab-db?driver={driver}'
-
-    self.__kwargs['folder'] = get_config('root_dir')
-    if 'rebuild_metadata' in self.config and self.config['rebuild_metadata']:
-      self.__kwargs['fake_migrate_all'] = True # see pyDAL's 'migration'
-    super().__init__(uri=uri, *self.__args, **self.__kwargs)
-    return self
+    self.db = _get_session(self.config_name)
+    self.db._depth += 1
+    return self.db
 
   def __exit__(self, err_type, err_value, traceback):
-    get_db._inst_cnt[self.config_name] -= 1
-    db = self._singleton or self
+    db = self.db
+    db._depth -= 1
     if isinstance(err_type, Exception):
       db.logger.error(err_value)
-    if get_db._inst_cnt[self.config_name] == 0:
+    # Also the writes made through pyDAL directly
+    if db._depth == 0 and (db._dirty or db._in_transaction()):
       db.commit()
-      db.close()
+      db._dirty = False
     return False # do not eliminate error
-  
+
+class SessionProxy:
+  """
+  Forwards to the database session of the current thread, so it can be
+  shared by threads (e.g. as `DataNode.db`).
+
+  :param config_name: The name of the database configuration.
+  :type config_name: str
+  """
+  def __init__(self, config_name):
+    self.config_name = config_name
+
+  def __getattr__(self, attr):
+    return getattr(_get_session(self.config_name), attr)
+
+  def __getitem__(self, key):
+    return _get_session(self.config_name)[key]
+
+  def __call__(self, *args, **kwargs):
+    return _get_session(self.config_name)(*args, **kwargs)
+
+class Database(pydal.DAL):
+  """
+  A long-lived database session, use `get_db` to access it.  Tables are
+  defined once by `declare_table` for the lifetime of the session.
+  """
+  @classmethod
+  def connect(cls, config_name):
+    """
+    Open a session of the database configuration `config_name`.  For
+    SQLite, several processes can share the database file with the options:
+
+    *  wal: Use the write-ahead log, so the readers and the writer do not
+        block each other.  It also sets `synchronous` to `NORMAL`.
+    *  pragmas: A mapping of other `PRAGMA`s to set, e.g. `mmap_size` or
+        `cache_size`.
+    *  read_only: For the evaluation-only processes, the tables are not
+        created or migrated, `update` raises `ReadOnlyError`, and SQLite
+        rejects the writes with `PRAGMA query_only`.  The file is still
+        opened for writing, e.g. SQLite may recover or checkpoint its
+        journal.
+    *  timeout: The seconds to wait for a lock. (defaults to: 5)
+    *  retries: The number of retries with an exponential backoff, if a
+        transaction was not able to begin (or commit) within `timeout`.
+        (defaults to: 0)
+
+    The write transactions begin with `BEGIN IMMEDIATE`, so a transaction
+    either waits for the lock before it reads anything, or fails without
+    writing anything.
+    """
+    config = get_config(config_name)
+    assert config, f'Failed to get config: {config_name}'
+    assert config['type'] in ['sqlite', 'mssql']
+    if config['type'] == 'sqlite':
+      db_path = os.path.join(get_config('root_dir'), config['filename'])
+      uri = f'sqlite://{db_path}'
+    elif config['type'] == 'mssql':
+      host = config['host']
+      user = config['user']
+      password = config['password']
+      driver = config['driver']
+      uri = f'mssql4://{user}:{password}@{host}/stocklab-db?driver={driver}'
+
+    kwargs = {'folder': get_config('root_dir')}
+    if 'rebuild_metadata' in config and config['rebuild_metadata']:
+      kwargs['fake_migrate_all'] = True # see pyDAL's 'migration'
+    read_only = bool(config.get('read_only'))
+    if read_only:
+      kwargs['migrate_enabled'] = False
+    if config['type'] == 'sqlite':
+      kwargs['driver_args'] = {} if read_only else \
+          {'isolation_level': 'IMMEDIATE'}
+      if 'timeout' in config:
+        kwargs['driver_args']['timeout'] = config['timeout']
+    db = cls(uri, **kwargs)
+    db.config_name = config_name
+    db.config = config
+    db.read_only = read_only
+    db._unique_keys = set() # the tables with the unique index of keys
+    db._retries = 0
+    db.logger = get_logger(f'stocklab_db__{config_name}')
+    if config['type'] == 'sqlite':
+      _tune_sqlite(db, config)
+    db._thread = threading.get_ident()
+    db._owner = threading.current_thread()
+    db._depth = 0
+    db._dirty = False
+    db.full_scans = []
+    db.columnar = open_store(get_config('root_dir'), config.get('columnar'))
+    db._columnar_pending = {} # node name -> [node, records]
+    if config.get('explain'):
+      db._adapter.execution_handlers.append(_ExplainHandler)
+    return db
+
+  def commit(self):
+    """Commit, then append the committed records to the columnar store."""
+    super().commit()
+    pending = getattr(self, '_columnar_pending', None)
+    if pending:
+      self._columnar_pending = {}
+      for node, records in pending.values():
+        self.columnar.write(node, records)
+
+  def rollback(self):
+    super().rollback()
+    if getattr(self, '_columnar_pending', None):
+      self._columnar_pending = {}
+
+  def _in_transaction(self):
+    return getattr(self._adapter.connection, 'in_transaction', False)
+
+  def checkpoint(self):
+    """
+    Commit the writes now instead of at the exit of the outermost `get_db`
+    context, e.g. between the chunks of a long crawl.
+    """
+    if self._dirty:
+      self.commit()
+      self._dirty = False
+
+  def close_session(self):
+    if self._dirty:
+      self.commit()
+      self._dirty = False
+    self.close()
+
   def declare_table(self, name, schema):
+    """
+    Define the table of `schema` and create its indexes: a unique index on
+    the key fields (`'key': True`), and secondary indexes on the fields with
+    `'index'` set.  Fields with the same `'index'` name form a composite
+    index, e.g. `{'index': 'by_date'}`, while `'index': True` indexes the
+    field alone.  If the existing records have duplicated keys, the keys
+    are indexed as non-unique instead, see `deduplicate`.
+    """
     def _field(name, config):
       assert name != 'id', 'pyDAL reserved this name'
       _cfg = config.copy()
-      try: # pop-out params not used by pyDAL
-        _cfg.pop('key')
-        _cfg.pop('pre_proc')
-      except KeyError:
-        pass
+      for k in ['key', 'pre_proc', 'index', 'partition']: # not for pyDAL
+        _cfg.pop(k, None)
       return pydal.Field(name, **_cfg)
     if name not in self.tables:
       fields = [_field(field_name, schema[field_name])
           for field_name in schema.keys()]
-      self.define_table(name, *fields)
+      if self.read_only: # the table should have been created
+        self.define_table(name, *fields)
+        return
+      try:
+        with _migration_lock(get_config('root_dir')):
+          self.define_table(name, *fields)
+          self._declare_indexes(name, schema)
+          self.commit()
+      except self._adapter.driver.OperationalError as e:
+        self.rollback()
+        if name in self.tables: # undo the failed definition
+          self.tables.remove(name)
+        self.__dict__.pop(name, None)
+        if 'already exists' not in str(e):
+          raise
+        # Another process created the table after pyDAL checked the
+        # migration metadata, just record the metadata of this table
+        self.define_table(name, *[_field(field_name, schema[field_name])
+          for field_name in schema.keys()], fake_migrate=True)
+        with _migration_lock(get_config('root_dir')):
+          self._declare_indexes(name, schema)
+          self.commit()
+
+  def _declare_indexes(self, name, schema):
+    table = self[name]
+    indexes = {}
+    for field_name, cfg in schema.items():
+      index = cfg.get('index')
+      if index:
+        index = field_name if index is True else index
+        indexes.setdefault(f'{name}__{index}', []).append(field_name)
+    for index_name, field_names in indexes.items():
+      self._create_index(table, index_name, field_names)
+    key_fields = _get_keys(schema)
+    if not key_fields:
+      return
+    try:
+      self._create_index(table, f'{name}__key', key_fields, unique=True)
+      self._unique_keys.add(name)
+    except self._adapter.driver.IntegrityError:
+      # A table created before the keys were indexed, its records are kept
+      # until `deduplicate` is called explicitly
+      self.logger.warning('%s has records with duplicated keys, the keys '
+          'are not indexed as unique until `deduplicate` is called.', name)
+      self._create_index(table, f'{name}__key_nonunique', key_fields)
+
+  def deduplicate(self, name, schema):
+    """
+    Remove the records with duplicated keys from the table `name`, the
+    latest written record of each key is kept, then create the unique index
+    of the keys.  This migrates a table created before the keys were
+    indexed, see `declare_table`.  The removed records are logged.
+
+    :returns: The number of records removed.
+    """
+    self._check_writable(name)
+    self.declare_table(name, schema)
+    table = self[name]
+    key_fields = _get_keys(schema)
+    assert len(key_fields) > 0
+    latest = self(table)._select(table.id.max(),
+        groupby=[table[k] for k in key_fields])
+    query = ~table.id.belongs(latest)
+    removed = self(query).select(orderby=table.id)
+    for row in removed:
+      self.logger.warning('Remove the record with duplicated keys from '
+          '%s: %s', name, row.as_dict())
+    self(query).delete()
+    self._create_index(table, f'{name}__key', key_fields, unique=True)
+    drop = f'DROP INDEX IF EXISTS {name}__key_nonunique'
+    if self._adapter.dbengine != 'sqlite':
+      drop += f' ON {table._rname}'
+    self.executesql(drop + ';')
+    self.commit()
+    self._unique_keys.add(name)
+    return len(removed)
+
+  def _create_index(self, table, index_name, field_names, unique=False):
+    columns = ', '.join(table[k]._rname for k in field_names)
+    unique = 'UNIQUE ' if unique else ''
+    sql = f'CREATE {unique}INDEX {index_name} ON {table._rname} ({columns});'
+    if self._adapter.dbengine == 'sqlite':
+      sql = sql.replace('INDEX', 'INDEX IF NOT EXISTS', 1)
+    else:
+      sql = f"IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = " \
+          f"'{index_name}') {sql}"
+    self.executesql(sql)
+
+  def explain(self, sql):
+    """
+    Returns the query plan of the SQL statement `sql` (e.g. from
+    `db(query)._select()`) as a list of strings.  Only SQLite is supported.
+    """
+    assert self._adapter.dbengine == 'sqlite'
+    cursor = self._adapter.connection.cursor()
+    return [row[-1] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}')]
 
-  def update(self, node, res):
+  def update(self, node, res, columnar=True):
+    """
+    Write the records `res` (a list of `dict`) of `node` to its table,
+    following `ignore_existed` and `update_existed` of `node`.  The written
+    records are also appended to the columnar store if it is enabled and
+    `columnar` is set (see `stocklab.columnar`), once they are committed.
+
+    Without either option, the records of the keys already existing in a
+    table with the unique index of keys are dropped, with a warning.
+
+    If it fails, the writes of this call are undone (with a savepoint, only
+    on SQLite), the earlier writes of the session are left to the
+    outermost `get_db` context.
+    """
+    self._check_writable(node.name)
     assert type(res) is list
     assert all([type(rec) is dict for rec in res])
     schema = node.schema
@@ -85,38 +480,206 @@ class get_db(pydal.DAL, ContextDecorator):
     update_existed = node.update_existed
     assert not (ignore_existed and update_existed)
 
-    def _proc(key, val):
-      cfg = schema[key]
-      field_type = cfg['type'] if 'type' in cfg else 'string'
-      type_map = {
-          'string': str,
-          'text': str,
-          'integer': int,
-          }
-      processed = cfg['pre_proc'](val) if 'pre_proc' in cfg else val
-      if field_type in type_map.keys() and processed is not None:
-        assert type(processed) is type_map[field_type], 'type error in DB insertion.' +\
-            f' Field {key} requires {field_type}, got {type(processed)}'
-      return processed
+    table = self[node.name]
+    convert = _get_converter(node.name, schema)
+    records = [convert(rec) for rec in res]
+    changed = records
+    upsert = False
+    self._dirty = True
+    with self._savepoint():
+      if ignore_existed or update_existed:
+        key_fields = _get_keys(schema)
+        assert len(key_fields) > 0
+        by_key = {}
+        for rec in records:
+          key = tuple(rec.get(k) for k in key_fields)
+          if ignore_existed:
+            by_key.setdefault(key, rec)
+          else:
+            by_key[key] = rec
+        existed = self._existed_keys(table, key_fields, by_key.keys())
+        records = [rec for key, rec in by_key.items() if key not in existed]
+        changed = list(by_key.values()) if update_existed else records
+        if update_existed and existed:
+          upsert = self._can_upsert(table, schema)
+          if upsert: # `_bulk_insert` updates the existing ones
+            records = changed
+          else:
+            for key in existed:
+              query = _and([table[k] == v for k, v in zip(key_fields, key)])
+              self(query).update(**by_key[key])
+          invalidate(node, [by_key[key] for key in existed])
+      # Without the options, the records of existing keys are ignored
+      conflict = upsert or not (ignore_existed or update_existed) and \
+          node.name in self._unique_keys
+      if conflict and not upsert:
+        # Only the records inserted refresh the views and are appended to
+        # the columnar store
+        key_fields = _get_keys(schema)
+        by_key = {}
+        for rec in records:
+          by_key.setdefault(tuple(rec.get(k) for k in key_fields), rec)
+        existed = self._existed_keys(table, key_fields, by_key.keys())
+        changed = [rec for key, rec in by_key.items() if key not in existed]
+        if len(changed) < len(records):
+          self.logger.warning('Ignored %d records of %s with existing keys '
+              '(see `ignore_existed` and `update_existed`).',
+              len(records) - len(changed), node.name)
+        records = changed
+      self._bulk_insert(table, schema, records,
+          _get_keys(schema) if conflict else None, update=upsert)
+      if changed:
+        refresh_views(self, node, changed)
+      if changed and columnar and self.columnar is not None:
+        pending = self._columnar_pending.setdefault(node.name, [node, []])
+        pending[1] += changed
 
-    def _key_q(schema):
-      key_fields = _get_keys(schema)
-      queries = [table[k] == v for k, v in rec.items() if k in key_fields]
-      assert len(key_fields) > 0
-      def _and(qs):
-        if len(qs) == 1:
-          return qs[0]
-        else:
-          return qs[0] & _and(qs[1:])
-      return _and(queries)
+  @contextmanager
+  def _savepoint(self):
+    """Undo the writes within this context if it fails, only on SQLite."""
+    if self._adapter.dbengine != 'sqlite':
+      yield
+      return
+    if not self._adapter.connection.in_transaction:
+      # As the implicit one, otherwise the savepoint begins a deferred one
+      level = self._adapter.connection.isolation_level or ''
+      self.executesql(f'BEGIN {level};')
+    self.executesql('SAVEPOINT stocklab_update;')
+    try:
+      yield
+    except BaseException:
+      self.executesql('ROLLBACK TO stocklab_update;')
+      self.executesql('RELEASE stocklab_update;')
+      raise
+    self.executesql('RELEASE stocklab_update;')
 
-    table = self[node.name]
-    for rec in res:
-      rec = {k:_proc(k, v) for k, v in rec.items()}
-      if ignore_existed:
-        if not self[node.name](_key_q(schema)):
-          self[node.name].insert(**rec)
-      elif update_existed:
-        self[node.name].update_or_insert(_key_q(schema), **rec)
-      else:
-        self[node.name].insert(**rec)
+  def _check_writable(self, name):
+    if self.read_only:
+      raise ReadOnlyError('The database is opened read-only, cannot write:',
+          name)
+
+  def is_missing(self, node_name, trigger):
+    """
+    :returns: True if the crawler of `node_name` was known to have no data
+        for `trigger` (a `CrawlerTrigger`), and the marker is not expired.
+    """
+    self.declare_table(_MISSING_TABLE, _MISSING_SCHEMA)
+    table = self[_MISSING_TABLE]
+    query = (table.node == node_name) & (table.trigger == trigger.key())
+    query &= table.expires > time.time()
+    try:
+      return not self(query).isempty()
+    except self._adapter.driver.OperationalError:
+      if not self.read_only: # the table may not be created by writers yet
+        raise
+      return False
+
+  def mark_missing(self, node_name, triggers, ttl):
+    """
+    Record that the crawler of `node_name` has no data for `triggers`, see
+    `is_missing`.  The markers expire after `ttl` seconds.
+    """
+    if self.read_only:
+      return
+    self.declare_table(_MISSING_TABLE, _MISSING_SCHEMA)
+    table = self[_MISSING_TABLE]
+    expires = time.time() + ttl
+    self._dirty = True
+    for t in triggers:
+      table.update_or_insert(
+          (table.node == node_name) & (table.trigger == t.key()),
+          node=node_name, trigger=t.key(), expires=expires)
+
+  def _existed_keys(self, table, key_fields, keys):
+    """Returns the subset of `keys` already exist in `table`."""
+    keys = list(keys)
+    fields = [table[k] for k in key_fields]
+    existed = set()
+    chunk_size = _MAX_SQL_VARS // len(key_fields)
+    for i in range(0, len(keys), chunk_size):
+      chunk = keys[i:i + chunk_size]
+      if len(fields) == 1:
+        query = fields[0].belongs({key[0] for key in chunk})
+      else: # not the product of the values of each field
+        query = self._keys_query(fields, chunk)
+      for row in self(query).select(*fields):
+        existed.add(tuple(row[k] for k in key_fields))
+    return existed.intersection(keys)
+
+  def _keys_query(self, fields, keys):
+    """
+    Returns the SQL condition matching the row values of `fields` to any of
+    `keys`, the values are written as literals.
+    """
+    represent = self._adapter.represent
+    rows = ', '.join('({})'.format(', '.join(represent(v, f.type)
+      for f, v in zip(fields, key))) for key in keys)
+    if self._adapter.dbengine == 'sqlite':
+      # The subquery is searched in the key index, unlike a plain `VALUES`
+      columns = ', '.join(f.sqlsafe for f in fields)
+      return f'({columns}) IN (SELECT * FROM (VALUES {rows}))'
+    names = ', '.join(f'c{i}' for i in range(len(fields)))
+    match = ' AND '.join(f'{f.sqlsafe} = v.c{i}' for i, f in enumerate(fields))
+    return f'EXISTS (SELECT 1 FROM (VALUES {rows}) AS v({names}) ' \
+        f'WHERE {match})'
+
+  def _is_raw(self, table, schema):
+    """
+    Returns True if the records of `table` can be inserted without pyDAL's
+    representation of the values.
+    """
+    return all(schema[k].get('type', 'string') in _RAW_TYPES
+        and not table[k].compute for k in schema)
+
+  def _can_upsert(self, table, schema):
+    """Returns True if `_bulk_insert` can update the existing keys."""
+    return self._adapter.dbengine == 'sqlite' and \
+        table._tablename in self._unique_keys and self._is_raw(table, schema)
+
+  def _bulk_insert(self, table, schema, records, conflict_keys=None,
+      update=False):
+    """
+    Insert `records` with one `executemany` per distinct set of columns,
+    the fields not in a record are set to their `default`.  Fall back to
+    pyDAL's `bulk_insert` for the field types that require pyDAL's
+    representation.  If `conflict_keys` (the key fields) is given, the
+    records of the keys already existing are written over the existing ones
+    if `update` is set (see `_can_upsert`), otherwise they are ignored on
+    SQLite, e.g. written by another process after `update` filtered them.
+    """
+    raw = self._is_raw(table, schema)
+    if not (raw and self._adapter.dbengine == 'sqlite'):
+      assert not update
+      conflict_keys = None
+    if not raw:
+      table.bulk_insert(records)
+      return
+    defaults = {k: table[k].default for k in schema
+        if table[k].default is not None}
+    def _default(k):
+      val = defaults[k]
+      return val() if callable(val) else val
+    groups = {}
+    for rec in records:
+      groups.setdefault(tuple(rec.keys()), []).append(tuple(rec.values()))
+    for cols, values in groups.items():
+      filled = [k for k in defaults if k not in cols]
+      if filled:
+        values = [row + tuple(_default(k) for k in filled) for row in values]
+      sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table._rname,
+          ', '.join(table[c]._rname for c in cols + tuple(filled)),
+          ', '.join('?' for _ in cols + tuple(filled)))
+      if conflict_keys:
+        sql += ' ON CONFLICT ({}) DO '.format(
+            ', '.join(table[k]._rname for k in conflict_keys))
+        updated = [table[c]._rname for c in cols if c not in conflict_keys]
+        if update and updated:
+          sql += 'UPDATE SET ' + ', '.join(f'{c} = excluded.{c}'
+              for c in updated)
+        else:
+          sql += 'NOTHING'
+      cursor = self._adapter.connection.cursor()
+      executemany = cursor.executemany
+      if self._retries:
+        executemany = _retry_locked(executemany, self, self._retries)
+      executemany(sql + ';', values)
@@ -0,0 +1,207 @@
+""" This module provides the write-behind mode of crawling.  It is enabled by
+    the `write_behind` option of the database configuration::
+
+        database:
+          type: sqlite
+          filename: db.sqlite
+          write_behind:
+            max_pending: 100000 # crawlers wait if more records are pending
+            batch_size: 10000 # records written per commit
+
+    The crawled records are queued instead of written by the crawling
+    thread, a background thread writes them with `get_db.update` in
+    batches.  Until written, the records are kept in memory: a `DataNode`
+    with `from_record` evaluates the crawled DataIdentifiers from them
+    directly, the other evaluations of the node wait for its pending records
+    to be written first.  The pending records are written when the process
+    exits, or by `flush`.
+
+    If a batch fails to be written, the cached results evaluated from its
+    records are invalidated, and the error is raised by the next `put`,
+    `flush` or evaluation of the same node.
+"""
+import atexit
+import threading
+
+from .core import deps
+from .core.config import get_config
+
+__writer = None
+__lock = threading.Lock()
+
+def _reset():
+    """
+    This is only used for testing.  To get a fresh session, we should
+    reset `config`, `bundle` and `logger` modules by calling their `reset()`.
+    """
+    global __writer
+    with __lock:
+        writer, __writer = __writer, None
+    if writer is not None:
+        writer.close()
+
+def get_writer():
+    """
+    Returns the `WriteBehind` writer, or None if the write-behind mode is not
+    enabled.
+    """
+    global __writer
+    if __writer is None:
+        cfg = (get_config('database') or {}).get('write_behind')
+        if not cfg:
+            return None
+        with __lock:
+            if __writer is None:
+                cfg = cfg if isinstance(cfg, dict) else {}
+                __writer = WriteBehind(**cfg)
+    return __writer
+
+def flush(timeout=None):
+    """Wait for the pending records to be written, if write-behind is on."""
+    if __writer is not None:
+        __writer.flush(timeout=timeout)
+
+class WriteBehind:
+    """
+    A queue of crawled records written by a background thread.
+
+    :param max_pending: The maximum number of records pending, `put` blocks
+        until the writer catches up, defaults to 100000.
+    :type max_pending: int
+    :param batch_size: The maximum number of records written per commit,
+        defaults to 10000.
+    :type batch_size: int
+    """
+    def __init__(self, max_pending=100000, batch_size=10000):
+        super().__init__()
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._queue = [] # [node, records, paths]
+        self._pending = {} # node name -> number of records
+        self._overlay = {} # node name -> {path: record}
+        self._errors = {} # node name -> [error, paths of the failed records]
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                name='stocklab-write-behind')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, node, records, paths):
+        """
+        Queue `records` of `node`.  Blocks while `max_pending` records are
+        pending.
+
+        :param paths: The DataIdentifier of each record (None if it is not
+            evaluated from a single record), see `DataNode.key_map`.
+        :type paths: list
+        """
+        with self._cond:
+            self.check(node.name)
+            assert not self._closed, 'The writer was closed.'
+            while self._total() >= self.max_pending and self._queue:
+                self._cond.wait()
+                self.check(node.name)
+            overlay = self._overlay.setdefault(node.name, {})
+            for path, rec in zip(paths, records):
+                if path is not None:
+                    overlay[path] = rec
+            self._queue.append([node, list(records), list(paths)])
+            self._pending[node.name] = \
+                    self._pending.get(node.name, 0) + len(records)
+            self._cond.notify_all()
+
+    def lookup(self, node_name, path):
+        """Returns the pending record of `path`, or None."""
+        overlay = self._overlay.get(node_name)
+        return None if overlay is None else overlay.get(path)
+
+    def is_pending(self, node_name):
+        """Returns True if any record of `node_name` is not yet written."""
+        return self._pending.get(node_name, 0) > 0
+
+    def check(self, node_name=None):
+        """
+        Raise the error of writing the records of `node_name` (of any node
+        if not given), if a batch failed since the last check.
+        """
+        with self._cond:
+            if node_name is None:
+                node_name = next(iter(self._errors), None)
+            failed = self._errors.pop(node_name, None)
+        if failed is not None:
+            error, paths = failed
+            # Results may have been cached after the failure was handled
+            deps.invalidate(paths)
+            raise error
+
+    def flush(self, node_name=None, timeout=None):
+        """
+        Wait until the pending records (of `node_name` if given) are
+        written, then raise the error of writing them if any, see `check`.
+
+        :returns: False if timed out.
+        """
+        def _done():
+            if node_name is None:
+                return self._total() == 0
+            return not self.is_pending(node_name)
+        with self._cond:
+            done = self._cond.wait_for(_done, timeout)
+        self.check(node_name)
+        return done
+
+    def close(self):
+        """Write the pending records and stop the writer thread."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+        self.check()
+
+    def _total(self):
+        return sum(self._pending.values())
+
+    def _take(self):
+        """Take up to `batch_size` records of the first queued node."""
+        node, records, paths = self._queue[0]
+        if len(records) <= self.batch_size:
+            self._queue.pop(0)
+            return node, records, paths
+        size = self.batch_size
+        self._queue[0][1:] = records[size:], paths[size:]
+        return node, records[:size], paths[:size]
+
+    def _run(self):
+        from .db import get_db, close_db
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    break
+                node, records, paths = self._take()
+            error = None
+            try:
+                with get_db('database') as db:
+                    db.declare_table(node.name, node.schema)
+                    node._update_chunk(db, records)
+            except Exception as e:
+                node.logger.error('Failed to write %d records of %s: %s',
+                        len(records), node.name, e)
+                error = e
+            with self._cond:
+                overlay = self._overlay[node.name]
+                for path, rec in zip(paths, records):
+                    if path is not None and overlay.get(path) is rec:
+                        del overlay[path]
+                self._pending[node.name] -= len(records)
+                if error is not None:
+                    failed = self._errors.setdefault(node.name, [error, []])
+                    failed[1] += [path for path in paths if path is not None]
+                self._cond.notify_all()
+            if error is not None: # the served results are not stored
+                deps.invalidate([path for path in paths if path is not None])
+        close_db()
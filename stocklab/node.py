@@ -1,6 +1,13 @@
-from .core.node import Node, Arg, Args
+import asyncio
+
+from .core import aio, trace, bundle, deps
+from .core.node import Node, Arg, Args, batch_scope, get_cache, set_cache
+from .core.node import flush_cache
+from .core.node import MissingData, plan_scope, record_triggers
 from .core.config import get_config
-from .core.crawler import CrawlerTrigger
+from .core.crawler import CrawlerTrigger, get_merging_rules, merge_triggers
+from .core.error import NoLongerAvailable
+from . import ingest
 
 class DataNode(Node):
     """
@@ -14,12 +21,35 @@ class DataNode(Node):
     *  update_existed: The key of a new record may be existed in the
         database. Keep the new record if the key duplicates. (defaults to:
         False)
+    *  missing_ttl: The seconds to remember that the crawler has no data
+        for a `CrawlerTrigger` (e.g. a holiday or a delisted stock), the
+        crawler will not be called for it again within the period. Set to 0
+        to always call the crawler. (defaults to: the `missing_ttl`
+        configuration, or 86400)
+    *  key_map: Maps a record in the table to the fields of the
+        DataIdentifier evaluated from it, so the cached results depending
+        on an overwritten record are invalidated (see `invalidate`).  Either
+        a `dict` from field names to column names, e.g. `{'date_idx':
+        'date'}`, or a function returning the fields of a record.  Fields
+        not in the `dict` are taken from the columns of the same names.
+        (defaults to: {})
+    *  ingest_chunk_size: The number of records written and committed at
+        once, if `crawler_entry` returns an iterator (e.g. a generator
+        paging through the source) instead of a `list`. (defaults to: 10000)
+    *  from_record: (Optional) A function evaluating the result from a
+        crawled record, e.g. `lambda rec: rec['price']`.  In the
+        write-behind mode (see `stocklab.ingest`), the crawled
+        DataIdentifiers are evaluated by it without waiting for the records
+        to be written.
     """
     def __init__(self):
         super().__init__()
         self.db = None
         self.default_attr('ignore_existed', False)
         self.default_attr('update_existed', False)
+        self.default_attr('missing_ttl', None)
+        self.default_attr('key_map', {})
+        self.default_attr('ingest_chunk_size', 10000)
 
     def _resolve(self, **kwargs):
         # TODO: explain this if-condition
@@ -28,12 +58,210 @@ class DataNode(Node):
         else:
             return self._resolve_with_db(**kwargs)
 
+    async def _aresolve(self, **kwargs):
+        if not hasattr(self, 'schema'):
+            return await super()._aresolve(**kwargs)
+        else:
+            return await self._aresolve_with_db(**kwargs)
+
+    def _bind_db(self):
+        """Make `self.db` refer to the database session of each thread."""
+        if self.db is None:
+            from .db import SessionProxy
+            self.db = SessionProxy('database')
+
+    def batch(self, fields_list):
+        """
+        Same as `Node.batch`, but the missing data of the whole batch is
+        collected first and crawled with merged `CrawlerTrigger`s (see
+        `stocklab.crawler.coalesce`).
+        """
+        with batch_scope() as memo:
+            if hasattr(self, 'schema'):
+                fields_list = [self.type_normalization(dict(fields))
+                        for fields in fields_list]
+                self._require([self.path(**fields) for fields in fields_list],
+                        fields_list)
+                self._prefetch(fields_list, memo)
+            return super().batch(fields_list)
+
+    def _prefetch(self, fields_list, memo):
+        from .db import get_db
+        triggers = []
+        self._bind_db()
+        with get_db('database') as db:
+            db.declare_table(self.name, self.schema)
+            self._wait_pending(db)
+            for fields in fields_list:
+                fields = self.type_normalization(dict(fields))
+                path = self.path(**fields)
+                if path in memo or get_cache(path) is not None:
+                    continue
+                try:
+                    memo[path] = type(self).evaluate(**fields)
+                    set_cache(path, memo[path])
+                except CrawlerTrigger as t:
+                    triggers.append(t)
+            if triggers:
+                self.logger.info('%d entries of the batch do not exist in '
+                        'DB, crawling...', len(triggers))
+                self._crawl(db, triggers)
+
+    def _merge_triggers(self, triggers):
+        if get_config('force_offline') == True:
+            raise NoLongerAvailable('Please unset ' +\
+                    'force_offline option to enable crawlers')
+        rules = get_merging_rules(type(self).crawler_entry)
+        if rules:
+            triggers = merge_triggers(triggers, rules)
+        return triggers
+
+    def _ttl(self):
+        if self.missing_ttl is not None:
+            return self.missing_ttl
+        ttl = get_config('missing_ttl')
+        return 86400 if ttl is None else ttl
+
+    def _known_missing(self, db, triggers):
+        """Returns the triggers known to have no data, see `missing_ttl`."""
+        if not self._ttl():
+            return []
+        return [t for t in triggers if db.is_missing(self.name, t)]
+
+    def _mark_missing(self, db, triggers):
+        if self._ttl():
+            db.mark_missing(self.name, triggers, self._ttl())
+
+    def _unavailable(self, t):
+        return NoLongerAvailable(f'{self.name} has no data for {t.kwargs}, '
+                f'retry after the marker expires (missing_ttl={self._ttl()})')
+
+    def _crawl(self, db, triggers):
+        known = self._known_missing(db, triggers)
+        triggers = [t for t in triggers if t not in known]
+        if not triggers:
+            return
+        record_triggers(self.name, triggers)
+        crawler_entry = type(self).crawler_entry
+        for t in self._merge_triggers(triggers):
+            try:
+                self._update(db, aio.call_entry(crawler_entry, t.kwargs))
+            except NoLongerAvailable:
+                if len(triggers) == 1:
+                    self._mark_missing(db, triggers)
+                raise
+
+    async def _acrawl(self, triggers):
+        known = await aio.run_in_executor(self._with_db, self._known_missing,
+                triggers)
+        triggers = [t for t in triggers if t not in known]
+        if not triggers:
+            return
+        record_triggers(self.name, triggers)
+        crawler_entry = type(self).crawler_entry
+        merged = self._merge_triggers(triggers)
+        try:
+            results = await asyncio.gather(*[
+                aio.acall_entry(crawler_entry, t.kwargs) for t in merged])
+            for res in results:
+                if hasattr(res, '__aiter__'):
+                    await self._aupdate(res)
+                    continue
+                await aio.run_in_executor(self._with_db, self._update, res)
+        except NoLongerAvailable:
+            if len(triggers) == 1:
+                await aio.run_in_executor(self._with_db, self._mark_missing,
+                        triggers)
+            raise
+
+    def _with_db(self, func, *args):
+        """
+        Call `func(db, *args)` in a `get_db` context with the table declared,
+        the asynchronous methods run it in the default executor, so the
+        queries do not block the event loop.
+        """
+        from .db import get_db
+        with get_db('database') as db:
+            db.declare_table(self.name, self.schema)
+            return func(db, *args)
+
+    def _update(self, db, res):
+        """
+        Write the crawled records `res` to the database, or queue them in
+        the write-behind mode (see `stocklab.ingest`).  `res` can also be an
+        iterator or an asynchronous iterator, the records are written and
+        committed in chunks of `ingest_chunk_size`, so the chunks written
+        are kept even if the iteration fails.
+
+        :returns: The number of records written.
+        """
+        if isinstance(res, list):
+            self._write(db, res)
+            return len(res)
+        if hasattr(res, '__aiter__'):
+            res = aio.iter_sync(res)
+        count = 0
+        for chunk in _chunks(res, self.ingest_chunk_size):
+            self._write(db, chunk)
+            db.checkpoint()
+            count += len(chunk)
+        return count
+
+    async def _aupdate(self, res):
+        """Same as `_update`, for asynchronous iterators."""
+        count = 0
+        chunk = []
+        async for rec in res:
+            chunk.append(rec)
+            if len(chunk) >= self.ingest_chunk_size:
+                await aio.run_in_executor(self._with_db, self._write, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            await aio.run_in_executor(self._with_db, self._write, chunk)
+            count += len(chunk)
+        return count
+
+    def _write(self, db, records):
+        writer = ingest.get_writer()
+        if writer is None:
+            return self._update_chunk(db, records)
+        writer.put(self, records, [_record_path(self, rec) for rec in records])
+
+    def _from_pending(self, path):
+        """
+        Returns the result evaluated by `from_record` from the record of
+        `path` pending in the write-behind queue, or None.
+        """
+        from_record = getattr(type(self), 'from_record', None)
+        writer = ingest.get_writer()
+        if from_record is None or writer is None:
+            return None
+        rec = writer.lookup(self.name, path)
+        return None if rec is None else from_record(rec)
+
+    def _wait_pending(self, db):
+        """Wait for the pending records of this node to be written."""
+        writer = ingest.get_writer()
+        if writer is None:
+            return
+        if writer.is_pending(self.name):
+            db.checkpoint() # do not block the writer
+            writer.flush(self.name)
+        writer.check(self.name)
+
+    def _update_chunk(self, db, records):
+        if trace.active is None:
+            return db.update(self, records)
+        with trace.active.span(self.name, 'db.update', records=len(records)):
+            return db.update(self, records)
+
     def _resolve_with_db(self, **kwargs):
         retval = None
         from .db import get_db
         # TODO: refactor STARTS
+        self._bind_db()
         with get_db('database') as db:
-            self.db = db
             if hasattr(self, 'schema'):
                 db.declare_table(self.name, self.schema)
             if hasattr(self, 'db_dependencies'):
@@ -42,19 +270,513 @@ class DataNode(Node):
             if not hasattr(self, 'schema'):
                 retval = type(self).evaluate(**kwargs)
 
+            crawled = set()
             while retval is None:
+                retval = self._from_pending(self.path(**kwargs))
+                if retval is not None:
+                    break
+                self._wait_pending(db)
                 try:
                     retval = type(self).evaluate(**kwargs)
                 except CrawlerTrigger as t:
+                    if t.key() in crawled: # the crawler gave nothing for it
+                        self._mark_missing(db, [t])
+                        raise self._unavailable(t)
+                    if self._known_missing(db, [t]):
+                        raise self._unavailable(t)
+                    crawled.add(t.key())
                     path = self.path(**kwargs)
-                    self.logger.info(f'{path} does not exist in DB, crawling...')
-                    if get_config('force_offline') == True:
-                        raise NoLongerAvailable('Please unset' +\
-                                'force_offline option to enable crawlers')
-                    db.update(self, type(self).crawler_entry(**t.kwargs))
+                    self.logger.info('%s does not exist in DB, crawling...',
+                            path)
+                    self._crawl(db, [t])
         # TODO: refactor ENDS
-        self.db = None
         return retval
 
+    async def _aresolve_with_db(self, **kwargs):
+        self._bind_db()
+        crawled = set()
+        path = self.path(**kwargs)
+        while True:
+            retval = self._from_pending(path)
+            if retval is not None:
+                return retval
+            writer = ingest.get_writer()
+            if writer is not None:
+                if writer.is_pending(self.name):
+                    await aio.run_in_executor(writer.flush, self.name)
+                writer.check(self.name)
+            retval, trigger = await aio.run_in_executor(self._with_db,
+                    self._evaluate_in_db, kwargs, crawled)
+            if trigger is None:
+                return retval
+            crawled.add(trigger.key())
+            self.logger.info('%s does not exist in DB, crawling...', path)
+            await self._acrawl([trigger])
+
+    def _evaluate_in_db(self, db, kwargs, crawled):
+        """
+        Returns a tuple `(retval, trigger)`, the `CrawlerTrigger` raised by
+        `evaluate` is returned if it was not crawled before.
+        """
+        try:
+            return type(self).evaluate(**kwargs), None
+        except CrawlerTrigger as t:
+            trigger = t
+        if trigger.key() in crawled: # the crawler gave nothing for it
+            self._mark_missing(db, [trigger])
+            raise self._unavailable(trigger)
+        if self._known_missing(db, [trigger]):
+            raise self._unavailable(trigger)
+        return None, trigger
+
+class Plan:
+    """
+    The data missing from the database for evaluating some DataIdentifiers,
+    see `stocklab.plan`.  The data can be crawled in parallel before the
+    evaluation, for example::
+
+        plan = stocklab.plan(di_strs)
+        while plan.triggers:
+            plan.crawl()
+            plan = stocklab.plan(di_strs) # the crawled data may reveal more
+        results = stocklab.eval_many(di_strs)
+
+    Attributes:
+
+    *  triggers: Mapping from node names to the `CrawlerTrigger`s recorded,
+        before merging.
+    *  missing: The DataIdentifiers requiring the missing data.
+    *  unavailable: The DataIdentifiers requiring data known to be not
+        available (see `DataNode.missing_ttl`), they are not crawled.
+    """
+    def __init__(self, triggers, missing, unavailable=None):
+        super().__init__()
+        self.triggers = triggers
+        self.missing = missing
+        self.unavailable = unavailable or []
+
+    def crawl(self, max_workers=None):
+        """
+        Call the crawlers for the merged triggers (see
+        `stocklab.crawler.coalesce`) concurrently, and write the results to
+        the database.  The triggers of nodes without a `schema` are not
+        crawled, they are evaluated with their crawlers as usual.  The
+        triggers given nothing by the crawlers are marked as missing (see
+        `DataNode.missing_ttl`), so the next plan will not include them.
+
+        :param max_workers: The number of threads calling crawlers, defaults
+            to the number of merged triggers.
+        :type max_workers: int
+        :returns: The number of crawler calls.
+        """
+        import concurrent.futures as futures
+        from .db import get_db
+        calls = []
+        for node_name, triggers in self.triggers.items():
+            node = bundle.get_node(node_name)
+            if isinstance(node, DataNode) and hasattr(node, 'schema'):
+                calls += [(node, t, triggers)
+                        for t in node._merge_triggers(triggers)]
+        if not calls:
+            return 0
+        def _call(call):
+            try:
+                return aio.call_entry(
+                        type(call[0]).crawler_entry, call[1].kwargs)
+            except NoLongerAvailable:
+                return None
+        with futures.ThreadPoolExecutor(
+                max_workers=max_workers or len(calls)) as pool:
+            results = list(pool.map(_call, calls))
+        with get_db('database') as db:
+            for (node, merged, triggers), res in zip(calls, results):
+                db.declare_table(node.name, node.schema)
+                try:
+                    count = 0 if res is None else node._update(db, res)
+                except NoLongerAvailable: # raised by an iterator
+                    count = 0
+                if not count:
+                    node._mark_missing(db, [t for t in triggers
+                        if _covers(merged, t)])
+        return len(calls)
+
+def _chunks(iterable, size):
+    chunk = []
+    for rec in iterable:
+        chunk.append(rec)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _covers(merged, trigger):
+    """Returns True if `trigger` was merged into `merged`."""
+    for k, v in trigger.kwargs.items():
+        m = merged.kwargs.get(k)
+        if m != v and not (isinstance(m, (range, list)) and v in m):
+            return False
+    return True
+
+def plan(dis):
+    """
+    Evaluate DataIdentifiers against the database only, see
+    `stocklab.plan`.
+    """
+    missing = []
+    unavailable = []
+    with plan_scope() as recorded, batch_scope():
+        for di in dis:
+            try:
+                di.node(di)
+            except MissingData:
+                missing.append(di)
+            except NoLongerAvailable:
+                unavailable.append(di)
+    return Plan({node_name: list(triggers.values())
+        for node_name, triggers in recorded.items()}, missing, unavailable)
+
+class SeriesNode(Node):
+    """
+    Nodes evaluated over a range of one field (the `axis`) at once.  The
+    `evaluate` function receives the axis field as a `range` and returns a
+    sequence, typically a NumPy array, with one element per axis value.  For
+    example, a vectorized moving average of a series node `Price`::
+
+        class MovingAverage(SeriesNode):
+            axis = 'date_idx'
+            args = Args(
+                    date_idx = Arg(type=int),
+                    stock = Arg(),
+                    window = Arg(type=int),
+                    )
+
+            def evaluate(date_idx, stock, window):
+                prices = DI('Price')(stock=stock, date_idx=range(
+                    date_idx.start - window + 1, date_idx.stop))
+                csum = numpy.cumsum(numpy.concatenate([[0], prices]))
+                return (csum[window:] - csum[:-window]) / window
+
+    The series are evaluated and cached in chunks of `chunk_size` aligned
+    axis values.  A range of the axis is written as `<start>to<stop>` (the
+    stop is excluded), e.g.
+    `MovingAverage.stock:acme.date_idx:750to1000.window:5`.  The chunks
+    within a requested range are evaluated as a whole, while the partial
+    chunks at its ends are evaluated only for the requested values.
+    A DataIdentifier with a single axis value is sliced from its chunk if
+    the chunk was evaluated, otherwise only the value itself is evaluated.
+    Therefore the values beyond the request (e.g. of the future dates) are
+    never required.
+
+    A `DataNode` can also be a series node, fetching a range of a column
+    with one query by `select_column`, and crawling only the values not
+    found (see `missing_range`)::
+
+        class PriceSeries(SeriesNode, DataNode):
+            axis = 'date_idx'
+            ...
+
+            def evaluate(date_idx, stock):
+                prices = select_column(PriceSeries, 'price',
+                        date_idx=date_idx, stock=stock)
+                missing = missing_range(prices, date_idx)
+                if missing is not None:
+                    raise CrawlerTrigger(start=missing.start,
+                            stop=missing.stop, stock=stock)
+                return numpy.array(prices)
+
+    Attributes:
+
+    *  axis: The name of the range-capable field, it must be declared with
+        `Arg(type=int)`.
+    *  chunk_size: The number of axis values evaluated at once. (defaults
+        to: 256)
+    """
+    def __init__(self):
+        super().__init__()
+        self.default_attr('chunk_size', 256)
+        assert self.args[self.axis].type is int, \
+                f'Axis {self.axis} should be an integer field.'
+
+    def path(self, **kwargs):
+        axis_val = kwargs.get(self.axis)
+        if isinstance(axis_val, range):
+            kwargs[self.axis] = f'{axis_val.start}to{axis_val.stop}'
+        return super().path(**kwargs)
+
+    def type_normalization(self, kwargs, partial=False):
+        axis_val = kwargs.get(self.axis)
+        if isinstance(axis_val, str) and 'to' in axis_val:
+            start, stop = axis_val.split('to')
+            axis_val = range(int(start), int(stop))
+        if not isinstance(axis_val, range):
+            return super().type_normalization(kwargs, partial)
+        assert axis_val.step == 1 and len(axis_val) > 0, \
+                f'Invalid range for {self.axis}: {axis_val}'
+        del kwargs[self.axis]
+        kwargs = super().type_normalization(kwargs, partial=True)
+        assert partial or len(kwargs) + 1 == len(self.args), \
+                f'Invalid fields: {kwargs}'
+        kwargs[self.axis] = axis_val
+        return kwargs
+
+    def _resolve(self, **kwargs):
+        axis_val = kwargs[self.axis]
+        if not isinstance(axis_val, range):
+            return self._slice(kwargs, range(axis_val, axis_val + 1))[0]
+        size = self.chunk_size
+        first, last = axis_val.start // size, (axis_val.stop - 1) // size
+        if first == last:
+            return self._slice(kwargs, axis_val)
+        parts = []
+        for idx in range(first, last + 1):
+            part = range(max(axis_val.start, idx * size),
+                    min(axis_val.stop, (idx + 1) * size))
+            if len(part) == size:
+                fields = dict(kwargs, **{self.axis: part})
+                parts.append(self._lookup(self.path(**fields), fields))
+            else:
+                parts.append(self._slice(kwargs, part))
+        return _concat(parts)
+
+    async def _aresolve(self, **kwargs):
+        axis_val = kwargs[self.axis]
+        size = self.chunk_size
+        if isinstance(axis_val, range) and axis_val.start % size == 0 \
+                and len(axis_val) == size:
+            return await super()._aresolve(**kwargs)
+        return await aio.run_in_executor(self._resolve, **kwargs)
+
+    def _slice(self, fields, axis_range):
+        """
+        Returns the series of `axis_range` within a chunk.  It is sliced from
+        the chunk if the chunk was evaluated, otherwise only `axis_range` is
+        evaluated.
+        """
+        start = axis_range.start // self.chunk_size * self.chunk_size
+        fields = dict(fields)
+        fields[self.axis] = range(start, start + self.chunk_size)
+        chunk_path = self.path(**fields)
+        chunk = get_cache(chunk_path)
+        if chunk is not None:
+            deps.record(chunk_path)
+            return chunk[axis_range.start - start:axis_range.stop - start]
+        fields[self.axis] = axis_range
+        return super()._resolve(**fields)
+
+def select_column(node, column, **fields):
+    """
+    Select `column` of the records of a `DataNode` with one query, e.g. for
+    a series data node (see `SeriesNode`).  The fields are mapped to the
+    schema fields by `key_map` of the node, one of them is a `range`.
+
+    :param node: The node, or the name of it.
+    :type node: DataNode, str
+    :returns: A list with a value for each element of the range, None for
+        the records not found.
+    """
+    node = bundle.get_node(node if isinstance(node, str) else node.name)
+    table = node.db[node.name]
+    axis = None
+    query = []
+    for field, val in fields.items():
+        name = node.key_map.get(field, field)
+        if isinstance(val, range):
+            assert axis is None and val.step == 1, f'Invalid range: {val}'
+            axis, axis_range = name, val
+            query += [table[name] >= val.start, table[name] < val.stop]
+        else:
+            query.append(table[name] == val)
+    assert axis is not None, 'A field should be a range.'
+    rows = node.db(_and(query)).select(table[axis], table[column])
+    values = {row[axis]: row[column] for row in rows}
+    return [values.get(v) for v in axis_range]
+
+def missing_range(values, axis_range):
+    """
+    Returns the first contiguous range of `axis_range` with None in
+    `values` (e.g. from `select_column`), or None if no value is missing.
+    The other missing values are found again after it is crawled.
+    """
+    start = None
+    for axis_val, val in zip(axis_range, values):
+        if val is None and start is None:
+            start = axis_val
+        elif val is not None and start is not None:
+            return range(start, axis_val)
+    return None if start is None else range(start, axis_range.stop)
+
+class MaterializedView(Node):
+    """
+    Derived nodes with the evaluated results stored in a table, so each
+    result is evaluated once across runs.  The table has a key column for
+    each field and a `value` column for the result, it is defined by
+    `declare_table` like the tables of `DataNode`.
+
+    When new records of a source `DataNode` are written by `get_db.update`,
+    only the affected results are evaluated again and stored.  They are
+    declared by `refresh_on`, for example::
+
+        class MovingAverage(MaterializedView):
+            refresh_on = {
+                    'Price': lambda rec: [{
+                        'stock': rec['stock'],
+                        'date_idx': range(rec['date'], rec['date'] + 30),
+                        }],
+                    }
+
+    A price of day `d` affects the stored moving averages of the following
+    30 days (for all windows), the others are not evaluated again.
+
+    Attributes:
+
+    *  refresh_on: Mapping from names of source nodes to functions.  Given
+        a new record of the source, the function returns a list of fields
+        to select the affected results.  Omitted fields match any value, a
+        field can also be a `range` or a `list` of values.  Affected
+        results not yet stored are evaluated only if all fields are given
+        as single values. (defaults to: {})
+    *  value_type: The pyDAL type of the results. (defaults to: 'double')
+    """
+    def __init__(self):
+        super().__init__()
+        self.default_attr('refresh_on', {})
+        self.default_attr('value_type', 'double')
+        self.ignore_existed = False
+        self.update_existed = True
+        assert 'value' not in self.args, 'Field `value` is reserved.'
+        self.schema = Schema(value={'type': self.value_type}, **{
+            arg_name: {'type': _field_type(arg), 'key': True}
+            for arg_name, arg in self.args.items()})
+
+    def _resolve(self, **kwargs):
+        from .db import get_db
+        with get_db('database') as db:
+            db.declare_table(self.name, self.schema)
+            table = db[self.name]
+            query = _and([table[k] == v for k, v in kwargs.items()]
+                    or [table.id > 0])
+            rows = db(query).select(table.value, limitby=(0, 1))
+            if rows:
+                return rows[0].value
+            retval = super()._resolve(**kwargs)
+            db.update(self, [dict(kwargs, value=retval)])
+        return retval
+
+    async def _aresolve(self, **kwargs):
+        return await aio.run_in_executor(self._resolve, **kwargs)
+
+    def refresh(self, db, source, records):
+        """
+        Evaluate and store the results affected by `records` of `source`,
+        it is called by `get_db.update`.
+        """
+        db.declare_table(self.name, self.schema)
+        table = db[self.name]
+        affected = {}
+        for rec in records:
+            for fields in self.refresh_on[source.name](rec):
+                if len(fields) == len(self.args) and not any(
+                        isinstance(v, (range, list)) for v in fields.values()):
+                    fields = self.type_normalization(dict(fields))
+                    affected[self.path(**fields)] = fields
+                    continue
+                query = _and([_match(table[k], v) for k, v in fields.items()]
+                        or [table.id > 0])
+                key_fields = [table[k] for k in self.args]
+                for row in db(query).select(*key_fields):
+                    fields = self.type_normalization(
+                            {k: row[k] for k in self.args})
+                    affected[self.path(**fields)] = fields
+        if not affected:
+            return
+        self.logger.info('Refreshing %d results of %s', len(affected),
+                self.name)
+        results = []
+        with batch_scope():
+            for path, fields in affected.items():
+                retval = super()._resolve(**fields)
+                results.append((path, dict(fields, value=retval)))
+        db.update(self, [rec for _, rec in results])
+        for path, rec in results: # after the invalidation by `db.update`
+            set_cache(path, rec['value'])
+
+def refresh_views(db, source, records):
+    """
+    Refresh the `MaterializedView`s affected by the new `records` of
+    `source`.
+    """
+    for node in bundle.get_nodes(refresh_on=source.name):
+        if isinstance(node, MaterializedView):
+            node.refresh(db, source, records)
+
+def invalidate(source, records):
+    """
+    Invalidate the cached results of `source` evaluated from the overwritten
+    `records`, and the results depending on them (see
+    `stocklab.core.deps`).  The whole cache is flushed if the fields cannot
+    be mapped from the records, see `DataNode.key_map`.
+    """
+    if not hasattr(source, 'args'): # not evaluated as DataIdentifiers
+        return
+    paths = set()
+    for rec in records:
+        path = _record_path(source, rec)
+        if path is None:
+            source.logger.warning('Cannot map records of %s to '
+                    'DataIdentifiers (see `key_map`), flushing the cache.',
+                    source.name)
+            flush_cache()
+            return
+        paths.add(path)
+    count = deps.invalidate(paths)
+    source.logger.debug('Invalidated %d cached results', count)
+
+def _record_path(source, rec):
+    """
+    Returns the DataIdentifier of `source` evaluated from the record `rec`,
+    or None if the fields cannot be mapped, see `DataNode.key_map`.
+    """
+    key_map = getattr(source, 'key_map', {})
+    if callable(key_map):
+        fields = key_map(rec)
+    else:
+        fields = {k: rec.get(key_map.get(k, k)) for k in source.args}
+    if any(v is None for v in fields.values()):
+        return None
+    return source.path(**source.type_normalization(fields))
+
+def _field_type(arg):
+    if arg.type is int:
+        return 'integer'
+    if arg.type is float:
+        return 'double'
+    return 'string'
+
+def _match(field, val):
+    if isinstance(val, range):
+        assert val.step == 1
+        return (field >= val.start) & (field < val.stop)
+    if isinstance(val, list):
+        return field.belongs(val)
+    return field == val
+
+def _and(queries):
+    query = queries[0]
+    for q in queries[1:]:
+        query &= q
+    return query
+
+def _concat(parts):
+    if len(parts) == 1:
+        return parts[0]
+    if hasattr(parts[0], '__array__'): # NumPy arrays
+        import numpy
+        return numpy.concatenate(parts)
+    retval = []
+    for part in parts:
+        retval.extend(part)
+    return retval
+
 class Schema(dict):
     pass
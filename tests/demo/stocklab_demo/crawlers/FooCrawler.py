@@ -1,13 +1,14 @@
-from stocklab.crawler import Crawler, speed_limiter
+from stocklab.crawler import Crawler, Contiguous, speed_limiter, coalesce
 
 class FooCrawler(Crawler):
     @speed_limiter(max_speed=1)
+    @coalesce(date=Contiguous())
     def bar(date, stock_id):
         FooCrawler.logger.warning(
                 f'Crawler started. Args: date={date}, stock_id={stock_id}')
         return [{
             'stock': stock_id,
-            'date': date,
-            'price': date + 123,
+            'date': d,
+            'price': d + 123,
             'note': 'the data was given by FooCrawler'
-            }]
+            } for d in date]
@@ -1,7 +1,8 @@
 from stocklab import DataIdentifier as DI
 from stocklab.node import *
 
-class MovingAverage(Node):
+class MovingAverage(SeriesNode):
+    axis = 'date_idx'
     args = Args(
             date_idx = Arg(type=int),
             stock = Arg(),
@@ -9,6 +10,10 @@ class MovingAverage(Node):
             )
 
     def evaluate(date_idx, stock, window, **kwargs):
-        dates = range(date_idx - window + 1, date_idx + 1)
-        prices = [DI('Price')(stock=stock, date_idx=d) for d in dates]
-        return sum(prices)/len(prices)
+        dates = range(date_idx.start - window + 1, date_idx.stop)
+        prices = DI('Price').batch(
+                [{'stock': stock, 'date_idx': d} for d in dates])
+        sums = [sum(prices[:window])]
+        for i in range(window, len(prices)):
+            sums.append(sums[-1] + prices[i] - prices[i - window])
+        return [s / window for s in sums]
@@ -13,6 +13,7 @@ class Price(DataNode):
             price = {'type': 'integer'},
             note = {},
             )
+    key_map = {'date_idx': 'date'}
 
     def evaluate(date_idx, stock):
         table = Price.db[Price.name]
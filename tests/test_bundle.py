@@ -20,6 +20,49 @@ class TestBundle(StocklabTestCase):
         self.assertRaises(AssertionError, bundle.register, self.FooNode)
         bundle.register(self.FooNode, allow_overwrite=True)
 
+    def test_import_hook(self):
+        import sys
+        import importlib
+        from stocklab.core import bundle
+        from stocklab.core.runtime import Surrogate
+        bundle.register(self.FooNode)
+        self.addCleanup(sys.modules.pop, 'FooNode', None)
+        foo = importlib.import_module('FooNode')
+        self.assertIsInstance(foo, Surrogate)
+        self.assertIs(Surrogate.resolve(foo), bundle.get_node('FooNode'))
+        self.assertRaises(ImportError, importlib.import_module, 'BarNode')
+
+    def test_lazy(self):
+        import os
+        import json
+        import tempfile
+        from stocklab.core import bundle
+        from stocklab.core.config import get_config
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, 'Alpha.py'), 'w') as f:
+                f.write('from stocklab.node import *\n'
+                        'from stocklab.core.runtime import Broken\n'
+                        'class Alpha(Node):\n'
+                        '    args = Args()\n'
+                        '    dep = Broken\n'
+                        '    def evaluate():\n'
+                        '        return 1\n')
+            with open(os.path.join(path, 'Broken.py'), 'w') as f:
+                f.write('raise ImportError()\n')
+            stocklab.bundle(path)
+            self.assertEqual(stocklab.eval('Alpha'), 1)
+            self.assertRaises(ImportError, bundle.get_node, 'Broken')
+            manifest_path = os.path.join(get_config('root_dir'),
+                    bundle.MANIFEST_NAME)
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            self.assertIn(os.path.abspath(path), manifest)
+            # Not popped by the failed import
+            self.assertRaises(ImportError, bundle.get_node, 'Broken')
+        bundle._save_manifest()
+        with open(manifest_path) as f:
+            self.assertNotIn(os.path.abspath(path), json.load(f))
+
 if __name__ == '__main__':
     unittest.main()
 
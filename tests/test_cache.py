@@ -0,0 +1,91 @@
+import unittest
+
+import stocklab
+from lib import StocklabTestCase
+
+class TestCache(StocklabTestCase):
+    def test_lru(self):
+        from stocklab.core.cache import LRUCache
+        cache = LRUCache(max_entries=2, node_limits={'Foo': 1})
+        cache.set('Bar.x:1', 1)
+        cache.set('Bar.x:2', 2)
+        self.assertEqual(cache.get('Bar.x:1'), 1)
+        cache.set('Bar.x:3', 3) # 'Bar.x:2' is the least recently used
+        self.assertIsNone(cache.get('Bar.x:2'))
+        cache.set('Foo.x:1', 1)
+        cache.set('Foo.x:2', 2)
+        self.assertIsNone(cache.get('Foo.x:1'))
+        self.assertEqual(cache.get('Foo.x:2'), 2)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 3)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_node_cache(self):
+        from stocklab.core.node import cache_stats
+        stocklab.eval('Price.stock:acme.date_idx:1000')
+        stocklab.eval('Price.stock:acme.date_idx:1000')
+        stats = cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_evict_deps(self):
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle, cache, deps
+        class FooChain(Node):
+            args = Args(n = Arg(type=int))
+
+            def evaluate(n):
+                if n == 0:
+                    return 1
+                return bundle.get_node('FooChain')(n=n - 1) + 1
+
+        bundle.register(FooChain, allow_overwrite=True)
+        cache.set_backend(cache.LRUCache(max_entries=4))
+        self.assertEqual(stocklab.eval('FooChain.n:50'), 51)
+        self.assertLessEqual(len(vars(deps)['__requires']), 4)
+        self.assertLessEqual(len(vars(deps)['__dependents']), 4)
+
+    def test_shared(self):
+        import os
+        import tempfile
+        from stocklab.core.cache import SharedCache
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'shared.sqlite')
+            cache = SharedCache(path)
+            other = SharedCache(path) # as in another process
+            cache.set('Bar.x:1', [1, 2])
+            self.assertIsNone(other.get('Bar.x:1')) # not written yet
+            cache.commit()
+            self.assertEqual(other.get('Bar.x:1'), [1, 2])
+            self.assertIsNone(other.get('Bar.x:2'))
+            self.assertEqual(other.stats()['shared_hits'], 1)
+            cache.batch_size = 2
+            cache.set('Bar.x:2', 2)
+            cache.set('Bar.x:3', 3) # written in a batch
+            self.assertEqual(other.get('Bar.x:3'), 3)
+            cache.close()
+            other.close()
+
+    def test_persistent_store(self):
+        import os
+        import tempfile
+        from stocklab.core.persist import PersistentStore
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'results.sqlite')
+            store = PersistentStore(path)
+            other = PersistentStore(path) # as in another process
+            other._conn.execute('PRAGMA busy_timeout = 0')
+            store.set('Bar.x:1', 'v', [1, 2], inputs=['Foo.x:1'])
+            other.set('Bar.x:2', 'v', [3]) # not locked by `store`
+            self.assertEqual(other.get('Bar.x:1', 'v'), [1, 2])
+            self.assertEqual(store.dependents(['Foo.x:1']), {'Bar.x:1'})
+            other.discard('Bar.x:1')
+            self.assertIsNone(store.get('Bar.x:1', 'v'))
+            store.close()
+            other.close()
+
+if __name__ == '__main__':
+    unittest.main()
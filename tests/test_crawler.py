@@ -0,0 +1,114 @@
+import unittest
+
+import stocklab
+from lib import StocklabTestCase
+
+class TestCrawler(StocklabTestCase):
+    def test_merge_triggers(self):
+        from stocklab.crawler import CrawlerTrigger, Contiguous, Collect
+        from stocklab.crawler import merge_triggers
+        triggers = [CrawlerTrigger(date=d, stock_id=s)
+                for d in [1, 2, 3, 5, 2] for s in ['a', 'b']]
+        merged = merge_triggers(triggers,
+                {'date': Contiguous(max_len=2), 'stock_id': Collect()})
+        self.assertEqual(sorted([(t.kwargs['date'], t.kwargs['stock_id'])
+            for t in merged], key=lambda m: m[0].start), [
+                (range(1, 3), ['a', 'b']),
+                (range(3, 4), ['a', 'b']),
+                (range(5, 6), ['a', 'b']),
+                ])
+
+    def test_coalesce(self):
+        from stocklab.core.crawler import get_merging_rules
+        from stocklab.core import bundle
+        from stocklab.db import get_db, _MISSING_TABLE, _MISSING_SCHEMA
+        crawler = bundle.get_crawler('FooCrawler')
+        self.assertIn('date', get_merging_rules(crawler.bar))
+        with get_db('database') as db: # crawled by a previous run
+            db.declare_table('Price', bundle.get_node('Price').schema)
+            db(db.Price.stock == 'coalesced').delete()
+            db.declare_table(_MISSING_TABLE, _MISSING_SCHEMA)
+            db(db[_MISSING_TABLE].node == 'Price').delete()
+        with self.assertLogs('FooCrawler', 'WARNING') as logs:
+            self.assertEqual(stocklab.eval(
+                'MovingAverage.stock:coalesced.date_idx:1000.window:5'), 1121.0)
+        # The missing dates are crawled at once
+        self.assertEqual(logs.output, ['WARNING:FooCrawler:Crawler started. '
+            'Args: date=range(996, 1001), stock_id=coalesced'])
+
+    def test_async(self):
+        import asyncio
+        import threading
+        from stocklab.core import bundle
+        from stocklab.crawler import Crawler, concurrency_limiter
+        from stocklab.node import DataNode, Schema, Args, Arg, CrawlerTrigger
+        in_flight = []
+        db_threads = set()
+        class AsyncCrawler(Crawler):
+            @concurrency_limiter(max_concurrency=2)
+            async def fetch(key):
+                in_flight.append(key)
+                assert len(in_flight) <= 2
+                await asyncio.sleep(0.01)
+                in_flight.remove(key)
+                return [{'key': key, 'val': key * 2}]
+
+        class AsyncData(DataNode):
+            crawler_entry = AsyncCrawler.fetch
+            args = Args(key = Arg(type=int))
+            schema = Schema(
+                    key = {'type': 'integer', 'key': True},
+                    val = {'type': 'integer'},
+                    )
+            ignore_existed = True
+
+            def evaluate(key):
+                db_threads.add(threading.current_thread())
+                table = AsyncData.db[AsyncData.name]
+                retval = AsyncData.db(table.key == key).select(limitby=(0, 1))
+                if retval:
+                    return retval[0].val
+                raise CrawlerTrigger(key=key)
+
+        bundle.register(AsyncCrawler, allow_overwrite=True)
+        bundle.register(AsyncData, allow_overwrite=True)
+        from stocklab.db import get_db
+        with get_db('database') as db:
+            db.declare_table('AsyncData', AsyncData.schema)
+            db(db.AsyncData).delete()
+
+        async def _main():
+            return await asyncio.gather(*[
+                stocklab.aeval(f'AsyncData.key:{k}') for k in [1, 2, 3, 1, 4]])
+        self.assertEqual(asyncio.run(_main()), [2, 4, 6, 2, 8])
+        # The queries are not run by the event loop
+        self.assertNotIn(threading.current_thread(), db_threads)
+        self.assertEqual(stocklab.eval('AsyncData.key:5'), 10)
+
+    def test_token_bucket(self):
+        import os
+        import tempfile
+        from stocklab.crawler import TokenBucket
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Buckets of the same name share the state, as in other processes
+            path = os.path.join(tmp_dir, 'rate_limits.sqlite')
+            bucket = TokenBucket(rate=1, burst=3, name='example.com',
+                    path=path)
+            other = TokenBucket(rate=1, burst=3, name='example.com',
+                    path=path)
+            self.assertTrue(bucket.acquire(blocking=False))
+            self.assertTrue(other.acquire(blocking=False))
+            self.assertTrue(bucket.acquire(blocking=False))
+            self.assertFalse(other.acquire(blocking=False))
+            self.assertGreater(bucket.wait_time(), 0.5)
+            bucket.close()
+            other.close()
+
+    def test_tick_period(self):
+        from stocklab.crawler import speed_limiter
+        with self.assertWarns(DeprecationWarning):
+            limited = speed_limiter(100, 0.01)(lambda x: x * 2)
+        self.assertEqual(limited(3), 6)
+
+if __name__ == '__main__':
+    unittest.main()
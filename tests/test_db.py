@@ -0,0 +1,553 @@
+import asyncio
+import unittest
+
+import stocklab
+from lib import StocklabTestCase
+
+def _has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+class TestDB(StocklabTestCase):
+    def setUp(self):
+        super().setUp()
+        from stocklab.node import DataNode, Schema
+        class FooData(DataNode):
+            schema = Schema(
+                    k1 = {'key': True},
+                    k2 = {'type': 'integer', 'key': True},
+                    val = {'type': 'integer'},
+                    )
+        self.FooData = FooData
+
+    def _update(self, records, **attrs):
+        from stocklab.db import get_db
+        from stocklab.core import bundle
+        bundle.register(self.FooData, allow_overwrite=True)
+        node = bundle.get_node('FooData')
+        node.ignore_existed = False
+        node.update_existed = False
+        for k, v in attrs.items():
+            setattr(node, k, v)
+        with get_db('database') as db:
+            db.declare_table(node.name, node.schema)
+            db.update(node, records)
+            rows = db(db[node.name]).select(orderby=db[node.name].id)
+            return [(r.k1, r.k2, r.val) for r in rows]
+
+    def test_update(self):
+        from stocklab.db import get_db
+        with get_db('database') as db:
+            db.declare_table('FooData', self.FooData.schema)
+            db(db.FooData).delete()
+        recs = [{'k1': 'a', 'k2': i, 'val': i} for i in range(1000)]
+        self.assertEqual(len(self._update(recs)), 1000)
+        recs = [{'k1': 'a', 'k2': 0, 'val': 7}, {'k1': 'b', 'k2': 0, 'val': 8},
+                {'k1': 'b', 'k2': 0, 'val': 9}]
+        rows = self._update(recs, ignore_existed=True)
+        self.assertEqual(rows[0], ('a', 0, 0))
+        self.assertEqual(rows[-1], ('b', 0, 8))
+        rows = self._update(recs, update_existed=True)
+        self.assertEqual(len(rows), 1001)
+        self.assertEqual(rows[0], ('a', 0, 7))
+        self.assertEqual(rows[-1], ('b', 0, 9))
+        recs = [{'k1': 'a', 'k2': 1, 'val': 5}, {'k1': 'c', 'k2': 0, 'val': 6}]
+        with self.assertLogs(level='WARNING') as cm:
+            rows = self._update(recs)
+        self.assertIn('Ignored 1 records of FooData', cm.output[0])
+        self.assertEqual(len(rows), 1002)
+        self.assertEqual(rows[1], ('a', 1, 1))
+        self.assertEqual(rows[-1], ('c', 0, 6))
+
+    def test_update_failed(self):
+        from stocklab.db import get_db
+        from stocklab.core import bundle
+        bundle.register(self.FooData, allow_overwrite=True)
+        node = bundle.get_node('FooData')
+        node.ignore_existed = False
+        node.update_existed = True
+        with get_db('database') as db:
+            db.declare_table(node.name, node.schema)
+            db(db.FooData).delete()
+            db.update(node, [{'k1': 'a', 'k2': 0, 'val': 1}])
+            # The first record is written before the second one fails
+            self.assertRaises(OverflowError, db.update, node, [
+                {'k1': 'b', 'k2': 0, 'val': 2},
+                {'k1': 'c', 'k2': 0, 'val': 2 ** 64}])
+        with get_db('database') as db: # the earlier write is committed
+            rows = db(db.FooData).select(orderby=db.FooData.id)
+            self.assertEqual([(r.k1, r.val) for r in rows], [('a', 1)])
+
+    def test_default(self):
+        from stocklab.db import get_db
+        from stocklab.node import DataNode, Schema
+        from stocklab.core import bundle
+        class FooDefault(DataNode):
+            update_existed = True
+            schema = Schema(
+                    k1 = {'key': True},
+                    val = {'type': 'integer', 'default': 0},
+                    note = {'default': 'n/a'},
+                    )
+        bundle.register(FooDefault, allow_overwrite=True)
+        node = bundle.get_node('FooDefault')
+        with get_db('database') as db:
+            db.declare_table(node.name, node.schema)
+            db(db.FooDefault).delete()
+            db.update(node, [{'k1': 'a'}, {'k1': 'b', 'note': 'x'}])
+            db.update(node, [{'k1': 'b', 'val': 2}, {'k1': 'c', 'val': 3}])
+            rows = db(db.FooDefault).select(orderby=db.FooDefault.k1)
+            self.assertEqual([(r.k1, r.val, r.note) for r in rows],
+                    [('a', 0, 'n/a'), ('b', 2, 'x'), ('c', 3, 'n/a')])
+
+    def test_materialized_view(self):
+        from stocklab.db import get_db
+        from stocklab.node import MaterializedView, Args, Arg
+        from stocklab.core import bundle
+        from stocklab.core.node import flush_cache
+        calls = []
+        class FooView(MaterializedView):
+            args = Args(k1 = Arg(), k2 = Arg(type=int))
+            refresh_on = {
+                    'FooData': lambda rec: [{'k1': rec['k1'], 'k2': [rec['k2']]}],
+                    }
+
+            def evaluate(k1, k2):
+                calls.append((k1, k2))
+                with get_db('database') as db:
+                    table = db.FooData
+                    query = (table.k1 == k1) & (table.k2 == k2)
+                    return db(query).select(table.val)[0].val * 2.0
+
+        bundle.register(FooView, allow_overwrite=True)
+        with get_db('database') as db:
+            db.declare_table('FooData', self.FooData.schema)
+            db(db.FooData).delete()
+            db.declare_table('FooView', bundle.get_node('FooView').schema)
+            db(db.FooView).delete()
+        self._update([{'k1': 'a', 'k2': 1, 'val': 5}])
+        self.assertEqual(stocklab.eval('FooView.k1:a.k2:1'), 10.0)
+        flush_cache()
+        self.assertEqual(stocklab.eval('FooView.k1:a.k2:1'), 10.0)
+        self.assertEqual(calls, [('a', 1)])
+        self._update([{'k1': 'a', 'k2': 1, 'val': 6},
+            {'k1': 'a', 'k2': 2, 'val': 1}], update_existed=True)
+        self.assertEqual(calls, [('a', 1), ('a', 1)])
+        flush_cache()
+        self.assertEqual(stocklab.eval('FooView.k1:a.k2:1'), 12.0)
+        self.assertEqual(stocklab.eval('FooView.k1:a.k2:2'), 2.0)
+        # The records ignored with their existing keys refresh no view
+        self._update([{'k1': 'a', 'k2': 2, 'val': 7},
+            {'k1': 'a', 'k2': 3, 'val': 1}])
+        self.assertEqual(calls, [('a', 1), ('a', 1), ('a', 2)])
+
+    def test_index(self):
+        from stocklab.db import get_db, close_db
+        from stocklab.core.config import get_config
+        with get_db('database') as db:
+            db.executesql('DROP TABLE IF EXISTS FooLegacy;')
+            db.executesql('CREATE TABLE FooLegacy (id INTEGER PRIMARY KEY '
+                    'AUTOINCREMENT, k1 CHAR(512), k2 INTEGER, val INTEGER);')
+            db.executesql('INSERT INTO FooLegacy (k1, k2, val) VALUES '
+                    "('a', 1, 1), ('a', 1, 2), ('b', 1, 3);")
+            db.commit()
+            schema = dict(self.FooData.schema, val={'type': 'integer',
+                'index': True})
+            db.declare_table('FooLegacy', schema)
+            rows = db(db.FooLegacy).select(orderby=db.FooLegacy.id)
+            self.assertEqual([r.val for r in rows], [1, 2, 3])
+            indexes = {row[1]: row[2] for row in
+                    db.executesql("PRAGMA index_list('FooLegacy');")}
+            self.assertNotIn('FooLegacy__key', indexes)
+            self.assertEqual(indexes['FooLegacy__key_nonunique'], 0)
+            self.assertEqual(indexes['FooLegacy__val'], 0)
+            self.assertEqual(db.deduplicate('FooLegacy', schema), 1)
+            rows = db(db.FooLegacy).select(orderby=db.FooLegacy.id)
+            self.assertEqual([r.val for r in rows], [2, 3])
+            indexes = {row[1]: row[2] for row in
+                    db.executesql("PRAGMA index_list('FooLegacy');")}
+            self.assertEqual(indexes['FooLegacy__key'], 1)
+            self.assertNotIn('FooLegacy__key_nonunique', indexes)
+        get_config('database')['explain'] = True
+        close_db()
+        with get_db('database') as db:
+            db.declare_table('FooLegacy', schema)
+            table = db.FooLegacy
+            db((table.k1 == 'a') & (table.k2 == 1)).select()
+            self.assertEqual(db.full_scans, [])
+            db(table.k2 == 1).select()
+            self.assertEqual(len(db.full_scans), 1)
+        close_db()
+
+    def test_missing(self):
+        from stocklab.db import get_db, _MISSING_TABLE, _MISSING_SCHEMA
+        from stocklab.node import DataNode, Schema, Args, Arg, CrawlerTrigger
+        from stocklab.core import bundle
+        from stocklab.core.error import NoLongerAvailable
+        calls = []
+        def crawl(date):
+            calls.append(date)
+            if date == 8:
+                raise NoLongerAvailable('delisted')
+            return [] if date in [7, 11] else [{'date': date, 'val': date * 2}]
+        class FooHoliday(DataNode):
+            crawler_entry = crawl
+            args = Args(date = Arg(type=int))
+            schema = Schema(
+                    date = {'type': 'integer', 'key': True},
+                    val = {'type': 'integer'},
+                    )
+
+            def evaluate(date):
+                table = FooHoliday.db[FooHoliday.name]
+                rows = FooHoliday.db(table.date == date).select()
+                if rows:
+                    return rows[0].val
+                raise CrawlerTrigger(date=date)
+        bundle.register(FooHoliday)
+        with get_db('database') as db:
+            db.declare_table('FooHoliday', FooHoliday.schema)
+            db(db.FooHoliday).delete()
+            db.declare_table(_MISSING_TABLE, _MISSING_SCHEMA)
+            db(db[_MISSING_TABLE].node == 'FooHoliday').delete()
+        self.assertEqual(stocklab.eval('FooHoliday.date:1'), 2)
+        for date in [7, 7, 8, 8]:
+            with self.assertRaises(NoLongerAvailable):
+                stocklab.eval(f'FooHoliday.date:{date}')
+        self.assertEqual(calls, [1, 7, 8]) # not crawled again
+        plan = stocklab.plan(['FooHoliday.date:7', 'FooHoliday.date:9'])
+        self.assertEqual(plan.unavailable, ['FooHoliday.date:7'])
+        self.assertEqual(plan.missing, ['FooHoliday.date:9'])
+        stocklab.plan(['FooHoliday.date:11']).crawl()
+        plan = stocklab.plan(['FooHoliday.date:11'])
+        self.assertEqual((plan.triggers, plan.unavailable),
+                ({}, ['FooHoliday.date:11']))
+        bundle.get_node('FooHoliday').missing_ttl = 0
+        with self.assertRaises(NoLongerAvailable):
+            stocklab.eval('FooHoliday.date:7')
+        self.assertEqual(calls, [1, 7, 8, 11, 7])
+
+    def _register_quote(self):
+        from stocklab.db import get_db
+        from stocklab.node import Node, DataNode, Schema, Args, Arg
+        from stocklab.core import bundle
+        class FooQuote(DataNode):
+            args = Args(
+                    date_idx = Arg(type=int),
+                    stock = Arg(),
+                    )
+            schema = Schema(
+                    stock = {'key': True},
+                    date = {'type': 'integer', 'key': True},
+                    price = {'type': 'integer'},
+                    )
+            key_map = {'date_idx': 'date'}
+
+            def evaluate(date_idx, stock):
+                table = FooQuote.db[FooQuote.name]
+                query = (table.stock == stock) & (table.date == date_idx)
+                return FooQuote.db(query).select(limitby=(0, 1))[0].price
+        class FooSum(Node):
+            args = Args(
+                    date_idx = Arg(type=int),
+                    stock = Arg(),
+                    )
+
+            def evaluate(date_idx, stock):
+                quote = bundle.get_node('FooQuote')
+                return quote(date_idx=date_idx - 1, stock=stock) + \
+                        quote(date_idx=date_idx, stock=stock)
+        bundle.register(FooQuote, allow_overwrite=True)
+        bundle.register(FooSum, allow_overwrite=True)
+        quote = bundle.get_node('FooQuote')
+        with get_db('database') as db:
+            db.declare_table('FooQuote', quote.schema)
+            db(db.FooQuote).delete()
+            db.update(quote, [{'stock': stock, 'date': date, 'price': price}
+                for stock in ['acme', 'other']
+                for date, price in [(999, 1), (1000, 2)]])
+        quote.update_existed = True
+        return quote
+
+    def test_invalidate(self):
+        from stocklab.db import get_db
+        from stocklab.core.node import get_cache
+        quote = self._register_quote()
+        acme = 'FooSum.date_idx:1000.stock:acme'
+        other = 'FooSum.date_idx:1000.stock:other'
+        self.assertEqual(stocklab.eval_many([acme, other]), [3, 3])
+        with get_db('database') as db:
+            db.update(quote, [{'stock': 'acme', 'date': 999, 'price': 10}])
+        self.assertIsNone(get_cache(acme))
+        self.assertIsNone(get_cache('FooQuote.date_idx:999.stock:acme'))
+        self.assertIsNotNone(get_cache('FooQuote.date_idx:1000.stock:acme'))
+        self.assertEqual(get_cache(other), 3)
+        self.assertEqual(stocklab.eval(acme), 12)
+
+    def test_invalidate_persisted(self):
+        from stocklab.db import get_db
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle, persist
+        from stocklab.core.node import flush_cache
+        quote = self._register_quote()
+        class FooPersisted(Node):
+            persist = True
+            args = Args(window = Arg(type=int))
+
+            def evaluate(window):
+                return bundle.get_node('FooSum')(stock='acme',
+                        date_idx=1000) * window
+
+        bundle.register(FooPersisted, allow_overwrite=True)
+        path = 'FooPersisted.window:2'
+        version = bundle.get_node('FooPersisted')._persist_version
+        persist.get_store().discard(path)
+        self.assertEqual(stocklab.eval(path), 6)
+        self.assertIsNotNone(persist.get_store().get(path, version))
+        flush_cache() # the edges in memory are gone, as in a new process
+        with get_db('database') as db:
+            db.update(quote, [{'stock': 'acme', 'date': 999, 'price': 1}])
+        self.assertIsNone(persist.get_store().get(path, version))
+
+    @unittest.skipUnless(_has_pyarrow(), 'pyarrow is not installed')
+    def test_columnar(self):
+        import os
+        import shutil
+        from stocklab.db import get_db, close_db
+        from stocklab.core.config import get_config
+        from stocklab.core import bundle
+        shutil.rmtree(os.path.join(get_config('root_dir'), 'columnar_test'),
+                ignore_errors=True)
+        get_config('database')['columnar'] = {'dirname': 'columnar_test',
+                'compact_after': 3}
+        close_db()
+        bundle.register(self.FooData, allow_overwrite=True)
+        node = bundle.get_node('FooData')
+        node.update_existed = True
+        with get_db('database') as db:
+            db.declare_table('FooData', node.schema)
+            db(db.FooData).delete()
+            db.update(node, [{'k1': k1, 'k2': i, 'val': i}
+                for k1 in ['a', 'b'] for i in range(10)])
+            db.update(node, [{'k1': 'a', 'k2': 3, 'val': 30}])
+            self.assertEqual(db.columnar.read(node).num_rows, 0)
+        with get_db('database') as db: # appended once committed
+            table = db.columnar.read(node, k1='a', k2=range(2, 5),
+                    columns=['k2', 'val'])
+            self.assertEqual(sorted(table.to_pylist(), key=lambda r: r['k2']),
+                    [{'k2': 2, 'val': 2}, {'k2': 3, 'val': 30},
+                        {'k2': 4, 'val': 4}])
+            self.assertEqual(db.columnar.read(node, latest=False).num_rows, 21)
+            db.update(node, [{'k1': 'a', 'k2': 4, 'val': 40}])
+            db.rollback()
+        with get_db('database') as db: # not appended if rolled back
+            self.assertEqual(db.columnar.read(node, latest=False).num_rows, 21)
+            for i in range(2):
+                db.update(node, [{'k1': 'b', 'k2': 0, 'val': i}])
+                db.commit()
+            # Compacted into one file per partition
+            self.assertEqual(len(db.columnar._files(node)), 2)
+            self.assertEqual(db.columnar.read(node, latest=False).num_rows, 20)
+            self.assertEqual(db.columnar.read(node, k1='b', k2=0,
+                columns=['val']).to_pylist(), [{'val': 1}])
+            db(db.FooData).delete()
+            self.assertEqual(db.columnar.export_to(db, node), 20)
+            self.assertEqual(db(db.FooData.val == 30).count(), 1)
+        close_db()
+
+    def test_streaming(self):
+        from stocklab.db import get_db
+        from stocklab.node import DataNode, Schema, Args, Arg, CrawlerTrigger
+        from stocklab.core import bundle
+        def crawl(day):
+            for d in range(day, day + 25):
+                yield {'day': d}
+            raise RuntimeError('page 3 failed')
+        async def acrawl(day):
+            for d in range(day, day + 25):
+                yield {'day': d}
+        class FooStream(DataNode):
+            crawler_entry = crawl
+            ingest_chunk_size = 10
+            args = Args(day = Arg(type=int))
+            schema = Schema(day = {'type': 'integer', 'key': True})
+
+            def evaluate(day):
+                table = FooStream.db[FooStream.name]
+                if FooStream.db(table.day == day).isempty():
+                    raise CrawlerTrigger(day=day)
+                return day
+        bundle.register(FooStream)
+        with get_db('database') as db:
+            db.declare_table('FooStream', FooStream.schema)
+            db(db.FooStream).delete()
+        with self.assertRaises(RuntimeError):
+            stocklab.eval('FooStream.day:100')
+        with get_db('database') as db:
+            db.rollback()
+            self.assertEqual(db(db.FooStream).count(), 20) # 2 chunks kept
+        FooStream.crawler_entry = acrawl
+        self.assertEqual(stocklab.eval('FooStream.day:200'), 200)
+        self.assertEqual(stocklab.eval('FooStream.day:224'), 224)
+        self.assertEqual(asyncio.run(stocklab.aeval('FooStream.day:300')), 300)
+
+    def test_write_behind(self):
+        from stocklab import ingest
+        from stocklab.db import get_db
+        from stocklab.core.config import get_config
+        from stocklab.node import DataNode, Schema, Args, Arg, CrawlerTrigger
+        from stocklab.core import bundle
+        get_config('database')['write_behind'] = {'batch_size': 4}
+        def crawl(day):
+            return [{'day': d, 'val': d * 2} for d in range(day, day + 10)]
+        class FooQueued(DataNode):
+            crawler_entry = crawl
+            from_record = lambda rec: rec['val']
+            args = Args(day = Arg(type=int))
+            schema = Schema(
+                    day = {'type': 'integer', 'key': True},
+                    val = {'type': 'integer'},
+                    )
+
+            def evaluate(day):
+                table = FooQueued.db[FooQueued.name]
+                rows = FooQueued.db(table.day == day).select()
+                if rows:
+                    return rows[0].val
+                raise CrawlerTrigger(day=day)
+        bundle.register(FooQueued)
+        with get_db('database') as db:
+            db.declare_table('FooQueued', FooQueued.schema)
+            db(db.FooQueued).delete()
+        self.assertEqual(stocklab.eval('FooQueued.day:100'), 200)
+        self.assertEqual(stocklab.eval('FooQueued.day:105'), 210)
+        self.assertEqual(stocklab.eval(
+            'MovingAverage.stock:acme.date_idx:2000.window:2'), 2122.5)
+        ingest.flush()
+        with get_db('database') as db:
+            self.assertEqual(db(db.FooQueued).count(), 10)
+
+        # A failed batch is raised to its node and not served any more
+        from stocklab.core.node import get_cache
+        class FooBroken(DataNode):
+            crawler_entry = lambda day: [{'day': day, 'val': 'bad'}]
+            from_record = lambda rec: rec['val']
+            args = Args(day = Arg(type=int))
+            schema = FooQueued.schema
+
+            def evaluate(day):
+                raise CrawlerTrigger(day=day)
+        bundle.register(FooBroken)
+        self.assertEqual(stocklab.eval('FooBroken.day:1'), 'bad')
+        writer = ingest.get_writer()
+        with self.assertRaises(AssertionError):
+            writer.flush('FooBroken')
+        self.assertIsNone(get_cache('FooBroken.day:1'))
+        writer.flush()
+
+    def test_sqlite_concurrency(self):
+        import os
+        import sqlite3
+        import tempfile
+        from stocklab.db import get_db, close_db, _retry_locked
+        from stocklab.core.error import ReadOnlyError
+        from stocklab.core.config import get_config
+        from stocklab.core import bundle
+        with tempfile.TemporaryDirectory() as root_dir:
+            config_file = os.path.join(root_dir, 'config.yml')
+            with open(config_file, 'w') as f:
+                f.write(f'root_dir: "{root_dir}"\nlog_level: INFO\n'
+                        'database:\n  type: sqlite\n  filename: db.sqlite\n'
+                        '  wal: true\n  pragmas:\n    cache_size: -8000\n')
+            stocklab.reset()
+            stocklab.configure(config_file)
+            with get_db('database') as db:
+                self.assertEqual(
+                        db.executesql('PRAGMA journal_mode;')[0][0], 'wal')
+                self.assertEqual(db.executesql('PRAGMA synchronous;')[0][0], 1)
+            self._update([{'k1': 'a', 'k2': 1, 'val': 5}])
+            config = get_config('database')
+            config['read_only'] = True
+            close_db()
+            with get_db('database') as db:
+                db.declare_table('FooData', self.FooData.schema)
+                self.assertEqual(db(db.FooData.k1 == 'a').count(), 1)
+                with self.assertRaises(ReadOnlyError):
+                    db.update(bundle.get_node('FooData'), [])
+            config['read_only'] = False
+            close_db()
+            attempts = []
+            def _locked():
+                attempts.append(1)
+                if len(attempts) < 3:
+                    raise sqlite3.OperationalError('database is locked')
+                return 'ok'
+            with get_db('database') as db:
+                retrying = _retry_locked(_locked, db, 5)
+                self.assertEqual(retrying(), 'ok')
+                self.assertEqual(len(attempts), 3)
+                # Not retried within a transaction
+                db.executesql("DELETE FROM FooData WHERE k1 = 'none';")
+                self.assertTrue(db._adapter.connection.in_transaction)
+                attempts.clear()
+                with self.assertRaises(sqlite3.OperationalError):
+                    retrying()
+                self.assertEqual(len(attempts), 1)
+                db.rollback()
+            close_db()
+
+    def test_session(self):
+        import threading
+        from stocklab.db import get_db
+        with get_db('database') as db:
+            pass
+        with get_db('database') as db2:
+            self.assertIs(db, db2)
+        sessions = []
+        def _worker():
+            with get_db('database') as db:
+                sessions.append(db)
+        thread = threading.Thread(target=_worker)
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], db)
+
+    def test_executor_session(self):
+        import stocklab.db
+        from stocklab.db import get_db
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle
+        from stocklab.core.node import flush_cache
+        from stocklab.core.executor import Executor
+        class FooSession(Node):
+            args = Args(n = Arg(type=int))
+
+            def evaluate(n):
+                with get_db('database'):
+                    return n
+
+        bundle.register(FooSession, allow_overwrite=True)
+        def _count():
+            return len(vars(stocklab.db)['__sessions'])
+        count = _count()
+        di_strs = [f'FooSession.n:{n}' for n in range(16)]
+        with Executor(max_workers=4) as executor:
+            for _ in range(3):
+                flush_cache()
+                self.assertEqual(stocklab.eval_many(di_strs,
+                    executor=executor), list(range(16)))
+                self.assertEqual(_count(), count)
+            self.assertIsNotNone(executor._threads) # kept within the context
+        self.assertIsNone(executor._threads)
+        executor = Executor(max_workers=4)
+        flush_cache()
+        self.assertEqual(stocklab.eval_many(di_strs, executor=executor),
+                list(range(16)))
+        self.assertIsNone(executor._threads) # shut down after the evaluation
+        self.assertEqual(_count(), count)
+
+if __name__ == '__main__':
+    unittest.main()
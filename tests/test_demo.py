@@ -18,9 +18,93 @@ class TestDemo(StocklabTestCase):
         self.assertIsNone(get_config('somethingNotExist'))
         self.assertIsNotNone(get_config('database'))
 
+    def test_logging(self):
+        import io
+        import os
+        import sys
+        import json
+        import logging
+        import tempfile
+        from stocklab.core import logger
+        with tempfile.TemporaryDirectory() as root_dir:
+            config_file = os.path.join(root_dir, 'config_json.yml')
+            with open(config_file, 'w') as f:
+                f.write(f'root_dir: "{root_dir}"\nlog_level: INFO\n'
+                        'log_format: json\n')
+            formatted = []
+            class Lazy:
+                def __str__(self):
+                    formatted.append(self)
+                    return 'lazy'
+            stocklab.reset()
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                stocklab.configure(config_file)
+                log = logger.get_instance('Foo')
+                filtered = Lazy()
+                log.debug('not formatted %s', filtered)
+                log.info('formatted %s', Lazy())
+                modified = ['logged']
+                log.info('%s', modified)
+                modified[0] = 'modified' # formatted before queued
+                try:
+                    raise ValueError('failed')
+                except ValueError:
+                    log.exception('error')
+                self.assertIsInstance(log.handlers[0],
+                        logging.handlers.QueueHandler)
+                logger._stop() # wait for the records to be written
+                lines = sys.stderr.getvalue().splitlines()
+            finally:
+                sys.stderr = stderr
+        self.assertNotIn(filtered, formatted)
+        entries = [json.loads(line) for line in lines]
+        self.assertEqual([entry['message'] for entry in entries],
+                ['formatted lazy', "['logged']", 'error'])
+        self.assertEqual(entries[0]['logger'], 'Foo')
+        self.assertIn('ValueError: failed', entries[2]['exc_info'])
+
     def test_demo(self):
         self.assertEqual(stocklab.eval(
             'MovingAverage.stock:acme.date_idx:1000.window:5'), 1121.0)
+        self.assertEqual(stocklab.eval(
+            'MovingAverage.stock:acme.date_idx:1000to1003.window:3'),
+            [1122.0, 1123.0, 1124.0])
+
+    def test_eval_many(self):
+        self.assertEqual(stocklab.eval_many([
+            'MovingAverage.stock:acme.date_idx:1001.window:3',
+            'Price.stock:acme.date_idx:1000',
+            'MovingAverage.stock:acme.date_idx:1000.window:3',
+            'Price.stock:acme.date_idx:1000',
+            ]), [1123.0, 1123, 1122.0, 1123])
+
+    def test_eval_many_process(self):
+        from stocklab.core.executor import Executor
+        di_strs = [f'MovingAverage.stock:acme.date_idx:{d}.window:3'
+                for d in range(1000, 1005)]
+        self.assertEqual(stocklab.eval_many(di_strs,
+            executor=Executor('process', 3)),
+            [1122.0 + i for i in range(5)])
+
+    def test_plan(self):
+        from stocklab.db import get_db, _MISSING_TABLE, _MISSING_SCHEMA
+        from stocklab.core import bundle
+        with get_db('database') as db: # crawled by a previous run
+            db.declare_table('Price', bundle.get_node('Price').schema)
+            db((db.Price.stock == 'acme') & (db.Price.date >= 2998)
+                    & (db.Price.date <= 3010)).delete()
+            db.declare_table(_MISSING_TABLE, _MISSING_SCHEMA)
+            db(db[_MISSING_TABLE].node == 'Price').delete()
+        di_strs = ['MovingAverage.date_idx:3000.stock:acme.window:3',
+                'MovingAverage.date_idx:3010.stock:acme.window:2']
+        plan = stocklab.plan(di_strs)
+        self.assertEqual(plan.missing, di_strs)
+        self.assertEqual(sorted(t.kwargs['date'] for t in
+            plan.triggers['Price']), [2998, 2999, 3000, 3009, 3010])
+        self.assertEqual(plan.crawl(), 2) # merged into 2 contiguous ranges
+        self.assertEqual(stocklab.plan(di_strs).triggers, {})
+        self.assertEqual(stocklab.eval_many(di_strs), [3122.0, 3132.5])
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,13 @@ import unittest
 import stocklab
 from lib import StocklabTestCase
 
+def _has_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
 class TestNode(StocklabTestCase):
     def setUp(self):
         super().setUp()
@@ -30,6 +37,233 @@ class TestNode(StocklabTestCase):
         self.assertRaises(
                 AssertionError, stocklab.eval, 'FooNode.a:1.b:2.c:321')
 
+    def test_batch(self):
+        from stocklab.core import bundle
+        bundle.register(self.FooNode, allow_overwrite=True)
+        node = bundle.get_node('FooNode')
+        results = node.batch([
+            {'a': 'x', 'b': '1', 'c': 'foo'},
+            {'a': 'y', 'b': 2, 'c': '123'},
+            {'a': 'x', 'b': 1, 'c': 'foo'},
+            ])
+        self.assertEqual(results, [('x', 1, 'foo'), ('y', 2, '123'),
+            ('x', 1, 'foo')])
+        self.assertEqual(stocklab.eval_many(
+            ['FooNode.a:1.b:2.c:123', 'FooNode.a:3.b:4.c:foo']),
+            [('1', 2, '123'), ('3', 4, 'foo')])
+
+    def test_data_identifier(self):
+        import pickle
+        from stocklab import DataIdentifier
+        from stocklab.core import bundle
+        from stocklab.core.node import get_cache
+        bundle.register(self.FooNode, allow_overwrite=True)
+        di = DataIdentifier('FooNode.c:123.b:02.a:1')
+        self.assertEqual(di, 'FooNode.a:1.b:2.c:123')
+        self.assertIs(DataIdentifier('FooNode.a:1.b:2.c:123'), di)
+        self.assertEqual(di.fields, {'a': '1', 'b': 2, 'c': '123'})
+        self.assertEqual(DataIdentifier('FooNode').name, 'FooNode')
+        self.assertIs(DataIdentifier('FooNode').args, di.node.args)
+        self.assertEqual(di(), ('1', 2, '123'))
+        self.assertEqual(get_cache(di), ('1', 2, '123'))
+        self.assertIs(pickle.loads(pickle.dumps(di)), di)
+        foo = DataIdentifier('FooNode.a:x')
+        self.assertEqual(foo(b=3, c='foo'), ('x', 3, 'foo'))
+        self.assertRaises(AssertionError, foo)
+        self.assertRaises(AssertionError, DataIdentifier, 'FooNode.d:1')
+
+    def test_series(self):
+        from stocklab import DataIdentifier
+        from stocklab.node import SeriesNode, Args, Arg
+        from stocklab.core import bundle
+        calls = []
+        class Square(SeriesNode):
+            axis = 'x'
+            chunk_size = 4
+            args = Args(x = Arg(type=int), offset = Arg(type=int))
+
+            def evaluate(x, offset):
+                calls.append(x)
+                return [i * i + offset for i in x]
+
+        bundle.register(Square, allow_overwrite=True)
+        self.assertEqual(stocklab.eval('Square.x:3.offset:1'), 10)
+        self.assertEqual(stocklab.eval('Square.x:2to9.offset:1'),
+                [5, 10, 17, 26, 37, 50, 65])
+        self.assertEqual(DataIdentifier('Square.offset:1').batch(
+            [{'x': x} for x in range(4, 7)]), [17, 26, 37])
+        # Only the requested values of the partial chunks are evaluated
+        self.assertEqual(calls, [range(3, 4), range(2, 4), range(4, 8),
+            range(8, 9)])
+
+    def test_series_data(self):
+        from stocklab.node import SeriesNode, DataNode, Schema, Args, Arg
+        from stocklab.node import CrawlerTrigger, select_column
+        from stocklab.node import missing_range
+        from stocklab.core import bundle
+        crawls = []
+        def crawl(start, stop, stock):
+            crawls.append(range(start, stop))
+            return [{'stock': stock, 'date': d, 'price': d * 2}
+                    for d in range(start, stop)]
+        class FooSeries(SeriesNode, DataNode):
+            axis = 'date_idx'
+            chunk_size = 16
+            crawler_entry = crawl
+            args = Args(date_idx = Arg(type=int), stock = Arg())
+            schema = Schema(
+                    stock = {'key': True},
+                    date = {'type': 'integer', 'key': True},
+                    price = {'type': 'integer'},
+                    )
+            key_map = {'date_idx': 'date'}
+
+            def evaluate(date_idx, stock):
+                prices = select_column(FooSeries, 'price', stock=stock,
+                        date_idx=date_idx)
+                missing = missing_range(prices, date_idx)
+                if missing is not None:
+                    raise CrawlerTrigger(start=missing.start,
+                            stop=missing.stop, stock=stock)
+                return prices
+
+        bundle.register(FooSeries, allow_overwrite=True)
+        from stocklab.db import get_db
+        with get_db('database') as db:
+            db.declare_table('FooSeries', FooSeries.schema)
+            db(db.FooSeries).delete()
+        self.assertEqual(stocklab.eval('FooSeries.stock:acme.date_idx:100'),
+                200)
+        self.assertEqual(stocklab.eval(
+            'FooSeries.stock:acme.date_idx:90to101'),
+            [d * 2 for d in range(90, 101)])
+        # The date 100 is not crawled again
+        self.assertEqual(crawls, [range(100, 101), range(90, 96),
+            range(96, 100)])
+        self.assertEqual(missing_range([1, None, None, 4, None], range(5)),
+                range(1, 3))
+
+    @unittest.skipUnless(_has_numpy(), 'NumPy is not installed')
+    def test_series_numpy(self):
+        import numpy
+        from stocklab.node import SeriesNode, Args, Arg
+        from stocklab.core import bundle
+        class Ramp(SeriesNode):
+            axis = 'x'
+            chunk_size = 8
+            args = Args(x = Arg(type=int))
+
+            def evaluate(x):
+                return numpy.arange(x.start, x.stop) * 0.5
+
+        bundle.register(Ramp, allow_overwrite=True)
+        series = stocklab.eval('Ramp.x:5to20')
+        self.assertIsInstance(series, numpy.ndarray)
+        self.assertEqual(series.tolist(), [x * 0.5 for x in range(5, 20)])
+        self.assertEqual(stocklab.eval('Ramp.x:9'), 4.5)
+
+    def test_persist(self):
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle, persist
+        from stocklab.core.node import flush_cache
+        calls = []
+        class BarNode(Node):
+            persist = True
+            args = Args(a = Arg(type=int))
+
+            def evaluate(a):
+                calls.append(a)
+                return a * 2
+
+        bundle.register(BarNode, allow_overwrite=True)
+        persist.get_store().discard('BarNode.a:21')
+        self.assertEqual(stocklab.eval('BarNode.a:21'), 42)
+        flush_cache()
+        self.assertEqual(stocklab.eval('BarNode.a:21'), 42)
+        self.assertEqual(calls, [21])
+
+    def test_executor(self):
+        import sys
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle
+        from stocklab.core.executor import Executor
+        class Chain(Node):
+            args = Args(n = Arg(type=int))
+
+            def evaluate(n):
+                if n == 0:
+                    return 1
+                return bundle.get_node('Chain')(n=n - 1) + 1
+
+        bundle.register(Chain, allow_overwrite=True)
+        depth = sys.getrecursionlimit() * 2
+        di_strs = [f'Chain.n:{depth}', f'Chain.n:{depth // 2}',
+                'MovingAverage.stock:acme.date_idx:1000.window:5']
+        self.assertEqual(stocklab.eval_many(di_strs,
+            executor=Executor(max_workers=4)), [depth + 1, depth // 2 + 1,
+                1121.0])
+
+    def test_executor_rounds(self):
+        from stocklab.node import Node, Args, Arg
+        from stocklab.core import bundle
+        from stocklab.core.executor import Executor
+        calls = []
+        class Leaf(Node):
+            args = Args(i = Arg(type=int))
+
+            def evaluate(i):
+                return i + 1
+
+        class Sum(Node):
+            args = Args(n = Arg(type=int))
+
+            def evaluate(n):
+                calls.append(n)
+                # Each request depends on the previous value
+                total = 0
+                for _ in range(n):
+                    total = bundle.get_node('Leaf')(i=total)
+                return total
+
+        bundle.register(Leaf, allow_overwrite=True)
+        bundle.register(Sum, allow_overwrite=True)
+        with Executor(max_workers=2) as executor:
+            self.assertEqual(stocklab.eval_many(['Sum.n:50'],
+                executor=executor), [50])
+        self.assertEqual(len(calls), 3) # stopped twice, then run inline
+
+    def test_trace(self):
+        import json
+        from stocklab.core import bundle
+        from stocklab.core.trace import tracing
+        bundle.register(self.FooNode, allow_overwrite=True)
+        with tracing() as tracer:
+            stocklab.eval('FooNode.a:1.b:2.c:123')
+            stocklab.eval('FooNode.a:1.b:2.c:123')
+        first, second = tracer.to_dict()
+        self.assertEqual(first['name'], 'FooNode.a:1.b:2.c:123')
+        self.assertEqual(first['attrs']['cache'], 'miss')
+        self.assertEqual([c['kind'] for c in first['children']], ['evaluate'])
+        self.assertEqual(second['attrs']['cache'], 'hit')
+        self.assertEqual(first['crawls'], 0)
+        events = json.loads(tracer.to_chrome_trace())['traceEvents']
+        self.assertEqual(len(events), 3)
+
+    def test_trace_executor(self):
+        from stocklab.core import bundle
+        from stocklab.core.trace import tracing
+        from stocklab.core.executor import Executor
+        bundle.register(self.FooNode, allow_overwrite=True)
+        di_strs = [f'FooNode.a:{a}.b:2.c:foo' for a in ['x', 'y']]
+        with tracing() as tracer:
+            with tracer.span('batch', 'test'):
+                stocklab.eval_many(di_strs, executor=Executor(max_workers=2))
+        roots = tracer.to_dict()
+        # The spans of the workers are nested in the caller's span
+        self.assertEqual([root['name'] for root in roots], ['batch'])
+        self.assertEqual(sorted(c['name'] for c in roots[0]['children']),
+                di_strs)
+
 if __name__ == '__main__':
     unittest.main()
 